@@ -12,18 +12,50 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import re
+import glob
 import time
-from Bio import SeqIO
-from Bio.Seq import Seq
+import signal
+import subprocess
+import multiprocessing
 from ARC import Config
 from ARC import logger
 from ARC import FatalError
 from ARC import Spawn
 from ARC.functions import *
+from ARC import seqio
+from ARC.read_index import build_index
+from ARC.index_cache import IndexCache
+from ARC.state import StateStore
+
+
+def index_reads(job):
+    """
+        Build the read index for a single SE file or a PE1/PE2 pair. This
+        runs inside of the indexing pool, so errors are returned to the
+        parent rather than raised.
+    """
+    sample, filetype, files, index_file, format, sra, cache = job
+    start = time.time()
+    cached = False
+    key = None
+    try:
+        if cache is not None:
+            nreads, cached, key = cache.fetch(index_file, files, format, sra)
+        else:
+            nreads = build_index(index_file, files, format, sra)
+    except FatalError as e:
+        return (sample, filetype, files, 0, time.time() - start, cached, key, e.msg)
+    return (sample, filetype, files, nreads, time.time() - start, cached, key, None)
+
+
+def ignore_sigint():
+    # Pool workers leave KeyboardInterrupt handling to the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
 
 
 class App:
-    def start(self, loglevel, configfile='ARC_config.txt'):
+    def start(self, loglevel, configfile='ARC_config.txt', resume=False):
         try:
             logger.setup(loglevel=loglevel)
 
@@ -33,7 +65,7 @@ class App:
 
             logger.info(
                 "Setting up working directories and building indexes...")
-            self.setup(values)
+            self.setup(values, resume)
 
             spawn = Spawn(values)
 
@@ -53,7 +85,7 @@ class App:
             logger.error("%s unexpectedly terminated" % (__name__))
             return 1
 
-    def setup(self, config):
+    def setup(self, config, resume=False):
         """
             Set up working folder for each sample. Also assign a "safe_target"
             name to each target so that folder creation works. This is a little
@@ -62,8 +94,13 @@ class App:
             therefore written with the assumption that the user has put the _:_
             in the name purposely so that multiple entries in the reference
             fasta will be treated as a single target.
+
+            With resume the folders and the run state database of the last
+            run are kept and each sample goes back to its last checkpoint
+            (see resume()) instead.
         """
         format = config['format']
+        index_jobs = []
         for sample in config['Samples']:
             s = config['Samples'][sample]
             working_dir = os.path.realpath(config['workingdirectory'] + '/working_' + sample)
@@ -71,12 +108,18 @@ class App:
             finished_dir = os.path.realpath('./finished_' + sample)
             config['Samples'][sample]['working_dir'] = working_dir
             config['Samples'][sample]['finished_dir'] = finished_dir
-            if os.path.exists(working_dir):
+            if resume:
+                if not (os.path.exists(working_dir) and os.path.exists(finished_dir)):
+                    raise FatalError(
+                        "Error, can't resume sample %s, %s or %s is missing." % (
+                            sample, working_dir, finished_dir))
+            elif os.path.exists(working_dir):
                 logger.info(
                     "WARNING working directory already exists for "
                     "sample %s, deleting old results if any." % (sample))
                 os.system('rm -rf %s' % finished_dir)
                 os.system('rm -rf %s/t__*' % working_dir)
+                os.system('rm -rf %s/I*.pack* %s/scratch' % (working_dir, working_dir))
                 os.system('rm -rf %s/*.psl' % working_dir)
                 os.system('rm %s/I*_contigs.fasta' % working_dir)
                 if os.path.exists('%s/idx' % working_dir):
@@ -86,108 +129,241 @@ class App:
                 os.mkdir(working_dir)
                 os.mkdir(finished_dir)
 
-            # Create stats file:
-            statsf = open(os.path.join(finished_dir, "mapping_stats.tsv"), 'w')
-            statsf.write('\t'.join(
-                ['Sample', 'Target', 'Iteration', 'Reads']) + '\n')
-            statsf.close()
-
-            # Create Target Summary Table
-            tstf = open(os.path.join(finished_dir, "target_summary_table.tsv"), 'w')
-            tstf.write('\t'.join(
-                ['Sample', 'Target', 'RefLen', 'Status', 'Iteration', 'Reads', 'Contigs', 'ContigLength']) + '\n')
-            tstf.close()
-
-            # Create a stats file for cdna
-            if config['cdna']:
-                countsf = open(os.path.join(finished_dir, "isogroup_read_counts.tsv"), 'a')
-                countsf.write('\t'.join(['Sample', 'Target', 'isogroup', 'readcount']) + '\n')
-                countsf.close()
-
-            # Build a separate index for each read file in the input, put them
-            # in working_dir
-            # Consider parallelizing this?
-            try:
-                start = time.time()
-                if 'PE1' in s:
-                    if not os.path.exists(os.path.join(working_dir, "PE1.idx")):
-                        print s['PE1']
-                        index_file = os.path.join(working_dir, "PE1.idx")
-                        p1 = SeqIO.index_db(index_file, s['PE1'], format,
-                                            key_function=keyfunction(config['sra']))
-                if 'PE2' in s:
-                    if not os.path.exists(os.path.join(working_dir, "PE2.idx")):
-                        print s['PE2']
-                        index_file = os.path.join(working_dir, "PE2.idx")
-                        p2 = SeqIO.index_db(index_file, s['PE2'], format,
-                                            key_function=keyfunction(config['sra']))
-                        if len(p1) != len(p2):
-                            logger.error("The number of reads in %s and %s do not match, "
-                                         "check the config for errors" % (s['PE1'], s['PE2']))
-                if 'SE' in s:
-                    if not os.path.exists(os.path.join(working_dir, "SE.idx")):
-                        print s['SE']
-                        index_file = os.path.join(working_dir, "SE.idx")
-                        SeqIO.index_db(index_file, s['SE'], format,
-                                       key_function=keyfunction(config['sra']))
-            except (KeyboardInterrupt, SystemExit):
-                print "Removing partial index: %s" % index_file
-                os.unlink(index_file)
-                raise
-            logger.info(
-                "Sample: %s, indexed reads in %s seconds." % (
-                    sample, time.time() - start))
+            if not resume:
+                # Create stats file, with normalization counts only when it is on:
+                statsf = open(os.path.join(finished_dir, "mapping_stats.tsv"), 'w')
+                header = ['Sample', 'Target', 'Iteration', 'Reads']
+                if config['normalize_coverage'] > 0:
+                    header += ['NormKept', 'NormDropped']
+                statsf.write('\t'.join(header) + '\n')
+                statsf.close()
+
+                # Create Target Summary Table
+                tstf = open(os.path.join(finished_dir, "target_summary_table.tsv"), 'w')
+                tstf.write('\t'.join(
+                    ['Sample', 'Target', 'RefLen', 'Status', 'Iteration', 'Reads', 'Contigs', 'ContigLength']) + '\n')
+                tstf.close()
+
+                # Create a stats file for cdna
+                if config['cdna']:
+                    countsf = open(os.path.join(finished_dir, "isogroup_read_counts.tsv"), 'a')
+                    countsf.write('\t'.join(['Sample', 'Target', 'isogroup', 'readcount']) + '\n')
+                    countsf.close()
+
+            # Queue up an index build for the PE pair and the SE file in the
+            # input, the indexes themselves go in working_dir
+            if 'PE1' in s and 'PE2' in s:
+                index_file = os.path.join(working_dir, "PE.idx")
+                if not os.path.exists(index_file):
+                    index_jobs.append((sample, 'PE', [s['PE1'], s['PE2']], index_file, format, config['sra']))
+            if 'SE' in s:
+                index_file = os.path.join(working_dir, "SE.idx")
+                if not os.path.exists(index_file):
+                    index_jobs.append((sample, 'SE', [s['SE']], index_file, format, config['sra']))
 
             # Read through the references, mask them if necessary
 
             # mapper_params['reference'] = os.path.join(self.params['working_dir'], 'I%03d' % self.params['iteration'] + '_contigs.fasta')
 
+        self.build_indexes(config, index_jobs)
+
+        if resume:
+            shared_dir = os.path.realpath(os.path.join(config['workingdirectory'], 'shared_working'))
+            config['shared_dir'] = shared_dir
+            config['initial_reference'] = os.path.join(shared_dir, 'I000_contigs.fasta')
+            config['state_db'] = os.path.join(shared_dir, 'state.db')
+            self.resume(config)
+            if config['mapper'] == 'bowtie2':
+                self.build_initial_index(config)
+            return
+
         # Read through the reference, set up a set of safe names for the targets.
         # Also create the Target Summary Table which is indexed by original target name (following ARC conventions)
-        # Also mask sequences and write them to a new set of output files
-        # safe_targets is a two-way lookup, meaning it has both the safe target ID and the contig ID.
+        # Also mask sequences and write them to a single shared I000_contigs.fasta which is linked into
+        # each sample's working_dir.
+        # Record i of the reference gets the safe name t__i, names lists the
+        # target of each record. Both go to the run state database (see
+        # ARC.state) which jobs look them up in.
         summary_stats = {}
-        safe_targets = {}
-        new_refsf = {}
-        for sample in config['Samples']:
-            s = config['Samples'][sample]
-            new_refsf[sample] = open(os.path.join(s['working_dir'], 'I000_contigs.fasta'), 'w')
+        names = []
+        shared_dir = os.path.realpath(os.path.join(config['workingdirectory'], 'shared_working'))
+        if not os.path.exists(shared_dir):
+            os.mkdir(shared_dir)
+        config['shared_dir'] = shared_dir
+        config['initial_reference'] = os.path.join(shared_dir, 'I000_contigs.fasta')
+        new_reff = seqio.RecordWriter(open(config['initial_reference'], 'w'), 'fasta')
 
-        i = 0
-        for t in SeqIO.parse(config['reference'], "fasta"):
-            if len(t.name.split("_:_")) == 1:
-                target = t.name
+        reff = open(config['reference'], 'r')
+        for title, seq, qual in seqio.read_records(reff, 'fasta'):
+            name = seqio.record_id(title)
+            if len(name.split("_:_")) == 1:
+                target = name
             else:
-                target = t.name.split("_:_")[1]
+                target = name.split("_:_")[1]
 
-            safe_targets[target] = "t__%06d" % i
-            safe_targets["t__%06d" % i] = target
-            i += 1
+            names.append(target)
             if target not in summary_stats:
-                summary_stats[target] = {'targetLength': len(t)}
+                summary_stats[target] = {'targetLength': len(seq)}
             else:
-                summary_stats[target]['targetLength'] = (summary_stats[target]['targetLength'] + len(t))
+                summary_stats[target]['targetLength'] = (summary_stats[target]['targetLength'] + len(seq))
 
             # Write contigs:
             if config['maskrepeats']:
-                t.seq = Seq(str(mask_seq(str(t.seq), config['mapper'])))
+                seq = str(mask_seq(seq, config['mapper']))
             # Bowtie2 crashes if a contig is all 'n' so only write it out if it isn't
-            if len(t) != t.seq.count('n'):
-                for outf in new_refsf.values():
-                    SeqIO.write(t, outf, "fasta")
+            if len(seq) != seq.count('n'):
+                new_reff.write(title, seq)
             else:
-                writeTargetStats(finished_dir=s['finished_dir'],
-                                 sample=sample,
-                                 target=target,
-                                 targetLength=summary_stats[target]['targetLength'],
-                                 status='MaskedOut',
-                                 iteration=0,
-                                 readcount=0,
-                                 num_contigs=0, contig_length=0)
+                for sample in config['Samples']:
+                    writeTargetStats(finished_dir=config['Samples'][sample]['finished_dir'],
+                                     sample=sample,
+                                     target=target,
+                                     targetLength=summary_stats[target]['targetLength'],
+                                     status='MaskedOut',
+                                     iteration=0,
+                                     readcount=0,
+                                     num_contigs=0, contig_length=0)
                 del summary_stats[target]
+        reff.close()
+        new_reff.close()
+
+        for sample in config['Samples']:
+            link_file(config['initial_reference'],
+                      os.path.join(config['Samples'][sample]['working_dir'], 'I000_contigs.fasta'))
+
+        config['state_db'] = os.path.join(shared_dir, 'state.db')
+        state = StateStore.create(config['state_db'], names, summary_stats, config['Samples'].keys())
+        # A run resumed before the first Finisher starts over from here
+        for sample in config['Samples']:
+            state.checkpoint(sample, 0, config['initial_reference'], False,
+                             file_sizes(config['Samples'][sample]['finished_dir']))
+        state.close()
+        logger.info("Recorded %s targets in the run state database %s" % (len(summary_stats), config['state_db']))
 
-        config['safe_targets'] = safe_targets
-        config['summary_stats'] = summary_stats
+        if config['mapper'] == 'bowtie2':
+            self.build_initial_index(config)
+
+    def resume(self, config):
+        """
+            Take each sample back to the checkpoint its last Finisher left:
+            cut its finished files back to their size then, remove what
+            later iterations left in its working folder and undo their
+            changes to the run state database. The checkpoint goes in
+            config['Samples'][sample]['checkpoint'] for Spawn.submit.
+        """
+        state = StateStore(config['state_db'])
+        try:
+            for sample in config['Samples']:
+                s = config['Samples'][sample]
+                checkpoint = state.last_checkpoint(sample)
+                if checkpoint is None:
+                    raise FatalError(
+                        "Error, there is no checkpoint of sample %s to resume from, "
+                        "start a new run instead." % sample)
+                truncate_files(s['finished_dir'], checkpoint.files)
+                working_dir = s['working_dir']
+                # Target folders are split again from empty read files
+                os.system('rm -rf %s/t__* %s/idx %s/blat_shards' % (working_dir, working_dir, working_dir))
+                os.system('rm -rf %s/I*.pack* %s/scratch' % (working_dir, working_dir))
+                os.system('rm -rf %s/*.psl' % working_dir)
+                for path in glob.glob(os.path.join(working_dir, 'I*_contigs.fasta')) + \
+                        glob.glob(os.path.join(working_dir, 'read_map.I*')):
+                    if int(re.search(r'I(\d+)', os.path.basename(path)).group(1)) > checkpoint.iteration:
+                        os.remove(path)
+                state.rollback(sample, checkpoint.iteration)
+                s['checkpoint'] = checkpoint
+                if checkpoint.finished:
+                    logger.info("Sample: %s finished in iteration %s, nothing to resume." % (sample, checkpoint.iteration))
+                else:
+                    logger.info("Sample: %s resuming from the checkpoint of iteration %s." % (sample, checkpoint.iteration))
+        finally:
+            state.close()
+
+    def build_indexes(self, config, index_jobs):
+        """
+            Build the read indexes for all samples at once using a pool of
+            nprocs workers. Partial indexes are removed if ARC is killed
+            while indexing.
+        """
+        if len(index_jobs) == 0:
+            return
+        cache = None
+        if config['indexcache']:
+            cache = IndexCache(config['indexcache'], config['indexcache_size'],
+                               config['indexcache_checksum'])
+            logger.info("Using the read index cache in %s" % config['indexcache'])
+        index_jobs = [job + (cache,) for job in index_jobs]
+        nprocs = max(1, min(int(config['nprocs']), len(index_jobs)))
+        logger.info("Indexing %s read files using %s processes." % (len(index_jobs), nprocs))
+        start = time.time()
+        pool = multiprocessing.Pool(nprocs, ignore_sigint)
+        try:
+            # get() with a timeout keeps the parent interruptible
+            results = pool.map_async(index_reads, index_jobs, chunksize=1).get(2 ** 31)
+            pool.close()
+        except (KeyboardInterrupt, SystemExit):
+            pool.terminate()
+            # The workers have to be gone (and their cache locks released)
+            # before their partial indexes can be removed
+            pool.join()
+            for job in index_jobs:
+                for f in glob.glob(job[3] + '.tmp*'):
+                    print "Removing partial index: %s" % f
+                    os.unlink(f)
+            if cache is not None:
+                cache.clean()
+            raise
+        finally:
+            pool.join()
+
+        for sample, filetype, files, nreads, seconds, cached, key, error in results:
+            if error is not None:
+                raise FatalError(error)
+            if cached:
+                logger.info("Sample: %s, reused cached index of %s %s reads from %s." % (
+                    sample, nreads, filetype, ', '.join(files)))
+                continue
+            size = sum([os.path.getsize(f) for f in files]) / 1048576.0
+            logger.info(
+                "Sample: %s, indexed %s %s reads from %s in %s seconds (%.0f reads/s, %.1f MB/s)." % (
+                    sample, nreads, filetype, ', '.join(files), seconds,
+                    nreads / max(seconds, 0.001), size / max(seconds, 0.001)))
+        if cache is not None:
+            # Entries this run just fetched are never evicted by it
+            cache.evict(keep=set(r[6] for r in results))
+        logger.info("Indexed all reads in %s seconds." % (time.time() - start))
+
+    def build_initial_index(self, config):
+        """
+            Build the bowtie2 index for I000_contigs.fasta once, all samples
+            share it (read-only) on the first iteration.
+        """
+        idx_dir = os.path.join(config['shared_dir'], 'idx')
+        if os.path.exists(idx_dir):
+            os.system('rm -rf %s' % idx_dir)
+        os.mkdir(idx_dir)
+        base = os.path.join(idx_dir, 'idx')
+        threads = config['bowtie2_build_threads']
+        if threads <= 0:
+            threads = config['nprocs']
+        args = ['bowtie2-build', '-f', '--threads', str(threads), config['initial_reference'], base]
+        if config['verbose']:
+            out = open(os.path.join(config['shared_dir'], "bowtie2-build_log.txt"), 'w')
+        else:
+            out = open(os.devnull, 'w')
+        logger.info("Building the shared bowtie2 index for I000_contigs.fasta.")
+        logger.info(" ".join(args))
+        start = time.time()
+        try:
+            ret = subprocess.call(args, stdout=out, stderr=out)
+        except Exception as exc:
+            raise FatalError("Unhandeled error running bowtie2-build\n\t%s" % exc)
+        finally:
+            out.close()
+        if ret != 0:
+            raise FatalError("Error creating the shared bowtie2 index, check log file.")
+        config['initial_index'] = base
+        logger.info("Built the shared bowtie2 index in %s seconds." % (time.time() - start))
 
     def clean(self):
         pass
@@ -0,0 +1,152 @@
+# Copyright 2013, Institute for Bioninformatics and Evolutionary Studies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import zlib
+import struct
+from collections import OrderedDict
+from ARC import exceptions
+
+# BGZF files (as written by bgzip) are a series of gzip members of at most
+# 64kb each, with the compressed size of the member stored in a 'BC' extra
+# field. A position in the file is a virtual offset:
+#     (offset of the block in the file << 16) | offset within the block
+# which lets us seek to a record by decompressing only the blocks it spans.
+
+GZIP_HEADER = struct.Struct('<4BI2BH')
+
+
+def is_gzip(filename):
+    inf = open(filename, 'rb')
+    magic = inf.read(2)
+    inf.close()
+    return magic == '\x1f\x8b'
+
+
+def is_bgzf(filename):
+    inf = open(filename, 'rb')
+    header = inf.read(GZIP_HEADER.size)
+    extra = inf.read(6)
+    inf.close()
+    if len(header) < GZIP_HEADER.size:
+        return False
+    id1, id2, cm, flg, mtime, xfl, osflag, xlen = GZIP_HEADER.unpack(header)
+    return (id1 == 31 and id2 == 139 and flg & 4 and xlen >= 6 and extra[0:2] == 'BC')
+
+
+def open_reads(filename):
+    """
+    Open a read file for random access. Plain text files are opened
+    directly, BGZF files get a BgzfReader and other gzip files are refused
+    because they can't be seeked into without decompressing everything.
+    """
+    if is_bgzf(filename):
+        return BgzfReader(filename)
+    if is_gzip(filename):
+        raise exceptions.FatalError(
+            "Error, %s is gzip compressed but not BGZF, please recompress it "
+            "with bgzip so it can be indexed." % filename)
+    return open(filename, 'rb')
+
+
+class BgzfReader:
+    """
+    A read-only, seekable file object for BGZF files. tell() and seek() use
+    virtual offsets, read() and readline() return decompressed text.
+    Decompressed blocks are kept in an LRU cache so that neighbouring
+    records don't decompress the same block twice.
+    """
+
+    def __init__(self, filename, cache_size=256):
+        self.filename = filename
+        self.handle = open(filename, 'rb')
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.seek(0)
+
+    def load_block(self, coffset):
+        """ Return (data, offset of the next block) for the block at coffset """
+        if coffset in self.cache:
+            block = self.cache.pop(coffset)
+            self.cache[coffset] = block
+            return block
+        self.handle.seek(coffset)
+        header = self.handle.read(GZIP_HEADER.size)
+        if not header:
+            return ('', coffset)
+        id1, id2, cm, flg, mtime, xfl, osflag, xlen = GZIP_HEADER.unpack(header)
+        if id1 != 31 or id2 != 139 or not flg & 4:
+            raise exceptions.FatalError(
+                "Error, bad BGZF block at offset %s in %s" % (coffset, self.filename))
+        extra = self.handle.read(xlen)
+        bsize = None
+        i = 0
+        while i < xlen:
+            slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == 'BC':
+                bsize = struct.unpack('<H', extra[i + 4:i + 6])[0]
+            i += 4 + slen
+        if bsize is None:
+            raise exceptions.FatalError(
+                "Error, missing BGZF block size at offset %s in %s" % (coffset, self.filename))
+        cdata = self.handle.read(bsize - xlen - 19)
+        self.handle.read(8)  # CRC32 and ISIZE
+        block = (zlib.decompress(cdata, -15), coffset + bsize + 1)
+        self.cache[coffset] = block
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return block
+
+    def _advance(self):
+        # Move past exhausted (or empty) blocks, returns False at EOF
+        while self.within >= len(self.data):
+            if self.next_coffset == self.coffset:
+                return False
+            self.coffset = self.next_coffset
+            self.data, self.next_coffset = self.load_block(self.coffset)
+            self.within = 0
+        return True
+
+    def seek(self, voffset):
+        self.coffset = voffset >> 16
+        self.data, self.next_coffset = self.load_block(self.coffset)
+        self.within = voffset & 0xFFFF
+
+    def tell(self):
+        self._advance()
+        return (self.coffset << 16) | self.within
+
+    def read(self, size):
+        chunks = []
+        while size > 0 and self._advance():
+            chunk = self.data[self.within:self.within + size]
+            self.within += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def readline(self):
+        chunks = []
+        while self._advance():
+            i = self.data.find('\n', self.within)
+            if i >= 0:
+                chunks.append(self.data[self.within:i + 1])
+                self.within = i + 1
+                break
+            chunks.append(self.data[self.within:])
+            self.within = len(self.data)
+        return ''.join(chunks)
+
+    def close(self):
+        self.handle.close()
+        self.cache.clear()
@@ -20,6 +20,7 @@ import subprocess
 from subprocess import CalledProcessError
 from ARC import logger
 from ARC import exceptions
+from ARC.bgzf import is_gzip, is_bgzf
 
 
 class Config:
@@ -44,7 +45,23 @@ class Config:
         'sloppymapping': True,
         'workingdirectory': './',
         'only-assembler': False,
-        'sra': False
+        'sra': False,
+        'indexcache': False,
+        'indexcache_size': 0,
+        'indexcache_checksum': False,
+        'bowtie2_build_threads': 0,
+        'streammapping': True,
+        'blat_shards': 0,
+        'sequentialsplit': False,
+        'splithandles': 256,
+        'splitjobs': 0,
+        'max_reads_per_target': 0,
+        'normalize_coverage': 0,
+        'normalize_ksize': 20,
+        'normalize_memory': 64,
+        'packedstore': False,
+        'scratchdir': False,
+        'rollingrounds': 0
     }
     FORMATS = ['fastq', 'fasta']
     ASSEMBLERS = {
@@ -206,10 +223,28 @@ class Config:
                     raise exceptions.FatalError(
                         "Error you must specify PE files and/or a SE file for "
                         "each sample.")
+
+                # Compressed reads must be BGZF so that they can be indexed
+                for filetype in self.config['Samples'][sample]:
+                    filename = self.config['Samples'][sample][filetype]
+                    if is_gzip(filename):
+                        if not is_bgzf(filename):
+                            raise exceptions.FatalError(
+                                "Error, %s is gzip compressed but not BGZF, "
+                                "please recompress it with bgzip." % filename)
+                        if self.config['mapper'] == 'blat':
+                            raise exceptions.FatalError(
+                                "Error, blat can't read compressed files, please "
+                                "decompress %s or use bowtie2." % filename)
         else:
             raise exceptions.FatalError(
                 "Could not find samples in %s" % self.filename)
 
+        # A shared read index cache is optional
+        if self.config['indexcache']:
+            self.config['indexcache'] = os.path.realpath(
+                self.config['indexcache'])
+
         if self.config['format'] not in self.FORMATS:
             raise exceptions.FatalError(
                 "Error, file format not specificed in ARC_self.txt.")
@@ -228,10 +263,30 @@ class Config:
         else:
             self.check_bins(self.ASSEMBLERS[self.config['assembler']])
 
-        if self.config['subsample'] <= 0 and self.config['subsample'] > 1:
+        if self.config['subsample'] <= 0 or self.config['subsample'] > 1:
             raise exceptions.FatalError(
                 "Error, you must specify a value greater than 0 and less than or equal to 1 for subsample")
 
+        if self.config['max_reads_per_target'] < 0:
+            raise exceptions.FatalError(
+                "Error, max_reads_per_target must be 0 (no limit) or a positive number of reads")
+
+        if self.config['normalize_coverage'] > 0 and (self.config['normalize_ksize'] < 1 or self.config['normalize_memory'] <= 0):
+            raise exceptions.FatalError(
+                "Error, normalize_ksize and normalize_memory must be positive when normalize_coverage is set")
+
+        if self.config['packedstore'] and (self.config['cdna'] or self.config['sequentialsplit']):
+            raise exceptions.FatalError(
+                "Error, packedstore can't be combined with cdna or sequentialsplit")
+
+        if self.config['rollingrounds'] < 0 or self.config['rollingrounds'] > 1:
+            raise exceptions.FatalError(
+                "Error, rollingrounds must be 0 (off) or a fraction of the assemblies up to 1")
+
+        if self.config['rollingrounds'] and self.config['packedstore']:
+            raise exceptions.FatalError(
+                "Error, rollingrounds can't be combined with packedstore")
+
     def convert(self):
         # Convert minutes to seconds for assembly timeouts
         self.config['assemblytimeout'] *= 60
@@ -15,25 +15,34 @@
 import os
 
 #Functions for repeat masking:
-def num_unmers(seq, N):
-    #Calculate the number of unique nmers in seq
-    nmers = {}
-    for i in range(len(seq) - (N - 1)):
-        nmers[str(seq[i:i+N]).upper()] = True
-    return(len(nmers))
-
-
 def mask_seq(seq, mapper, W=15, N=3):
     #Replace simple repeats with 'n' characters
-    #This masks a window if the number of unique Nmers is <
+    #This masks a window if the number of unique Nmers is < 7. The Nmer counts
+    # are updated as the window slides along the sequence, so this runs in
+    # time linear in the length of seq.
     seq_copy = bytearray(seq)
-    i = 0
-    for i in range(len(seq) - (W - 1)):
-        if num_unmers(seq[i:i + W], N) < 7:
+    if mapper not in ('blat', 'bowtie2'):
+        return(seq_copy)
+    upper = str(seq).upper()
+    nmers = [upper[j:j + N] for j in range(len(seq) - (N - 1))]
+    counts = {}
+    masked = 0  # everything before this position has already been masked
+    for j in range(len(nmers)):
+        counts[nmers[j]] = counts.get(nmers[j], 0) + 1
+        # nmers[j] is the last Nmer in the window starting at i
+        i = j - (W - N)
+        if i < 0:
+            continue
+        if len(counts) < 7:
+            start = max(i, masked)
             if mapper == 'blat':
-                seq_copy[i:i + W] = seq[i:i + W].lower()
+                seq_copy[start:i + W] = str(seq[start:i + W]).lower()
             if mapper == 'bowtie2':
-                seq_copy[i:i + W] = 'n' * W
+                seq_copy[start:i + W] = 'n' * (i + W - start)
+            masked = i + W
+        counts[nmers[i]] -= 1
+        if counts[nmers[i]] == 0:
+            del counts[nmers[i]]
     return(seq_copy)
 
 
@@ -65,6 +74,43 @@ def writeTargetStats(finished_dir, sample, target, targetLength, status, iterati
     tstf.close()
 
 
+def link_file(src, dst):
+    """ Hard link src to dst, falling back to a symlink across file systems """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        os.symlink(src, dst)
+
+
+def file_sizes(folder):
+    """ {name: size} of the files in folder, synced to disk so the sizes still hold after a crash """
+    sizes = {}
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            f = open(path, 'rb')
+            os.fsync(f.fileno())
+            f.close()
+            sizes[name] = os.path.getsize(path)
+    return sizes
+
+
+def truncate_files(folder, sizes):
+    """ Cut the files in folder back to sizes (from file_sizes), files not in it are removed """
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if not os.path.isfile(path):
+            continue
+        if name in sizes:
+            f = open(path, 'r+b')
+            f.truncate(sizes[name])
+            f.close()
+        else:
+            os.remove(path)
+
+
 def keyfunction(sra):
     if sra:
         return lambda x: x.split()[0][:-1]
@@ -0,0 +1,236 @@
+# Copyright 2013, Institute for Bioninformatics and Evolutionary Studies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import glob
+import time
+import json
+import errno
+import fcntl
+import struct
+import shutil
+import hashlib
+from ARC import logger
+from ARC import exceptions
+from ARC import read_index
+
+
+class IndexCache:
+    """
+    A directory of read indexes shared between ARC runs. Indexes are stored
+    under a key built from the path, size and mtime of the indexed files (and
+    optionally a checksum of their contents), so any run or sample pointing
+    at the same reads reuses the same index. Builds and evictions are guarded
+    with flock so that several ARC runs can share one cache.
+    """
+
+    def __init__(self, cache_dir, max_size=0, checksum=False):
+        self.cache_dir = cache_dir
+        # max_size is in GB, 0 means the cache is never pruned
+        self.max_size = int(max_size * 1073741824)
+        self.checksum = checksum
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    raise exceptions.FatalError(
+                        "Error creating index cache %s: %s" % (cache_dir, exc))
+
+    def describe(self, files, format, sra):
+        """ The properties of the inputs which identify an index """
+        desc = {'magic': read_index.MAGIC, 'format': format, 'sra': sra, 'files': []}
+        for f in files:
+            st = os.stat(f)
+            entry = {'path': os.path.realpath(f), 'size': st.st_size, 'mtime': st.st_mtime}
+            if self.checksum:
+                entry['md5'] = self.md5(f)
+            desc['files'].append(entry)
+        return desc
+
+    def md5(self, filename):
+        h = hashlib.md5()
+        inf = open(filename, 'rb')
+        while True:
+            buf = inf.read(4194304)
+            if not buf:
+                break
+            h.update(buf)
+        inf.close()
+        return h.hexdigest()
+
+    def key(self, desc):
+        return hashlib.md5(json.dumps(desc, sort_keys=True)).hexdigest()
+
+    def valid(self, key, desc):
+        """ Check that a cached index exists, is complete and matches desc """
+        index_file = os.path.join(self.cache_dir, key + '.idx')
+        meta_file = os.path.join(self.cache_dir, key + '.meta')
+        if not (os.path.exists(index_file) and os.path.exists(meta_file)):
+            return False
+        try:
+            meta = json.load(open(meta_file))
+            inf = open(index_file, 'rb')
+            magic, nfiles, nrecords = read_index.HEADER.unpack(inf.read(read_index.HEADER.size))
+            inf.close()
+        except (IOError, ValueError, struct.error):
+            return False
+        expected = read_index.HEADER.size + nrecords * (
+            read_index.KEY_SIZE + read_index.ORDINAL.size + read_index.LOCATION.size * nfiles)
+        return (meta['desc'] == json.loads(json.dumps(desc)) and magic == read_index.MAGIC and
+                nfiles == len(desc['files']) and meta['nrecords'] == nrecords and
+                os.path.getsize(index_file) == expected)
+
+    def lock(self, key):
+        """
+        Take the lock of a key. evict() removes the lock file of an entry it
+        drops, so the lock only counts if the file it was taken on is still
+        the one at the path, otherwise try again on the new file.
+        """
+        path = os.path.join(self.cache_dir, key + '.lock')
+        while True:
+            lockf = open(path, 'a')
+            fcntl.flock(lockf, fcntl.LOCK_EX)
+            try:
+                if os.fstat(lockf.fileno()).st_ino == os.stat(path).st_ino:
+                    return lockf
+            except OSError:
+                pass
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+            lockf.close()
+
+    def partial_files(self, key):
+        """ The temporary files a build of key leaves in the cache until it completes """
+        return (glob.glob(os.path.join(self.cache_dir, key + '.idx.tmp*')) +
+                glob.glob(os.path.join(self.cache_dir, key + '.meta.tmp')))
+
+    def fetch(self, index_file, files, format, sra):
+        """
+        Place an index for files at index_file, building it in the cache if
+        there isn't a valid copy already. Returns (nrecords, cached, key).
+        """
+        desc = self.describe(files, format, sra)
+        key = self.key(desc)
+        cached_file = os.path.join(self.cache_dir, key + '.idx')
+        meta_file = os.path.join(self.cache_dir, key + '.meta')
+        # Hold the lock for this key while building so concurrent runs wait
+        # for the index instead of building it twice.
+        lockf = self.lock(key)
+        try:
+            cached = self.valid(key, desc)
+            if not cached:
+                # Including what an interrupted build of this key left
+                for f in [cached_file, meta_file] + self.partial_files(key):
+                    if os.path.exists(f):
+                        os.unlink(f)
+                nrecords = read_index.build_index(cached_file, files, format, sra)
+                outf = open(meta_file + '.tmp', 'w')
+                json.dump({'desc': desc, 'nrecords': nrecords}, outf)
+                outf.close()
+                os.rename(meta_file + '.tmp', meta_file)
+            else:
+                nrecords = json.load(open(meta_file))['nrecords']
+            # Mark the entry as recently used for eviction
+            os.utime(cached_file, None)
+            # A hard link keeps the index usable by this run even if it is
+            # evicted from the cache later on. A cache on another file system
+            # can't be linked to, and a symlink would dangle after an
+            # eviction, so the index is copied instead.
+            if os.path.lexists(index_file):
+                os.unlink(index_file)
+            try:
+                os.link(cached_file, index_file)
+            except OSError:
+                shutil.copyfile(cached_file, index_file + '.tmp')
+                os.rename(index_file + '.tmp', index_file)
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+            lockf.close()
+        return nrecords, cached, key
+
+    def clean(self):
+        """
+        Remove the temporary files of interrupted builds. Keys which are
+        locked are being built right now and are left alone.
+        """
+        lockf = open(os.path.join(self.cache_dir, '.evict.lock'), 'a')
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            keys = set(os.path.basename(f).split('.')[0]
+                       for f in glob.glob(os.path.join(self.cache_dir, '*.tmp*')))
+            for key in keys:
+                keylock = open(os.path.join(self.cache_dir, key + '.lock'), 'a')
+                try:
+                    fcntl.flock(keylock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    keylock.close()
+                    continue
+                removed = self.partial_files(key)
+                if not os.path.exists(os.path.join(self.cache_dir, key + '.idx')):
+                    # Nothing was ever completed under this key
+                    removed.append(os.path.join(self.cache_dir, key + '.lock'))
+                for f in removed:
+                    if os.path.exists(f):
+                        os.unlink(f)
+                fcntl.flock(keylock, fcntl.LOCK_UN)
+                keylock.close()
+                logger.info("Removed an interrupted build of %s from the index cache." % key)
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+            lockf.close()
+
+    def evict(self, keep=()):
+        """
+        Remove the least recently used indexes until the cache fits in
+        max_size, except for the keys in keep (those fetched by this run).
+        Interrupted builds are cleaned up first.
+        """
+        self.clean()
+        if self.max_size <= 0:
+            return
+        lockf = open(os.path.join(self.cache_dir, '.evict.lock'), 'a')
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            entries = []
+            total = 0
+            for f in glob.glob(os.path.join(self.cache_dir, '*.idx')):
+                st = os.stat(f)
+                entries.append((st.st_mtime, st.st_size, f))
+                total += st.st_size
+            entries.sort()
+            for mtime, size, f in entries:
+                if total <= self.max_size:
+                    break
+                key = os.path.basename(f)[:-4]
+                if key in keep:
+                    continue
+                keylock = open(os.path.join(self.cache_dir, key + '.lock'), 'a')
+                try:
+                    # Skip entries that are being built or fetched right now
+                    fcntl.flock(keylock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    keylock.close()
+                    continue
+                # The lock file goes too, while it is still held (see lock())
+                for g in (f, os.path.join(self.cache_dir, key + '.meta'), os.path.join(self.cache_dir, key + '.lock')):
+                    if os.path.exists(g):
+                        os.unlink(g)
+                fcntl.flock(keylock, fcntl.LOCK_UN)
+                keylock.close()
+                total -= size
+                logger.info("Evicted %s from the index cache (last used %s)." % (
+                    f, time.ctime(mtime)))
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+            lockf.close()
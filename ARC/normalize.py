@@ -0,0 +1,116 @@
+# Copyright 2013, Institute for Bioninformatics and Evolutionary Studies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Digital normalization of a target's reads before assembly. Reads are
+# streamed once and a read (or pair) is dropped when the median abundance of
+# its k-mers among the reads kept so far has already reached the coverage
+# cutoff, so over-represented regions are thinned down to about that
+# coverage while low coverage regions keep every read. k-mer abundances are
+# kept in a count-min sketch of fixed size, which can over-count but never
+# under-counts.
+
+import string
+from array import array
+
+SKETCH_DEPTH = 4
+MAX_COUNT = 65535
+COMPLEMENT = string.maketrans('ACGT', 'TGCA')
+
+
+class CountMinSketch:
+    """
+    SKETCH_DEPTH (4) rows of saturating 16 bit counters. A k-mer is counted
+    in one slot per row, picked by double hashing, and its estimate is the
+    smallest of those counters. The width is the largest power of two that
+    fits in cells. Both methods work on all the k-mers of a read at once and
+    the rows are unrolled, as this is the inner loop of normalization.
+    """
+
+    def __init__(self, cells):
+        width = 1024
+        while width * 2 * SKETCH_DEPTH <= cells:
+            width *= 2
+        self.mask = width - 1
+        self.rows = [array('H', [0]) * width for i in xrange(SKETCH_DEPTH)]
+
+    def estimates(self, kmers):
+        """ Returns (slots, counts) for a list of k-mers """
+        mask = self.mask
+        r0, r1, r2, r3 = self.rows
+        slots = []
+        counts = []
+        for kmer in kmers:
+            h1 = hash(kmer)
+            h2 = hash(kmer[::-1]) | 1
+            s = (h1 & mask, (h1 + h2) & mask, (h1 + 2 * h2) & mask, (h1 + 3 * h2) & mask)
+            slots.append(s)
+            counts.append(min(r0[s[0]], r1[s[1]], r2[s[2]], r3[s[3]]))
+        return slots, counts
+
+    def add(self, slots):
+        r0, r1, r2, r3 = self.rows
+        for a, b, c, d in slots:
+            if r0[a] < MAX_COUNT:
+                r0[a] += 1
+            if r1[b] < MAX_COUNT:
+                r1[b] += 1
+            if r2[c] < MAX_COUNT:
+                r2[c] += 1
+            if r3[d] < MAX_COUNT:
+                r3[d] += 1
+
+
+class Normalizer:
+    """
+    Decides which reads to keep, reads have to be offered in a fixed order
+    for the result to be reproducible. memory is the size of the sketch in
+    MB, it is sized down for inputs with fewer bases than that.
+    """
+
+    def __init__(self, coverage, ksize, memory, nbases=None):
+        self.coverage = coverage
+        self.ksize = ksize
+        cells = int(memory * 1048576) / 2
+        if nbases is not None:
+            cells = min(cells, max(65536, nbases * 2))
+        self.sketch = CountMinSketch(cells)
+        self.kept = 0
+        self.dropped = 0
+
+    def kmers(self, seq):
+        """ The canonical (smaller of the two strands) k-mers of seq """
+        k = self.ksize
+        seq = seq.upper()
+        rc = seq.translate(COMPLEMENT)[::-1]
+        n = len(seq)
+        return [min(seq[i:i + k], rc[n - i - k:n - i]) for i in xrange(n - k + 1)]
+
+    def keep(self, seqs):
+        """
+        Take the sequences of a read or pair, return True and count their
+        k-mers if they should be kept. Mates are judged together so pairs
+        stay intact. Reads shorter than the k-mer size are always kept.
+        """
+        kmers = []
+        for seq in seqs:
+            kmers.extend(self.kmers(seq))
+        if kmers:
+            slots, counts = self.sketch.estimates(kmers)
+            counts.sort()
+            if counts[len(counts) / 2] >= self.coverage:
+                self.dropped += 1
+                return False
+            self.sketch.add(slots)
+        self.kept += 1
+        return True
@@ -0,0 +1,205 @@
+# Copyright 2013, Institute for Bioninformatics and Evolutionary Studies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import fcntl
+
+# Bytes copied at a time when packing and unpacking entries
+CHUNK_SIZE = 1 << 20
+
+
+def container_path(working_dir, iteration):
+    return os.path.join(working_dir, 'I%03d.pack' % iteration)
+
+
+def scratch_dir(params):
+    """ Where packed targets are unpacked, scratchdir if it is set or the sample's working folder """
+    if params['scratchdir']:
+        return os.path.join(params['scratchdir'], os.path.basename(params['working_dir']))
+    return os.path.join(params['working_dir'], 'scratch')
+
+
+def copy(inf, outf, length=None):
+    """ Copy inf to outf (at most length bytes) in chunks, returns the number of bytes copied """
+    copied = 0
+    while length is None or copied < length:
+        size = CHUNK_SIZE if length is None else min(CHUNK_SIZE, length - copied)
+        data = inf.read(size)
+        if not data:
+            break
+        outf.write(data)
+        copied += len(data)
+    return copied
+
+
+class Entry:
+    """
+    A read-only file over length bytes of the container starting at offset,
+    reading never goes past the end of the entry.
+    """
+
+    def __init__(self, path, offset, length):
+        self.inf = open(path, 'rb')
+        self.inf.seek(offset)
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.inf.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        if size == 0:
+            return ''
+        line = self.inf.readline(size)
+        self.remaining -= len(line)
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.inf.close()
+
+
+class PackedStore:
+    """
+    The files of every target of one sample and iteration (reads, assembled
+    contigs, finished status) appended to a single container file instead of
+    one directory per target. Entries are listed in a tab separated table
+    next to the container (target, name, offset, length), a later entry
+    replaces an earlier one with the same target and name. Any number of
+    processes can append at the same time, writes and table reads are
+    guarded with flock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.table_path = path + '.tab'
+        self.lock_path = path + '.lock'
+        self.table = None
+
+    def lock(self, operation):
+        lockf = open(self.lock_path, 'a')
+        fcntl.flock(lockf, operation)
+        return lockf
+
+    def unlock(self, lockf):
+        fcntl.flock(lockf, fcntl.LOCK_UN)
+        lockf.close()
+
+    def put(self, target, files):
+        """
+        Append a list of (name, file object) for target, each file is copied
+        in chunks of CHUNK_SIZE. The table lines are written after all of the
+        data, so nobody sees a partial entry, and in the order given, so a
+        status file listed last marks the rest as complete.
+        """
+        lockf = self.lock(fcntl.LOCK_EX)
+        try:
+            outf = open(self.path, 'ab')
+            outf.seek(0, 2)
+            offset = outf.tell()
+            lines = []
+            for name, inf in files:
+                length = copy(inf, outf)
+                lines.append('\t'.join([target, name, str(offset), str(length)]) + '\n')
+                offset += length
+            outf.close()
+            tabf = open(self.table_path, 'a')
+            tabf.write(''.join(lines))
+            tabf.close()
+        finally:
+            self.unlock(lockf)
+        self.table = None
+
+    def load(self):
+        """ (Re)read the table, returns {target: {name: (offset, length)}} """
+        table = {}
+        if os.path.exists(self.table_path):
+            lockf = self.lock(fcntl.LOCK_SH)
+            try:
+                for l in open(self.table_path, 'r'):
+                    target, name, offset, length = l.rstrip('\n').split('\t')
+                    table.setdefault(target, {})[name] = (int(offset), int(length))
+            finally:
+                self.unlock(lockf)
+        self.table = table
+        return table
+
+    def names(self, target):
+        if self.table is None:
+            self.load()
+        return self.table.get(target, {}).keys()
+
+    def has(self, target, name):
+        return name in self.names(target)
+
+    def get(self, target, name):
+        """ The data of an entry, or None if there isn't one """
+        inf = self.open(target, name)
+        if inf is None:
+            return None
+        data = inf.read()
+        inf.close()
+        return data
+
+    def open(self, target, name):
+        """ A file-like Entry reading an entry from the container, or None """
+        if not self.has(target, name):
+            return None
+        offset, length = self.table[target][name]
+        return Entry(self.path, offset, length)
+
+    def materialize(self, target, dest_dir, names=None):
+        """ Write the entries of target (or only those in names) as files under dest_dir """
+        for name in self.names(target):
+            if names is not None and name not in names:
+                continue
+            path = os.path.join(dest_dir, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            inf = self.open(target, name)
+            outf = open(path, 'wb')
+            copy(inf, outf)
+            outf.close()
+            inf.close()
+
+    def pack(self, target, src_dir, names):
+        """ Store the files in names which exist under src_dir as entries of target """
+        files = []
+        for name in names:
+            path = os.path.join(src_dir, name)
+            if os.path.exists(path):
+                files.append((name, open(path, 'rb')))
+        try:
+            self.put(target, files)
+        finally:
+            for name, inf in files:
+                inf.close()
+
+    def remove(self):
+        for f in (self.path, self.table_path, self.lock_path):
+            if os.path.exists(f):
+                os.remove(f)
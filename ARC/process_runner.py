@@ -23,10 +23,11 @@ import ARC.runners
 
 
 class ProcessRunner(Process):
-    def __init__(self, proc, q, status, stats, ppid):
+    def __init__(self, proc, q, events, status, stats, ppid):
         super(ProcessRunner, self).__init__()
         self.proc = proc
         self.q = q
+        self.events = events
         self.status = status
         self.stats = stats
         self.ppid = ppid
@@ -35,35 +36,43 @@ class ProcessRunner(Process):
         # Block until there is an item on the queue
         item = self.q.get()
 
-        # Run the job
-        self.running()
-        job = getattr(ARC.runners, item['runner'])(item['params'])
-        logger.debug("[%s] Processing: %s" % (self.name, job.message()))
-        job.queue(self.q)
-        job.runner()
+        status = 'failed'
+        try:
+            # Run the job
+            self.events.put(('started', item['task']))
+            self.running()
+            job = getattr(ARC.runners, item['runner'])(item['params'])
+            logger.debug("[%s] Processing: %s" % (self.name, job.message()))
+            job.queue(self.events, item['task'])
+            job.runner()
 
-        # Update stats
-        self.update_jobstats(item['runner'])
+            # Update stats
+            self.update_jobstats(item['runner'])
 
-        # Clean up
-        # job.clean()
-        del job
-        job = None
-        del item
-        item = None
-
-        # Notify that the task has been completed
-        self.q.task_done()
+            # Clean up
+            # job.clean()
+            del job
+            job = None
+            status = 'ok'
+            self.update_runstats()
+        except exceptions.RerunnableError:
+            status = 'rerun'
+            self.update_runstats(1)
+            raise
+        finally:
+            # Notify that the task has been completed. This goes on the same
+            # queue after any jobs the task submitted, so the scheduler sees
+            # those first.
+            self.events.put(('job_done', item['task'], status))
+            self.q.task_done()
 
     def run(self):
         while True:
             try:
                 self.waiting()
                 self.launch()
-                self.update_runstats()
             except exceptions.RerunnableError as e:
                 logger.warn("[%s] A job needs to be rerun: %s" % (self.name, e))
-                self.update_runstats(1)
             except exceptions.FatalError as e:
                 logger.error("[%s] A fatal error occurred: %s" % (self.name, e))
                 os.kill(self.ppid, signal.SIGINT)
@@ -92,7 +101,7 @@ class ProcessRunner(Process):
             self.stats[2] += 1
         elif jobtype == "Assembler":
             self.stats[3] += 1
-        elif jobtype == "AssemblyChecker":
-            self.stats[4] += 1
         elif jobtype == "Finisher":
+            self.stats[4] += 1
+        elif jobtype == "Splitter":
             self.stats[5] += 1
@@ -0,0 +1,353 @@
+# Copyright 2013, Institute for Bioninformatics and Evolutionary Studies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import mmap
+import heapq
+import struct
+import hashlib
+from array import array
+from bisect import bisect_left
+from itertools import izip_longest
+from ARC import exceptions
+from ARC.functions import keyfunction
+from ARC.bgzf import open_reads, BgzfReader
+
+# A compact read index which replaces SeqIO.index_db for ARC's read files.
+#
+# An index covers either a single SE file, or a PE1/PE2 pair of files in which
+# case both mates are stored in a single record. The file layout is:
+#
+#    header:   magic, number of files, number of records
+#    keys:     nrecords sorted KEY_SIZE byte hashes of the read keys
+#    ordinals: the ordinal of the record for each key, in the same order
+#    records:  nrecords x nfiles (offset, length) pairs, in file order.
+#              Offsets are BGZF virtual offsets for compressed files.
+#
+# The ordinal of a read (or pair) is its position in the read files, so
+# visiting reads in ordinal order only ever reads forward through the files.
+
+MAGIC = 'ARCIDX02'
+HEADER = struct.Struct('<8sIQ')
+KEY_SIZE = 12
+# Big endian so that records with the same key sort in file order
+ORDINAL = struct.Struct('>I')
+LOCATION = struct.Struct('<QI')
+# Gaps between records up to this size are read through rather than seeked
+SKIP_SIZE = 65536
+RUN_SIZE = 2000000
+# Indexes larger than this get a table of where each 2 byte key prefix starts,
+# which cuts the binary search in ordinal() down to a small bucket.
+BUCKET_MIN = 1048576
+
+
+def hash_key(key):
+    return hashlib.md5(key).digest()[:KEY_SIZE]
+
+
+def scan_records(handle, format):
+    """
+    Iterate over a FASTA or FASTQ file, yielding (title, offset, length) for
+    every record without parsing the sequences. Offsets come from tell() so
+    that they are virtual offsets for BGZF files, lengths are always in
+    uncompressed bytes. Multi-line FASTA and FASTQ records are supported.
+    """
+    if format == 'fasta':
+        start = handle.tell()
+        line = handle.readline()
+        while line and line[0] != '>':
+            start = handle.tell()
+            line = handle.readline()
+        while line:
+            title = line[1:].rstrip()
+            length = len(line)
+            pos = handle.tell()
+            line = handle.readline()
+            while line and line[0] != '>':
+                length += len(line)
+                pos = handle.tell()
+                line = handle.readline()
+            yield title, start, length
+            start = pos
+    elif format == 'fastq':
+        start = handle.tell()
+        line = handle.readline()
+        while line:
+            if line[0] != '@':
+                if line.strip() == '':
+                    start = handle.tell()
+                    line = handle.readline()
+                    continue
+                raise exceptions.FatalError(
+                    "Error, expected a FASTQ record to start with '@': %s" % line.strip())
+            title = line[1:].rstrip()
+            length = len(line)
+            seqlen = 0
+            line = handle.readline()
+            while line and line[0] != '+':
+                seqlen += len(line.strip())
+                length += len(line)
+                line = handle.readline()
+            if not line:
+                raise exceptions.FatalError(
+                    "Error, truncated FASTQ record: %s" % title)
+            length += len(line)
+            quallen = 0
+            while quallen < seqlen:
+                line = handle.readline()
+                if not line:
+                    raise exceptions.FatalError(
+                        "Error, truncated FASTQ record: %s" % title)
+                quallen += len(line.strip())
+                length += len(line)
+            yield title, start, length
+            start = handle.tell()
+            line = handle.readline()
+    else:
+        raise exceptions.FatalError("Error, unknown read format %s" % format)
+
+
+def _write_run(entries, filename):
+    entries.sort()
+    outf = open(filename, 'wb')
+    outf.write(''.join(entries))
+    outf.close()
+
+
+def _read_run(filename, size):
+    inf = open(filename, 'rb')
+    while True:
+        entry = inf.read(size)
+        if not entry:
+            break
+        yield entry
+    inf.close()
+
+
+def build_index(index_file, files, format, sra):
+    """
+    Build an index for one file (SE) or a pair of files (PE1, PE2) and write
+    it to index_file. Keys are sorted with an external merge sort so that
+    memory use is bounded for very large read files. The index is written to
+    a temporary name and renamed into place when it is complete. Returns the
+    number of records indexed.
+    """
+    key_function = keyfunction(sra)
+    entry_size = KEY_SIZE + ORDINAL.size
+    tmp_file = index_file + '.tmp'
+    handles = [open_reads(f) for f in files]
+    runs = []
+    entries = []
+    nrecords = 0
+    # Locations are spilled in file order while scanning, the keys and
+    # ordinals are appended once they have been sorted.
+    locf = open(tmp_file + '.loc', 'w+b')
+    try:
+        for records in izip_longest(*[scan_records(h, format) for h in handles]):
+            if None in records:
+                raise exceptions.FatalError(
+                    "The number of reads in %s and %s do not match, check "
+                    "the config for errors" % (files[0], files[1]))
+            key = key_function(records[0][0].split()[0])
+            for r in records[1:]:
+                if key_function(r[0].split()[0]) != key:
+                    raise exceptions.FatalError(
+                        "ReadID %s in %s does not match ReadID %s in %s, PE "
+                        "files must contain the same reads in the same order." % (
+                            records[0][0].split()[0], files[0], r[0].split()[0], files[1]))
+            entries.append(hash_key(key) + ORDINAL.pack(nrecords))
+            locf.write(''.join([LOCATION.pack(r[1], r[2]) for r in records]))
+            nrecords += 1
+            if len(entries) >= RUN_SIZE:
+                runs.append(tmp_file + '.%d' % len(runs))
+                _write_run(entries, runs[-1])
+                entries = []
+
+        if runs:
+            runs.append(tmp_file + '.%d' % len(runs))
+            _write_run(entries, runs[-1])
+            entries = heapq.merge(*[_read_run(r, entry_size) for r in runs])
+        else:
+            entries.sort()
+
+        outf = open(tmp_file, 'wb')
+        outf.write(HEADER.pack(MAGIC, len(files), nrecords))
+        # Keys are written directly, ordinals go to a spill file which is
+        # appended once all of the keys have been written.
+        ordf = open(tmp_file + '.ord', 'w+b')
+        for entry in entries:
+            outf.write(entry[:KEY_SIZE])
+            ordf.write(entry[KEY_SIZE:])
+        for spill in (ordf, locf):
+            spill.seek(0)
+            while True:
+                buf = spill.read(1048576)
+                if not buf:
+                    break
+                outf.write(buf)
+        ordf.close()
+        outf.close()
+        os.rename(tmp_file, index_file)
+    finally:
+        locf.close()
+        for h in handles:
+            h.close()
+        for f in runs + [tmp_file + '.loc', tmp_file + '.ord', tmp_file]:
+            if os.path.exists(f):
+                os.unlink(f)
+    return nrecords
+
+
+class _Keys:
+    """ Sequence view of the key table so that bisect can search the mmap """
+    def __init__(self, buf, start, n):
+        self.buf = buf
+        self.start = start
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        pos = self.start + i * KEY_SIZE
+        return self.buf[pos:pos + KEY_SIZE]
+
+
+class ReadIndex:
+    """
+    Read-only, memory-mapped view of an index written by build_index. Records
+    are returned as the raw text of the record in each of the indexed files.
+    Fetching records in ordinal order reads forward through the files,
+    skipping short gaps by reading through them instead of seeking.
+    """
+    def __init__(self, index_file, files):
+        self.index_file = index_file
+        inf = open(index_file, 'rb')
+        self.buf = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        inf.close()
+        magic, nfiles, self.nrecords = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or nfiles != len(files):
+            self.buf.close()
+            raise exceptions.FatalError(
+                "Error, %s is not a valid index for %s" % (index_file, ', '.join(files)))
+        self.keys = _Keys(self.buf, HEADER.size, self.nrecords)
+        self.ordinals = HEADER.size + KEY_SIZE * self.nrecords
+        self.locations = self.ordinals + ORDINAL.size * self.nrecords
+        self.record_size = LOCATION.size * nfiles
+        self.handles = [open_reads(f) for f in files]
+        # Where the next read of each plain text handle starts, None for BGZF
+        # handles which keep their own block cache.
+        self.positions = [None if isinstance(h, BgzfReader) else 0 for h in self.handles]
+        self.buckets = None
+        if self.nrecords >= BUCKET_MIN:
+            self.buckets = array('L', [0]) * 65537
+            lo = 0
+            for p in xrange(1, 65536):
+                lo = bisect_left(self.keys, struct.pack('>H', p), lo)
+                self.buckets[p] = lo
+            self.buckets[65536] = self.nrecords
+
+    def __len__(self):
+        return self.nrecords
+
+    def __contains__(self, key):
+        return self.ordinal(key) is not None
+
+    def ordinal(self, key):
+        """ Return the position of key in the index, or None """
+        h = hash_key(key)
+        if self.buckets is None:
+            lo, hi = 0, self.nrecords
+        else:
+            p = (ord(h[0]) << 8) | ord(h[1])
+            lo, hi = self.buckets[p], self.buckets[p + 1]
+        i = bisect_left(self.keys, h, lo, hi)
+        if i < hi and self.keys[i] == h:
+            return ORDINAL.unpack_from(self.buf, self.ordinals + i * ORDINAL.size)[0]
+        return None
+
+    def get_raw(self, ordinal):
+        """ Return a list with the raw text of the record in each file """
+        pos = self.locations + ordinal * self.record_size
+        records = []
+        for i, h in enumerate(self.handles):
+            offset, length = LOCATION.unpack_from(self.buf, pos)
+            position = self.positions[i]
+            if position is None:
+                h.seek(offset)
+            elif offset != position:
+                if position < offset <= position + SKIP_SIZE:
+                    h.read(offset - position)
+                else:
+                    h.seek(offset)
+            records.append(h.read(length))
+            if position is not None:
+                self.positions[i] = offset + length
+            pos += LOCATION.size
+        return records
+
+    def get(self, key, default=None):
+        i = self.ordinal(key)
+        if i is None:
+            return default
+        return self.get_raw(i)
+
+    def close(self):
+        for h in self.handles:
+            h.close()
+        self.handles = []
+        self.buf.close()
+
+
+class SampleIndex:
+    """
+    The PE and/or SE read indexes of a sample, presented as a single range of
+    read ordinals: pairs take [0, nPE) and single reads [nPE, nPE + nSE).
+    A key present in both indexes resolves to the pair.
+    """
+    def __init__(self, working_dir, pe_files=None, se_file=None):
+        self.pe = self.se = None
+        self.npe = 0
+        if pe_files:
+            self.pe = ReadIndex(os.path.join(working_dir, 'PE.idx'), pe_files)
+            self.npe = len(self.pe)
+        if se_file:
+            self.se = ReadIndex(os.path.join(working_dir, 'SE.idx'), [se_file])
+
+    def __len__(self):
+        return self.npe + (len(self.se) if self.se is not None else 0)
+
+    def ordinal(self, key):
+        """ Return the sample-wide ordinal of key, or None """
+        if self.pe is not None:
+            i = self.pe.ordinal(key)
+            if i is not None:
+                return i
+        if self.se is not None:
+            i = self.se.ordinal(key)
+            if i is not None:
+                return self.npe + i
+        return None
+
+    def get_raw(self, ordinal):
+        """ Return (paired, records) with the raw text of the pair or single read """
+        if ordinal < self.npe:
+            return True, self.pe.get_raw(ordinal)
+        return False, self.se.get_raw(ordinal - self.npe)
+
+    def close(self):
+        for idx in (self.pe, self.se):
+            if idx is not None:
+                idx.close()
+        self.pe = self.se = None
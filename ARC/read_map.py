@@ -0,0 +1,274 @@
+# Copyright 2013, Institute for Bioninformatics and Evolutionary Studies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import heapq
+import struct
+from array import array
+from itertools import izip
+from ARC import exceptions
+from ARC.read_index import hash_key
+
+# Reads and targets are identified by integer ordinals rather than names:
+# read ordinals come from the sample's read indexes (see read_index.SampleIndex)
+# and target ordinals are the numbers in the safe target names ("t__000042").
+#
+# A finalized map can be saved for Splitter jobs as a header with the number
+# of offsets and reads and the byte size of an offset, followed by the two
+# arrays.
+
+HEADER = struct.Struct('<QQI')
+
+
+def wide_typecode():
+    """ The array typecode of a 64 bit unsigned integer, None if this build has none """
+    for code in ('L', 'Q'):
+        try:
+            if array(code).itemsize == 8:
+                return code
+        except ValueError:
+            pass
+    return None
+
+
+# 'L' is only 64 bit on LP64 platforms (and Python 2 has no 'Q'). Offsets can't
+# outgrow the address space, so on other builds a 32 bit 'L' still holds them.
+WIDE = wide_typecode()
+OFFSET = WIDE or 'L'
+
+
+def target_ordinal(safe_target):
+    return int(safe_target[3:])
+
+
+def safe_target_name(ordinal):
+    return "t__%06d" % ordinal
+
+
+def read_hash(key):
+    """
+    A 32 bit hash of a read key used for subsampling. Both mates of a pair
+    share a key, so pairs are always kept or dropped together.
+    """
+    return struct.unpack_from('<I', hash_key(key), 4)[0]
+
+
+class ReadMap:
+    """
+    A compact record of which reads mapped to which targets. Hits are
+    appended to a pair of integer arrays while the mapping is parsed, then
+    finalize() groups them by target with a counting sort and removes
+    duplicate hits, leaving one array of read ordinals and an array of
+    offsets into it indexed by target ordinal.
+
+    With hashes=True a read_hash() is kept for every read as well, so that
+    the map can be downsampled after it is finalized.
+    """
+
+    def __init__(self, hashes=False):
+        self.hit_targets = array('I')
+        self.hit_reads = array('I')
+        self.hit_hashes = array('I') if hashes else None
+        self.offsets = array(OFFSET, [0])
+        self.reads = array('I')
+        self.hashes = None
+
+    def add(self, target, read, hash=0):
+        self.hit_targets.append(target)
+        self.hit_reads.append(read)
+        if self.hit_hashes is not None:
+            self.hit_hashes.append(hash)
+
+    def finalize(self):
+        ntargets = max(self.hit_targets) + 1 if self.hit_targets else 0
+        starts = array(OFFSET, [0]) * (ntargets + 1)
+        for t in self.hit_targets:
+            starts[t + 1] += 1
+        for t in xrange(ntargets):
+            starts[t + 1] += starts[t]
+        fill = array(OFFSET, starts)
+        grouped = array('I', [0]) * len(self.hit_reads)
+        for t, r in izip(self.hit_targets, self.hit_reads):
+            grouped[fill[t]] = r
+            fill[t] += 1
+        hashes = None
+        if self.hit_hashes is not None:
+            # Hashes only depend on the read, so they are grouped the same way
+            fill = array(OFFSET, starts)
+            hashes = array('I', [0]) * len(self.hit_hashes)
+            for t, h in izip(self.hit_targets, self.hit_hashes):
+                hashes[fill[t]] = h
+                fill[t] += 1
+            self.hit_hashes = array('I')
+        del fill
+        self.hit_targets = array('I')
+        self.hit_reads = array('I')
+        # Deduplicate each target's reads in place, the write position never
+        # passes the start of the group being read.
+        offsets = array(OFFSET, [0]) * (ntargets + 1)
+        pos = 0
+        for t in xrange(ntargets):
+            if starts[t + 1] > starts[t]:
+                if hashes is None:
+                    uniq = sorted(set(grouped[starts[t]:starts[t + 1]]))
+                else:
+                    pairs = sorted(set(izip(grouped[starts[t]:starts[t + 1]], hashes[starts[t]:starts[t + 1]])))
+                    uniq = [r for r, h in pairs]
+                    hashes[pos:pos + len(uniq)] = array('I', [h for r, h in pairs])
+                grouped[pos:pos + len(uniq)] = array('I', uniq)
+                pos += len(uniq)
+            offsets[t + 1] = pos
+        del grouped[pos:]
+        if hashes is not None:
+            del hashes[pos:]
+        self.reads = grouped
+        self.hashes = hashes
+        self.offsets = offsets
+
+    def downsample(self, fraction=1, cap=0):
+        """
+        Keep the reads whose hash falls in the lowest fraction of the hash
+        range, then at most cap reads (0 for no cap) per target, choosing the
+        ones with the smallest hashes. The selection only depends on the read
+        keys, so it is the same from run to run. Needs a finalized map built
+        with hashes=True, the hashes are dropped afterwards.
+        """
+        limit = int(fraction * 4294967296)
+        reads = array('I')
+        offsets = array(OFFSET, [0]) * len(self.offsets)
+        for t in xrange(len(self.offsets) - 1):
+            start, end = self.offsets[t], self.offsets[t + 1]
+            if end > start:
+                pairs = [(h, r) for r, h in izip(self.reads[start:end], self.hashes[start:end]) if h < limit]
+                if cap and len(pairs) > cap:
+                    pairs = heapq.nsmallest(cap, pairs)
+                reads.extend(sorted([r for h, r in pairs]))
+            offsets[t + 1] = len(reads)
+        self.reads = reads
+        self.offsets = offsets
+        self.hashes = None
+
+    def count(self, target):
+        """ The number of distinct reads which mapped to target """
+        if target + 1 >= len(self.offsets):
+            return 0
+        return self.offsets[target + 1] - self.offsets[target]
+
+    def __contains__(self, target):
+        return self.count(target) > 0
+
+    def targets(self):
+        """ Iterate over the ordinals of the targets with mapped reads """
+        for t in xrange(len(self.offsets) - 1):
+            if self.offsets[t + 1] > self.offsets[t]:
+                yield t
+
+    def get(self, target):
+        """ Return an array with the read ordinals mapped to target """
+        if target + 1 >= len(self.offsets):
+            return array('I')
+        return self.reads[self.offsets[target]:self.offsets[target + 1]]
+
+    def __len__(self):
+        return len(self.reads)
+
+    def with_reads(self, target_reads):
+        """ A map over the same targets holding the reads in {target: reads} instead """
+        read_map = ReadMap()
+        read_map.offsets = array(OFFSET, [0]) * len(self.offsets)
+        for t in xrange(len(self.offsets) - 1):
+            if t in target_reads:
+                read_map.reads.extend(target_reads[t])
+            read_map.offsets[t + 1] = len(read_map.reads)
+        return read_map
+
+    def save(self, filename):
+        """ Write a finalized map to filename """
+        outf = open(filename + '.tmp', 'wb')
+        outf.write(HEADER.pack(len(self.offsets), len(self.reads), self.offsets.itemsize))
+        self.offsets.tofile(outf)
+        self.reads.tofile(outf)
+        outf.close()
+        os.rename(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, filename, targets=None):
+        """ Read a map written by save(), keeping only the reads of targets if given """
+        read_map = cls()
+        inf = open(filename, 'rb')
+        noffsets, nreads, itemsize = HEADER.unpack(inf.read(HEADER.size))
+        offsets = array(OFFSET)
+        if itemsize != offsets.itemsize:
+            inf.close()
+            raise exceptions.FatalError("Read map %s has %s byte offsets, this build uses %s byte offsets"
+                                        % (filename, itemsize, offsets.itemsize))
+        offsets.fromfile(inf, noffsets)
+        if targets is None:
+            read_map.offsets = offsets
+            read_map.reads.fromfile(inf, nreads)
+        else:
+            start = inf.tell()
+            targets = set(targets)
+            read_map.offsets = array(OFFSET, [0]) * noffsets
+            pos = 0
+            for t in xrange(noffsets - 1):
+                n = offsets[t + 1] - offsets[t]
+                if n and t in targets:
+                    inf.seek(start + offsets[t] * read_map.reads.itemsize)
+                    read_map.reads.fromfile(inf, n)
+                    pos += n
+                read_map.offsets[t + 1] = pos
+        inf.close()
+        return read_map
+
+    def by_read(self):
+        """
+        Iterate over (read, targets) in read ordinal order, inverting the map
+        with a bucket sort on the high bits of the read ordinals. Each hit is
+        packed into a single 64 bit integer (read << 32 | target), held in a
+        list on builds without a 64 bit array type.
+        """
+        if not self.reads:
+            return
+        shift = max(0, max(self.reads).bit_length() - 16)
+        nbuckets = (max(self.reads) >> shift) + 1
+        starts = array(OFFSET, [0]) * (nbuckets + 1)
+        for r in self.reads:
+            starts[(r >> shift) + 1] += 1
+        for b in xrange(nbuckets):
+            starts[b + 1] += starts[b]
+        fill = array(OFFSET, starts)
+        if WIDE is not None:
+            hits = array(WIDE, [0]) * len(self.reads)
+        else:
+            hits = [0] * len(self.reads)
+        for t in self.targets():
+            for r in self.get(t):
+                b = r >> shift
+                hits[fill[b]] = (r << 32) | t
+                fill[b] += 1
+        del fill
+        for b in xrange(nbuckets):
+            read = None
+            targets = []
+            for hit in sorted(hits[starts[b]:starts[b + 1]]):
+                if hit >> 32 != read:
+                    if targets:
+                        yield read, targets
+                    read = hit >> 32
+                    targets = []
+                targets.append(hit & 0xFFFFFFFF)
+            if targets:
+                yield read, targets
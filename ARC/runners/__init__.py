@@ -15,5 +15,5 @@
 from base import Base
 from finisher import Finisher
 from assembler import Assembler
-from assembly_checker import AssemblyChecker
+from splitter import Splitter
 from mapper import Mapper
\ No newline at end of file
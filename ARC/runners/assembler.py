@@ -19,6 +19,7 @@ import signal
 from ARC import logger
 from ARC import exceptions
 from ARC.runners import Base
+from ARC.packed_store import PackedStore
 import traceback
 import sys
 
@@ -28,7 +29,13 @@ class Assembler(Base):
     This class represents assembly jobs and handles running assemblies.
     required params:
         assembler, sample, target, PE1 and PE2 and/or SE, target_dir
+    With packed_store set the target is unpacked from that container into
+    target_dir (a scratch folder) before the assembly, and the contigs and
+    finished status are packed back into it afterwards.
     """
+    # Files the Finisher reads from a finished assembly
+    contig_files = {'newbler': os.path.join('assembly', 'assembly', '454AllContigs.fna'),
+                    'spades': os.path.join('assembly', 'contigs.fasta')}
 
     def message(self):
         return 'Assembler for Sample: %s Target: %s' % (self.params['sample'], self.params['target'])
@@ -36,6 +43,24 @@ class Assembler(Base):
     def start(self):
         if not('assembler' in self.params):
             raise exceptions.FatalError("assembler not defined in params")
+        if 'packed_store' not in self.params:
+            self.run_assembly()
+            return
+        store = PackedStore(self.params['packed_store'])
+        safe_target = os.path.basename(self.params['target_dir'])
+        if os.path.exists(self.params['target_dir']):
+            os.system("rm -rf %s" % self.params['target_dir'])
+        os.makedirs(self.params['target_dir'])
+        try:
+            store.materialize(safe_target, self.params['target_dir'])
+            self.run_assembly()
+            # finished goes last, it marks the rest of the entries complete
+            store.pack(safe_target, self.params['target_dir'],
+                       [self.contig_files[self.params['assembler']], 'assembly.log', 'finished'])
+        finally:
+            os.system("rm -rf %s" % self.params['target_dir'])
+
+    def run_assembly(self):
         if self.params['map_against_reads'] and self.params['iteration'] == 1:
             self.RunMapAgainstReads()
         elif self.params['assembler'] == 'newbler':
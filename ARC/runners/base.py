@@ -39,11 +39,17 @@ class Base:
     def message(self):
         return 'Starting %s' % self.name
 
-    def queue(self, job_q):
-        self.job_q = job_q
-
-    def submit(self, job):
-        self.job_q.put(job)
+    def queue(self, events, task):
+        self.events = events
+        self.task = task
+
+    def submit(self, job, barrier=False):
+        """
+        Hand a job to the Spawn scheduler as a child of this one. A barrier
+        job only runs once this job and everything it started are done, with
+        barrier='sample' once nothing else of the sample is left.
+        """
+        self.events.put(('submit', self.task, job, barrier))
 
     @classmethod
     def to_job(obj, params):
@@ -61,9 +67,10 @@ class Base:
 
     def clean(self):
         del self.params
-        del self.job_q
+        del self.events
         self.params = None
-        self.job_q = None
+        self.events = None
+        self.task = None
 
     def start(self):
         pass
@@ -14,11 +14,15 @@
 
 import os
 from Bio import SeqIO
-from Bio.Seq import Seq
 from ARC import logger
 from ARC import exceptions
+from ARC import seqio
 from ARC.functions import *
 from ARC.runners import Base
+from ARC.packed_store import PackedStore, container_path, scratch_dir
+from ARC.read_map import safe_target_name
+from ARC.state import StateStore
+from ARC.target_table import TargetTable
 from collections import Counter
 import traceback
 import sys
@@ -81,85 +85,165 @@ class Finisher(Base):
         return 'Finisher for Sample: %s' % self.params['sample']
 
     def start(self):
+        self.state = StateStore(self.params['state_db'])
+        self.table = TargetTable.load(self.state, self.params['sample'])
+        try:
+            self.finish()
+        finally:
+            self.state.close()
+
+    def finish(self):
         sample = self.params['sample']
         logger.info("Sample: %s Starting finisher" % self.params['sample'])
         finished_dir = self.params['finished_dir']
-        sample_finished = False
         targets_written = 0
         iteration = self.params['iteration']
+        self.store = None
+        if self.params['packedstore']:
+            self.store = PackedStore(container_path(self.params['working_dir'], iteration))
 
         #Set up output for both finished and additional mapping outputs
         fin_outf = open(os.path.join(finished_dir, 'contigs.fasta'), 'a')
         remap_outf = open(os.path.join(self.params['working_dir'], 'I%03d' % self.params['iteration'] + '_contigs.fasta'), 'w')
 
-        #check whether the sample is globally finished
-        if self.params['iteration'] >= self.params['numcycles']:
-            sample_finished = True
-
-        #loop over the current set of targets_folders
-        for target_folder in self.params['targets']:
+        #loop over the targets not collected by a Finisher yet, that is this
+        # iteration's and with rollingrounds any left assembling before
+        jobs = self.state.open_jobs(sample)
+        collected = []
+        # Targets retired in this pass by status and in the order they were
+        # collected, they are retired in the table once per status after the loop
+        self.retiring = {}
+        self.retired = []
+        for job in jobs:
             #Extract target specific details:
             target_map_against_reads = False
-            safe_target = target_folder.split("/")[-1]  # get last element of path name
-            target = self.params['safe_targets'][safe_target]
-            cur_reads = self.params['readcounts'][target][iteration]  # note that this is a counter, so no key errors can occur
-            previous_reads = self.params['readcounts'][target][iteration - 1]
+            target_folder = os.path.join(self.params['working_dir'], safe_target_name(job.ordinal))
+            target = job.target
+            # Rules go by the target's own iteration
+            target_iteration = job.target_iteration
+            cur_reads = job.mapped
+            previous_reads = job.previous
 
             #Get finished assembly status:
-            with open(os.path.join(target_folder, 'finished'), 'r') as finishedf:
-                l = finishedf.readline().strip().split()[0]
+            finishedf = self.open_target_file(target_folder, 'finished')
+            if finishedf is None:
+                #Still being assembled, a later Finisher collects it
+                continue
+            collected.append(job)
+            l = finishedf.readline().strip().split()[0]
+            finishedf.close()
 
             logger.info("Sample: %s target: %s finishing target.." % (self.params['sample'], target))
-            logger.info("Sample: %s target: %s iteration: %s Assembly reports status: %s." % (sample, target, self.params['iteration'], l))
+            logger.info("Sample: %s target: %s iteration: %s Assembly reports status: %s." % (sample, target, target_iteration, l))
 
             if l in ('assembly_failed', 'map_against_reads'):
                 target_map_against_reads = True
 
-            if l == 'assembly_killed':
+            if l == 'no_reads':
+                #Subsampling left no reads to assemble for this target
+                self.retire(job, 'NoReads', 0, 0, 0)
+                if not self.params['keepassemblies'] and self.store is None:
+                    os.system("rm -rf %s" % target_folder)
+            elif l == 'assembly_killed':
                 #only write out the reads, assembly won't have contigs
-                self.write_target(target, target_folder, outf=fin_outf, finished=False, map_against_reads=False, killed=True)
-            elif sample_finished:  # everything goes into the final file/folders.
-                self.write_target(target, target_folder, outf=fin_outf, finished=True, )
-            elif target_map_against_reads and cur_reads > previous_reads and iteration < 3:
+                self.write_target(job, target_folder, outf=fin_outf, finished=False, map_against_reads=False, killed=True)
+            elif target_iteration >= self.params['numcycles']:  # everything goes into the final file/folders.
+                self.write_target(job, target_folder, outf=fin_outf, finished=True, )
+            elif target_map_against_reads and cur_reads > previous_reads and target_iteration < 3:
                 #Only map against reads if we have improvement in mapping and we haven't been mapping for multiple iterations
-                targets_written += self.write_target(target, target_folder, outf=remap_outf, finished=False, map_against_reads=True)
+                targets_written += self.write_target(job, target_folder, outf=remap_outf, finished=False, map_against_reads=True)
             else:
                 #Check read counts and retire target, or send it back for re-mapping depending on mapped reads
-                if iteration > 1 and cur_reads != 0 and previous_reads != 0:
+                if target_iteration > 1 and cur_reads != 0 and previous_reads != 0:
                     if cur_reads / previous_reads > self.params['max_incorporation']:
                         logger.info("Sample %s target %s hit a repetitive region, no more mapping will be done" % (self.params['sample'], target))
-                        self.write_target(target, target_folder, outf=fin_outf, finished=True, status='Repeat')
-                    elif cur_reads <= previous_reads and iteration > 2:
+                        self.write_target(job, target_folder, outf=fin_outf, finished=True, status='Repeat')
+                    elif cur_reads <= previous_reads and target_iteration > 2:
                         #Give the mapper a couple extra iterations in case the first mapping got a lot of reads which didn't assemble
                         logger.info("Sample %s target %s did not incorporate any more reads, no more mapping will be done" % (self.params['sample'], target))
-                        self.write_target(target, target_folder, outf=fin_outf, finished=True)
+                        self.write_target(job, target_folder, outf=fin_outf, finished=True)
                     else:
                         #nothing fancy is going on, just write the contigs out for remapping
-                        targets_written += self.write_target(target, target_folder, outf=remap_outf, finished=False)
+                        targets_written += self.write_target(job, target_folder, outf=remap_outf, finished=False)
                 else:
                     #nothing fancy is going on, just write the contigs out for remapping
-                    targets_written += self.write_target(target, target_folder, outf=remap_outf, finished=False)
+                    targets_written += self.write_target(job, target_folder, outf=remap_outf, finished=False)
 
         fin_outf.flush()
         remap_outf.flush()
         fin_outf.close()
         remap_outf.close()
 
+        # Targets written out or left without reads this iteration, they are
+        # saved before the next Mapper loads its table
+        for status, (ids, iterations, readcounts, contigs, contig_lengths) in self.retiring.iteritems():
+            self.table.retire(ids, status, iterations, readcounts, contigs, contig_lengths)
+        self.table.write_stats(self.params['finished_dir'], sample, self.retired)
+        self.table.save(self.state, sample, iteration)
+        self.state.finish_jobs(sample, collected)
+        assembling = len(jobs) - len(collected)
+
+        # With nothing left assembling the sample can be resumed from here,
+        # before the next Mapper adds to the finished files
+        reference = os.path.join(self.params['working_dir'], 'I%03d' % self.params['iteration'] + '_contigs.fasta')
+        if assembling == 0:
+            self.state.checkpoint(sample, iteration, reference, targets_written == 0, file_sizes(finished_dir))
+
         if targets_written > 0:
             # Build a new mapper and put it on the queue
             from ARC.runners import Mapper
             mapper_params = {}
             for k in self.params:
                 mapper_params[k] = self.params[k]
-            del mapper_params['targets']
-            mapper_params['reference'] = os.path.join(self.params['working_dir'], 'I%03d' % self.params['iteration'] + '_contigs.fasta')
+            mapper_params['reference'] = reference
             self.submit(Mapper.to_job(mapper_params))
             logger.info("Sample: %s Added new mapper to queue: iteration %s" % (self.params['sample'], self.params['iteration']))
 
+        elif assembling > 0:
+            # Only with rollingrounds, come back once the rest are done
+            logger.info("Sample: %s Mapper not added to queue, waiting for %s targets still being assembled." % (self.params['sample'], assembling))
+            finisher_params = {}
+            for k in self.params:
+                finisher_params[k] = self.params[k]
+            self.submit(Finisher.to_job(finisher_params), barrier='sample')
+
         else:
             logger.info("Sample: %s Mapper not added to queue. Work finished." % self.params['sample'])
-
-    def write_target(self, target, target_folder, outf, finished=False, map_against_reads=False, killed=False, status=None):
+            read_map_file = os.path.join(self.params['working_dir'], 'read_map.I%03d' % self.params['iteration'])
+            if os.path.exists(read_map_file):
+                os.remove(read_map_file)
+            #Remove the reads kept for targets which would have gone on
+            if not self.params['keepassemblies']:
+                for job in collected:
+                    target_folder = os.path.join(self.params['working_dir'], safe_target_name(job.ordinal))
+                    if os.path.exists(target_folder):
+                        os.system("rm -rf %s" % target_folder)
+                if self.store is not None:
+                    self.store.remove()
+                    os.system("rm -rf %s" % scratch_dir(self.params))
+
+        #The Splitters of this iteration were the last to read the previous container
+        if self.store is not None and not self.params['keepassemblies']:
+            PackedStore(container_path(self.params['working_dir'], iteration - 1)).remove()
+
+    def retire(self, job, status, readcount, contigs, contig_length):
+        """ Add a target to those retired with status at the end of this pass """
+        columns = self.retiring.setdefault(status, ([], [], [], [], []))
+        for column, value in zip(columns, (job.ordinal, job.target_iteration, readcount, contigs, contig_length)):
+            column.append(value)
+        self.retired.append(job.ordinal)
+
+    def open_target_file(self, target_folder, name):
+        """ Open one of a target's files from its folder or the packed store, None if it doesn't exist """
+        if self.store is not None:
+            return self.store.open(os.path.basename(target_folder), name)
+        path = os.path.join(target_folder, name)
+        if os.path.exists(path):
+            return open(path, 'r')
+        return None
+
+    def write_target(self, job, target_folder, outf, finished=False, map_against_reads=False, killed=False, status=None):
+        target = job.target
         # either map_against_reads was passed in, or
         # no contigs were assembled and target isn't finished, or
         # assembler crashed and no contig file was created
@@ -172,32 +256,36 @@ class Finisher(Base):
             status = 'Killed'
         if map_against_reads is False and killed is False:
             if self.params['assembler'] == 'newbler':
-                contigf = os.path.join(self.params['working_dir'], target_folder, "assembly", "assembly", "454AllContigs.fna")
+                contig_name = os.path.join("assembly", "assembly", "454AllContigs.fna")
             elif self.params['assembler'] == 'spades':
-                contigf = os.path.join(self.params['working_dir'], target_folder, "assembly", "contigs.fasta")
+                contig_name = os.path.join("assembly", "contigs.fasta")
+            contigf = os.path.join(self.params['working_dir'], target_folder, contig_name)
+            contig_inf = None
             #add support for a special output if this is the final assembly and newbler -cdna was used:
             if finished and self.params['cdna'] and self.params['assembler'] == 'newbler':
                 self.writeCDNAresults(target, target_folder, outf, contigf)
-            elif os.path.exists(contigf):
+            else:
+                contig_inf = self.open_target_file(target_folder, contig_name)
+            if contig_inf is not None:
                 i = 0
-                contig_inf = open(contigf, 'r')
-                for contig in SeqIO.parse(contig_inf, 'fasta'):
+                contig_outf = seqio.RecordWriter(outf, 'fasta')
+                for title, seq, qual in seqio.read_records(contig_inf, 'fasta'):
                     i += 1
                     if finished:
-                        contig.name = contig.id = self.params['sample'] + "_:_" + target + "_:_" + "Contig%03d" % i
+                        new_id = self.params['sample'] + "_:_" + target + "_:_" + "Contig%03d" % i
                     else:
-                        contig.name = contig.id = self.params['sample'] + "_:_" + target + "_:_" + "Unfinished%03d" % i
-                    contig = contig.upper()
+                        new_id = self.params['sample'] + "_:_" + target + "_:_" + "Unfinished%03d" % i
+                    seq = seq.upper()
                     #Only mask repeats on intermediate iterations.
                     if self.params['maskrepeats'] and not finished:
-                        #contig.seq = Seq(str(mask_seq(contig.seq.tostring(), self.params['mapper'])))
-                        contig.seq = Seq(str(mask_seq(str(contig.seq), self.params['mapper'])))
+                        seq = str(mask_seq(seq, self.params['mapper']))
                     #Bowtie2 crashes if a contig is all 'n' so only write it out if it isn't
-                    if len(contig.seq) != contig.seq.count('n'):
-                        SeqIO.write(contig, outf, "fasta")
-                        contig_length += len(contig.seq)
+                    if len(seq) != seq.count('n'):
+                        contig_outf.write(seqio.rename(title, new_id), seq)
+                        contig_length += len(seq)
+                contig_outf.flush()
                 contig_inf.close()
-                logger.info("Sample: %s target: %s iteration: %s Finished writing %s contigs " % (self.params['sample'], target, self.params['iteration'], i))
+                logger.info("Sample: %s target: %s iteration: %s Finished writing %s contigs " % (self.params['sample'], target, job.target_iteration, i))
                 num_contigs += i
                 #if i == 0 and finished is False and self.params['iteration'] < 2:
                 #    map_against_reads = True
@@ -206,94 +294,88 @@ class Finisher(Base):
             i = 0
             logger.info("Sample %s target %s: Writing reads as contigs." % (self.params['sample'], target))
             if 'PE1' in self.params and 'PE2' in self.params:
-                inf_PE1n = os.path.join(target_folder, "PE1." + self.params['format'])
-                inf_PE2n = os.path.join(target_folder, "PE2." + self.params['format'])
-                if os.path.exists(inf_PE1n) and os.path.exists(inf_PE2n):
-                    inf_PE1 = open(inf_PE1n, 'r')
-                    inf_PE2 = open(inf_PE2n, 'r')
-                    for r in SeqIO.parse(inf_PE1, self.params['format']):
+                inf_PE1 = self.open_target_file(target_folder, "PE1." + self.params['format'])
+                inf_PE2 = self.open_target_file(target_folder, "PE2." + self.params['format'])
+                if inf_PE1 is not None and inf_PE2 is not None:
+                    read_outf = seqio.RecordWriter(outf, 'fasta')
+                    for title, seq, qual in seqio.read_records(inf_PE1, self.params['format']):
                         i += 1
-                        r.name = r.id = self.params['sample'] + "_:_" + target + "_:_" + "Read%04d" % i
-                        SeqIO.write(r, outf, "fasta")
-                    for r in SeqIO.parse(inf_PE2, self.params['format']):
+                        read_outf.write(seqio.rename(title, self.params['sample'] + "_:_" + target + "_:_" + "Read%04d" % i), seq)
+                    for title, seq, qual in seqio.read_records(inf_PE2, self.params['format']):
                         i += 1
-                        r.name = r.id = self.params['sample'] + "_:_" + target + "_:_" + "Read%04d" % i
-                        SeqIO.write(r, outf, "fasta")
+                        read_outf.write(seqio.rename(title, self.params['sample'] + "_:_" + target + "_:_" + "Read%04d" % i), seq)
+                    read_outf.flush()
                     inf_PE1.close()
                     inf_PE2.close()
 
             if 'SE' in self.params:
-                inf_SEn = os.path.join(target_folder, "SE." + self.params['format'])
-                if os.path.exists(inf_SEn):
-                    inf_SE = open(inf_SEn, 'r')
-                for r in SeqIO.parse(inf_SE, self.params['format']):
-                    i += 1
-                    r.name = r.id = self.params['sample'] + "_:_" + target + "_:_" + "Read%04d" % i
-                    SeqIO.write(r, outf, "fasta")
-                inf_SE.close()
+                inf_SE = self.open_target_file(target_folder, "SE." + self.params['format'])
+                if inf_SE is not None:
+                    read_outf = seqio.RecordWriter(outf, 'fasta')
+                    for title, seq, qual in seqio.read_records(inf_SE, self.params['format']):
+                        i += 1
+                        read_outf.write(seqio.rename(title, self.params['sample'] + "_:_" + target + "_:_" + "Read%04d" % i), seq)
+                    read_outf.flush()
+                    inf_SE.close()
             num_contigs += i
 
         if finished or killed:
             #Write reads:
             if 'PE1' in self.params and 'PE2' in self.params:
-                inf_PE1n = os.path.join(target_folder, "PE1." + self.params['format'])
-                inf_PE2n = os.path.join(target_folder, "PE2." + self.params['format'])
-                if os.path.exists(inf_PE1n) and os.path.exists(inf_PE2n):
-                    inf_PE1 = open(inf_PE1n, 'r')
-                    inf_PE2 = open(inf_PE2n, 'r')
-
-                    outf_PE1 = open(os.path.join(self.params['finished_dir'], "PE1." + self.params['format']), 'a')
-                    outf_PE2 = open(os.path.join(self.params['finished_dir'], "PE2." + self.params['format']), 'a')
-
-                    for r in SeqIO.parse(inf_PE1, self.params['format']):
-                        r.description = self.params['sample'] + "_:_" + target
-                        SeqIO.write(r, outf_PE1, self.params['format'])
-                    for r in SeqIO.parse(inf_PE2, self.params['format']):
-                        r.description = self.params['sample'] + "_:_" + target
-                        SeqIO.write(r, outf_PE2, self.params['format'])
+                inf_PE1 = self.open_target_file(target_folder, "PE1." + self.params['format'])
+                inf_PE2 = self.open_target_file(target_folder, "PE2." + self.params['format'])
+                if inf_PE1 is not None and inf_PE2 is not None:
+
+                    outf_PE1 = seqio.RecordWriter(open(os.path.join(self.params['finished_dir'], "PE1." + self.params['format']), 'a'), self.params['format'])
+                    outf_PE2 = seqio.RecordWriter(open(os.path.join(self.params['finished_dir'], "PE2." + self.params['format']), 'a'), self.params['format'])
+
+                    description = self.params['sample'] + "_:_" + target
+                    for raw in seqio.read_raw(inf_PE1, self.params['format']):
+                        outf_PE1.write_text(seqio.retitle(raw, self.params['format'], seqio.describe(seqio.raw_title(raw), description)))
+                    for raw in seqio.read_raw(inf_PE2, self.params['format']):
+                        outf_PE2.write_text(seqio.retitle(raw, self.params['format'], seqio.describe(seqio.raw_title(raw), description)))
                     outf_PE1.close()
                     outf_PE2.close()
 
             if 'SE' in self.params:
-                inf_SEn = os.path.join(target_folder, "SE." + self.params['format'])
-                if os.path.exists(inf_SEn):
-                    inf_SE = open(inf_SEn, 'r')
-                    outf_SE = open(os.path.join(self.params['finished_dir'], "SE." + self.params['format']), 'a')
-                    for r in SeqIO.parse(inf_SE, self.params['format']):
-                        r.description = self.params['sample'] + "_:_" + target
-                        SeqIO.write(r, outf_SE, self.params['format'])
+                inf_SE = self.open_target_file(target_folder, "SE." + self.params['format'])
+                if inf_SE is not None:
+                    outf_SE = seqio.RecordWriter(open(os.path.join(self.params['finished_dir'], "SE." + self.params['format']), 'a'), self.params['format'])
+                    description = self.params['sample'] + "_:_" + target
+                    for raw in seqio.read_raw(inf_SE, self.params['format']):
+                        outf_SE.write_text(seqio.retitle(raw, self.params['format'], seqio.describe(seqio.raw_title(raw), description)))
                     outf_SE.close()
 
         # Finally a special case for situations where assembly of a target is killed, but contigs exist from
         # a previous assembly. Note that we only do this when not running in cDNA mode.
-        if killed and self.params['iteration'] > 1 and not self.params['cdna']:
+        if killed and job.iteration > 1 and not self.params['cdna']:
             #No contigs will be available, however contigs from the previous iteration will be present in
             # I00N_contigs.fasta, grab these and write them out instead
             logger.info("Sample: %s target: %s iteration: %s Writing contigs from previous iteration."
-                        % (self.params['sample'], target, self.params['iteration']))
-            contigf = os.path.join(self.params['working_dir'], 'I%03d' % (self.params['iteration'] - 1) + '_contigs.fasta')
+                        % (self.params['sample'], target, job.target_iteration))
+            contigf = os.path.join(self.params['working_dir'], 'I%03d' % (job.iteration - 1) + '_contigs.fasta')
             if os.path.exists(contigf):
-                for contig in SeqIO.parse(contigf, 'fasta'):
-                    if contig.id.split("_:_")[1] == target:
-                        contig.name = contig.id = contig.id.replace("Unfinished", "Contig")
-                        SeqIO.write(contig, outf, "fasta")
+                contig_inf = open(contigf, 'r')
+                contig_outf = seqio.RecordWriter(outf, 'fasta')
+                for title, seq, qual in seqio.read_records(contig_inf, 'fasta'):
+                    contig_id = seqio.record_id(title)
+                    if contig_id.split("_:_")[1] == target:
+                        contig_outf.write(seqio.rename(title, contig_id.replace("Unfinished", "Contig")), seq)
                         num_contigs += 1
-                        contig_length += len(contig.seq)
-        #Cleanup temporary assembly, and reads:
-        if not self.params['keepassemblies']:
-            os.system("rm -rf %s" % target_folder)
+                        contig_length += len(seq)
+                contig_outf.flush()
+                contig_inf.close()
+        #Cleanup temporary assembly, and reads. Targets which go on to the
+        # next iteration keep their reads for delta extraction.
+        if not self.params['keepassemblies'] and self.store is None:
+            if finished or killed:
+                os.system("rm -rf %s" % target_folder)
+            else:
+                os.system("rm -rf %s %s" % (os.path.join(target_folder, 'assembly'), os.path.join(target_folder, 'finished')))
 
-        #write out target stats:
+        #retire the target, its stats are written out with the others at the end:
         if finished or killed:
-            writeTargetStats(finished_dir=self.params['finished_dir'],
-                             sample=self.params['sample'],
-                             target=target,
-                             targetLength=self.params['summary_stats'][target]['targetLength'],
-                             status=status,
-                             iteration=self.params['iteration'],
-                             readcount=self.params['readcounts'][target][self.params['iteration']],
-                             num_contigs=num_contigs, contig_length=contig_length)
-            del self.params['summary_stats'][target]
+            self.retire(job, status, job.mapped, num_contigs, contig_length)
 
         #writeTargetStats(target, status, num_contigs, contig_length, self.params)
 
@@ -15,29 +15,30 @@
 import time
 import subprocess
 import os
-from collections import Counter
-from Bio import SeqIO
 from ARC import exceptions
 from ARC import logger
 #from ARC import Assembler
 from ARC.runners import Base
-from ARC.runners import Assembler
-from ARC.runners import AssemblyChecker
+from ARC.runners import Splitter
+from ARC.runners import Finisher
 from ARC.functions import *
+from ARC.read_index import SampleIndex
+from ARC.read_map import ReadMap, read_hash, safe_target_name
+from ARC.state import StateStore, Job
+from ARC.target_table import TargetTable
 import traceback
 import sys
-from random import randint
 
 
 class Mapper(Base):
     """
     This calss handles mapping jobs, as well as converting map results into a
-     text version of a dict.
+     ReadMap of read and target ordinals.
     required params:
         PE1, PE2, SE, format, mapper, numcycles, reference, sample, verbose,
-         working_dir
+         working_dir, state_db
     params added:
-        mapping_dict
+        read_map
     """
 
     def message(self):
@@ -46,15 +47,28 @@ class Mapper(Base):
     def start(self):
         if not('mapper' in self.params):
             raise exceptions.FatalError("mapper not defined in params")
-        if self.params['mapper'] == 'bowtie2':
-            logger.info("Sample: %s Running bowtie2." % self.params['sample'])
-            self.run_bowtie2()
-        if self.params['mapper'] == 'blat':
-            logger.info("Sample: %s Running blat." % self.params['sample'])
-            self.run_blat()
-        #Mapping is done, run splitreads:
-        logger.info("Sample: %s Running splitreads." % self.params['sample'])
-        self.splitreads()
+        # The read indexes assign the read ordinals used in the ReadMap and
+        # are used again to fetch the reads in splitreads.
+        pe_files = None
+        if 'PE1' in self.params and 'PE2' in self.params:
+            pe_files = [self.params['PE1'], self.params['PE2']]
+        self.index = SampleIndex(self.params['working_dir'], pe_files, self.params.get('SE'))
+        self._last_readid = self._last_ordinal = self._last_hash = None
+        self.state = StateStore(self.params['state_db'])
+        self.table = TargetTable.load(self.state, self.params['sample'])
+        try:
+            if self.params['mapper'] == 'bowtie2':
+                logger.info("Sample: %s Running bowtie2." % self.params['sample'])
+                self.run_bowtie2()
+            if self.params['mapper'] == 'blat':
+                logger.info("Sample: %s Running blat." % self.params['sample'])
+                self.run_blat()
+            #Mapping is done, run splitreads:
+            logger.info("Sample: %s Running splitreads." % self.params['sample'])
+            self.splitreads()
+        finally:
+            self.index.close()
+            self.state.close()
 
     def run_bowtie2(self):
         """
@@ -79,15 +93,7 @@ class Mapper(Base):
             if not os.path.exists(self.params['SE']):
                 raise exceptions.FatalError("SE file cannot be found.")
 
-        #Make idx directory
-        try:
-            working_dir = self.params['working_dir']
-            idx_dir = os.path.realpath(os.path.join(working_dir, 'idx'))
-            os.mkdir(idx_dir)
-        except Exception as exc:
-            txt = "Sample: %s Error creating working directory." % (
-                self.params['sample']) + '\n\t' + str(exc)
-            raise exceptions.FatalError(txt)
+        working_dir = self.params['working_dir']
 
         #Check whether to log to temporary file, or default to os.devnull
         if 'verbose' in self.params:
@@ -95,42 +101,61 @@ class Mapper(Base):
         else:
             out = open(os.devnull, 'w')
 
-        #Set up a path to the index
-        base = os.path.join(idx_dir, 'idx')
-
-        #Build index
-        #The idea is to map against the finished contigs and in-progress
-        # contigs, thereby ensuring that the -k parameter (or best map)
-        # are respected properly, and avoid the situation where reads which
-        # were mapped to a now finished target might later be mapped to a an
-        # in-progress target.
-        fin_outf = os.path.join(self.params['finished_dir'], 'contigs.fasta')
-        args = ['bowtie2-build', '-f']
-        if os.path.exists(fin_outf) and os.path.getsize(fin_outf) > 0:
-            args.append(','.join((fin_outf, self.params['reference'])))
-        else:
-            args.append(self.params['reference'])
-        args.append(base)
-        logger.info("Sample: %s Calling bowtie2-build." %
-                    self.params['sample'])
-        logger.info(" ".join(args))
-        try:
-            ret = subprocess.call(args, stdout=out, stderr=out)
-        except Exception as exc:
-            txt = ("Sample %s: Unhandeled error running bowtie2-build"
-                   % self.params['sample']) + '\n\t' + str(exc)
-            # make sure that out is closed before throwing exception
-            out.close()
-            raise exceptions.FatalError(txt)
+        n_bowtieprocs = int(round(max(float(self.params['nprocs'])/self.params['nsamples'], 1)))
 
-        if ret != 0:
-            out.close()
-            raise exceptions.FatalError(
-                "Sample: %s Error creating bowtie2 index, check log file."
-                % self.params['sample'])
+        #On the first iteration every sample maps against the same reference,
+        # so the index built once by App.setup is used (read-only) instead.
+        if self.params['iteration'] == 0 and 'initial_index' in self.params:
+            idx_dir = None
+            base = self.params['initial_index']
+            logger.info("Sample: %s Using shared bowtie2 index %s." %
+                        (self.params['sample'], base))
+        else:
+            #Make idx directory
+            try:
+                idx_dir = os.path.realpath(os.path.join(working_dir, 'idx'))
+                os.mkdir(idx_dir)
+            except Exception as exc:
+                txt = "Sample: %s Error creating working directory." % (
+                    self.params['sample']) + '\n\t' + str(exc)
+                out.close()
+                raise exceptions.FatalError(txt)
+
+            #Set up a path to the index
+            base = os.path.join(idx_dir, 'idx')
+
+            #Build index
+            #The idea is to map against the finished contigs and in-progress
+            # contigs, thereby ensuring that the -k parameter (or best map)
+            # are respected properly, and avoid the situation where reads which
+            # were mapped to a now finished target might later be mapped to a an
+            # in-progress target.
+            fin_outf = os.path.join(self.params['finished_dir'], 'contigs.fasta')
+            args = ['bowtie2-build', '-f', '--threads', str(n_bowtieprocs)]
+            if os.path.exists(fin_outf) and os.path.getsize(fin_outf) > 0:
+                args.append(','.join((fin_outf, self.params['reference'])))
+            else:
+                args.append(self.params['reference'])
+            args.append(base)
+            logger.info("Sample: %s Calling bowtie2-build." %
+                        self.params['sample'])
+            logger.info(" ".join(args))
+            try:
+                ret = subprocess.call(args, stdout=out, stderr=out)
+            except Exception as exc:
+                txt = ("Sample %s: Unhandeled error running bowtie2-build"
+                       % self.params['sample']) + '\n\t' + str(exc)
+                # make sure that out is closed before throwing exception
+                out.close()
+                raise exceptions.FatalError(txt)
+
+            if ret != 0:
+                out.close()
+                raise exceptions.FatalError(
+                    "Sample: %s Error creating bowtie2 index, check log file."
+                    % self.params['sample'])
 
         #Do bowtie2 mapping:
-        n_bowtieprocs = int(round(max(float(self.params['nprocs'])/len(self.params['Samples']), 1)))
         args = ['bowtie2', '-I', '0', '-X', '1500', '--no-unal']
 
         #Tune the sensitivity so that on the first iteration the mapper is
@@ -150,31 +175,59 @@ class Mapper(Base):
             args += ['-1', self.params['PE1'], '-2', self.params['PE2']]
         if 'SE' in self.params:
             args += ['-U', self.params['SE']]
-        args += ['-S', os.path.join(working_dir, 'mapping.sam')]
-        logger.info(
-            "Sample: %s Calling bowtie2 mapper" % self.params['sample'])
-        logger.info(" ".join(args))
+        if self.params['streammapping']:
+            #Read the SAM from bowtie2's stdout while it is mapping, nothing
+            # is written to disk.
+            logger.info(
+                "Sample: %s Calling bowtie2 mapper (streaming)" % self.params['sample'])
+            logger.info(" ".join(args))
+            try:
+                proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=out)
+            except Exception as exc:
+                out.close()
+                txt = ("Sample %s: Unhandeled error running bowtie2 mapping" %
+                       self.params['sample']) + '\n\t' + str(exc)
+                raise exceptions.FatalError(txt)
+            try:
+                self.params['read_map'] = self.parse_SAM(proc.stdout)
+            except:
+                proc.kill()
+                raise
+            finally:
+                proc.stdout.close()
+                ret = proc.wait()
+                out.close()
+            if ret != 0:
+                raise exceptions.FatalError(
+                    "Sample %s: Bowtie2 mapping returned an error, check log file."
+                    % self.params['sample'])
+        else:
+            args += ['-S', os.path.join(working_dir, 'mapping.sam')]
+            logger.info(
+                "Sample: %s Calling bowtie2 mapper" % self.params['sample'])
+            logger.info(" ".join(args))
+
+            try:
+                ret = subprocess.call(args, stdout=out, stderr=out)
+                out.close()
+            except Exception as exc:
+                txt = ("Sample %s: Unhandeled error running bowtie2 mapping" %
+                       self.params['sample']) + '\n\t' + str(exc)
+                raise exceptions.FatalError(txt)
 
-        try:
-            ret = subprocess.call(args, stdout=out, stderr=out)
             out.close()
-        except Exception as exc:
-            txt = ("Sample %s: Unhandeled error running bowtie2 mapping" %
-                   self.params['sample']) + '\n\t' + str(exc)
-            raise exceptions.FatalError(txt)
-
-        out.close()
-        if ret != 0:
-            raise exceptions.FatalError(
-                "Sample %s: Bowtie2 mapping returned an error, check log file."
-                % self.params['sample'])
+            if ret != 0:
+                raise exceptions.FatalError(
+                    "Sample %s: Bowtie2 mapping returned an error, check log file."
+                    % self.params['sample'])
 
-        #Extract the SAM to a dict
-        self.params['mapping_dict'] = self.SAM_to_dict(
-            os.path.join(working_dir, 'mapping.sam'))
-        #clean up intermediary files:
-        os.remove(os.path.join(working_dir, 'mapping.sam'))
-        os.system("rm -rf %s" % idx_dir)
+            #Extract the SAM to a dict
+            self.params['read_map'] = self.SAM_to_dict(
+                os.path.join(working_dir, 'mapping.sam'))
+            #clean up intermediary files:
+            os.remove(os.path.join(working_dir, 'mapping.sam'))
+        if idx_dir is not None:
+            os.system("rm -rf %s" % idx_dir)
 
     def run_blat(self):
         #Check for necessary params:
@@ -209,41 +262,96 @@ class Mapper(Base):
             allreads_outf.write(self.params['SE'] + '\n')
         allreads_outf.close()
 
+        #blat is single threaded, so the reference is split into shards which
+        # are mapped by concurrent blat processes. Every read is still
+        # compared to every target, so the union of the shard PSLs is the
+        # same as a single blat run.
+        nshards = self.params['blat_shards']
+        if nshards <= 0:
+            nshards = int(round(max(float(self.params['nprocs'])/self.params['nsamples'], 1)))
+        if nshards > 1:
+            references = self.shard_reference(nshards)
+        else:
+            references = [self.params['reference']]
+
         #Do blat mapping
-        args = ['blat', self.params['reference'], os.path.join(working_dir, 'reads.txt')]
-        if self.params['format'] == 'fastq':
-            args.append('-fastq')
-        if self.params['fastmap']:
-            args.append('-fastMap')
-        #Some new experimental params to increase specificity after the first iteration:
-        if self.params['maskrepeats']:
-            args.append("-mask=lower")
-        if self.params['iteration'] > 0 or not self.params['sloppymapping']:
-            args.append("-minIdentity=98")
-            args.append("-minScore=40")
-        args.append(os.path.join(working_dir, 'mapping.psl'))
-
-        logger.info("Sample: %s Calling blat mapper" % self.params['sample'])
-        logger.debug(" ".join(args))
+        procs = []
         try:
-            ret = subprocess.call(args, stdout=out, stderr=out)
-        except Exception as exc:
-            txt = ("Sample %s: Unhandeled error running blat mapping, check log file." % self.params['sample']) + '\n\t' + str(exc)
-            raise exceptions.FatalError(txt)
+            for i, reference in enumerate(references):
+                psl = os.path.join(working_dir, 'mapping.%d.psl' % i)
+                args = ['blat', reference, os.path.join(working_dir, 'reads.txt')]
+                if self.params['format'] == 'fastq':
+                    args.append('-fastq')
+                if self.params['fastmap']:
+                    args.append('-fastMap')
+                #Some new experimental params to increase specificity after the first iteration:
+                if self.params['maskrepeats']:
+                    args.append("-mask=lower")
+                if self.params['iteration'] > 0 or not self.params['sloppymapping']:
+                    args.append("-minIdentity=98")
+                    args.append("-minScore=40")
+                args.append(psl)
+
+                logger.info("Sample: %s Calling blat mapper" % self.params['sample'])
+                logger.debug(" ".join(args))
+                try:
+                    procs.append((subprocess.Popen(args, stdout=out, stderr=out), args, psl))
+                except Exception as exc:
+                    txt = ("Sample %s: Unhandeled error running blat mapping, check log file." % self.params['sample']) + '\n\t' + str(exc)
+                    raise exceptions.FatalError(txt)
+
+            #Extract each PSL into the ReadMap as soon as its shard finishes
+            read_map = self.new_read_map()
+            while procs:
+                for job in procs:
+                    proc, args, psl = job
+                    ret = proc.poll()
+                    if ret is None:
+                        continue
+                    procs.remove(job)
+                    if ret != 0:
+                        raise exceptions.FatalError('Sample: %s Error running blat mapping, check log file. \n\t %s' % (self.params['sample'], " ".join(args)))
+                    self.add_PSL(psl, read_map)
+                    os.remove(psl)
+                    break
+                else:
+                    time.sleep(0.5)
+            read_map.finalize()
+            self.params['read_map'] = read_map
         finally:
+            for proc, args, psl in procs:
+                if proc.poll() is None:
+                    proc.kill()
+                proc.wait()
+                if os.path.exists(psl):
+                    os.remove(psl)
             out.close()
-        if ret != 0:
-            raise exceptions.FatalError('Sample: %s Error running blat mapping, check log file. \n\t %s' % (self.params['sample'], " ".join(args)))
-
-        #Extract the PSL to a dict
-        self.params['mapping_dict'] = self.PSL_to_dict(os.path.join(working_dir, 'mapping.psl'))
-
-        #Cleanup
-        os.remove(os.path.join(working_dir, 'mapping.psl'))
-        out.close()
+            if nshards > 1:
+                os.system("rm -rf %s" % os.path.join(working_dir, 'blat_shards'))
+
+    def shard_reference(self, nshards):
+        """ Split the reference into nshards FASTA files of about the same number of bases """
+        shard_dir = os.path.join(self.params['working_dir'], 'blat_shards')
+        if os.path.exists(shard_dir):
+            os.system("rm -rf %s" % shard_dir)
+        os.mkdir(shard_dir)
+        references = [os.path.join(shard_dir, 'reference.%d.fasta' % i) for i in range(nshards)]
+        outfs = [open(f, 'w') for f in references]
+        sizes = [0] * nshards
+        shard = 0
+        for l in open(self.params['reference'], 'r'):
+            if l[0] == '>':
+                shard = sizes.index(min(sizes))
+            else:
+                sizes[shard] += len(l) - 1
+            outfs[shard].write(l)
+        for outf in outfs:
+            outf.close()
+        # A reference with fewer records than shards leaves some shards empty
+        return [f for f, size in zip(references, sizes) if size > 0]
 
     def SAM_to_dict(self, filename):
-        """ Read a SAM file to a mapping dict and return it """
+        """ Read a SAM file to a ReadMap and return it """
         #Check for necessary files:
         if os.path.exists(filename) is False:
             raise exceptions.FatalError("Missing SAM file")
@@ -253,9 +361,17 @@ class Mapper(Base):
             txt = "Failed to open SAM file %s" % filename
             txt += '\n\t' + str(exc)
             raise exceptions.FatalError(txt)
-        read_map = {}  # target:{read} dictionary of dictionaries
+        read_map = self.parse_SAM(inf)
+        inf.close()
+        return read_map
+
+    def parse_SAM(self, inf):
+        """ Read SAM lines from an open file or pipe to a ReadMap and return it """
+        read_map = self.new_read_map()
+        key_function = keyfunction(self.params['sra'])
         i = 0
         discards = 0
+        missing = 0
         startT = time.time()
         for l in inf:
             i += 1
@@ -263,7 +379,6 @@ class Mapper(Base):
                 l2 = l.strip().split()
                 if l2[2] == "*":  # skip unmapped
                     continue
-                readid = keyfunction(self.params['sra'])(l2[0])  # .split("/")[0]
                 target = l2[2]
                 # handle references built using assembled contigs:
                 if len(target.split("_:_")) == 3:
@@ -272,25 +387,58 @@ class Mapper(Base):
                     if status.startswith("Contig") or status.startswith("isogroup"):
                         discards += 1
                         continue
-                if target not in read_map:
-                    read_map[target] = {}
-                read_map[target][readid] = 1
+                read = self.read_ordinal(key_function(l2[0]))
+                if read is None:
+                    missing += 1
+                    continue
+                read_map.add(self.target_ordinal(target), read, self._last_hash)
+        read_map.finalize()
         # Report total time:
         logger.info("Sample: %s, Processed %s lines from SAM in %s seconds." % (self.params['sample'], i, time.time() - startT))
         if discards > 0:
             logger.info("%s out of %s reads mapped to finished contigs and were not recruited for assembly." % (discards, i))
+        if missing > 0:
+            logger.warn("Sample: %s %s mapped reads were not found in the read indexes." % (self.params['sample'], missing))
         return read_map
 
+    def read_ordinal(self, readid):
+        """ Ordinal of readid in the sample's read indexes, the last lookup is
+        cached because mates and multiple hits of a read are consecutive """
+        if readid != self._last_readid:
+            self._last_readid = readid
+            self._last_ordinal = self.index.ordinal(readid)
+            if self.downsampling():
+                self._last_hash = read_hash(readid)
+        return self._last_ordinal
+
+    def downsampling(self):
+        return self.params['subsample'] < 1 or self.params['max_reads_per_target'] > 0
+
+    def new_read_map(self):
+        """ A ReadMap which keeps read hashes when splitreads will downsample it """
+        return ReadMap(hashes=self.downsampling())
+
+    def target_ordinal(self, target):
+        return self.table.id(target)
+
     def PSL_to_dict(self, filename):
-        """Process a PSL file to the dict format """
+        """Process a PSL file to a ReadMap """
+        read_map = self.new_read_map()
+        self.add_PSL(filename, read_map)
+        read_map.finalize()
+        return read_map
+
+    def add_PSL(self, filename, read_map):
+        """Add the hits in a PSL file to read_map, which the caller finalizes """
         try:
             inf = open(filename, 'r')
         except Exception as inst:
             if type(inst) == IOError:
                 logger.error("Failed to open mapping dictionary %s." % filename)
             raise inst
-        read_map = {}
+        key_function = keyfunction(self.params['sra'])
         i = 0
+        missing = 0
         startT = time.time()
 
         psl_header = False
@@ -303,16 +451,20 @@ class Mapper(Base):
             if psl_header and i <= 5:
                 continue
             l2 = l.strip().split("\t")
-            readid = keyfunction(self.params['sra'])(l2[9])  # .split("/")[0]  # remove unique part of PE reads
+            readid = key_function(l2[9])  # .split("/")[0]  # remove unique part of PE reads
             target = l2[13]
             # handle references built using assembled contigs:
             if len(target.split("_:_")) > 1:
                 target = target.split("_:_")[1]
-            if target not in read_map:
-                read_map[target] = {}
-            read_map[target][readid] = 1
+            read = self.read_ordinal(readid)
+            if read is None:
+                missing += 1
+                continue
+            read_map.add(self.target_ordinal(target), read, self._last_hash)
+        inf.close()
         logger.info("Sample: %s, Processed %s lines from PSL in %s seconds." % (self.params['sample'], i, time.time() - startT))
-        return read_map
+        if missing > 0:
+            logger.warn("Sample: %s %s mapped reads were not found in the read indexes." % (self.params['sample'], missing))
 
     # def write_dict(self, filename, read_map):
     #     """
@@ -347,140 +499,142 @@ class Mapper(Base):
     #     return new_map
 
     def splitreads(self):
-        """ Split reads and then kick off assemblies once the reads are split for a target, use safe_targets for names"""
+        """ Split reads and then kick off assemblies once the reads are split for a target"""
         self.params['iteration'] += 1
-
-        # Write out statistics for any/all targets which failed to recruit reads:
-        for target in self.params['summary_stats'].keys():
-            # print "Target", target
-            if target not in self.params['mapping_dict']:
-                writeTargetStats(finished_dir=self.params['finished_dir'],
-                                 sample=self.params['sample'],
-                                 target=target,
-                                 targetLength=self.params['summary_stats'][target]['targetLength'],
-                                 status='NoReads',
-                                 iteration=self.params['iteration'],
-                                 readcount=0,
-                                 num_contigs=0, contig_length=0)
-                del self.params['summary_stats'][target]
-
-        checker_params = {}
-        for k in self.params:
-            checker_params[k] = self.params[k]
-        del checker_params['mapping_dict']
-        checker_params['targets'] = {}
         iteration = self.params['iteration']
-        # open previously created indexes:
-        if 'PE1' in self.params and 'PE2' in self.params:
-            idx_PE1 = SeqIO.index_db(os.path.join(self.params['working_dir'], "PE1.idx"), key_function=keyfunction(self.params['sra']))
-            idx_PE2 = SeqIO.index_db(os.path.join(self.params['working_dir'], "PE2.idx"), key_function=keyfunction(self.params['sra']))
-        if 'SE' in self.params:
-            idx_SE = SeqIO.index_db(os.path.join(self.params['working_dir'], "SE.idx"), key_function=keyfunction(self.params['sra']))
-        if 'readcounts' not in checker_params:
-            checker_params['readcounts'] = {}
-        # if 'contigcounts' not in checker_params:
-        #    checker_params['contigcounts'] = {}
-        statsf = open(os.path.join(self.params['finished_dir'], 'mapping_stats.tsv'), 'a')
-        for target in self.params['mapping_dict']:
-            startT = time.time()
-            # logger.info("Running splitreads for Sample: %s target: %s" % (self.params['sample'], target))
-            target_dir = os.path.join(self.params['working_dir'], self.params['safe_targets'][target])
-            if target not in checker_params['readcounts']:
-                checker_params['readcounts'][target] = Counter()
-            # if target not in checker_params['contigcounts']:
-            #    checker_params['contigcounts'] = Counter()
-            if os.path.exists(target_dir):
+        sample = self.params['sample']
+        read_map = self.params['read_map']
+        del self.params['read_map']
+
+        # Write out statistics for any/all targets which failed to recruit reads.
+        # With rollingrounds targets still being assembled weren't mapped.
+        table = self.table
+        assembling = set(job.ordinal for job in self.state.open_jobs(sample))
+        no_reads = [target_id for target_id in table.active() if target_id not in read_map and target_id not in assembling]
+        table.retire(no_reads, 'NoReads', iteration)
+        table.write_stats(self.params['finished_dir'], sample)
+        table.save(self.state, sample, iteration)
+        for target_id in no_reads:
+            # The folder may still hold the reads of the last iteration
+            target_dir = os.path.join(self.params['working_dir'], safe_target_name(target_id))
+            if os.path.exists(target_dir) and not self.params['keepassemblies'] and not self.params['packedstore']:
                 os.system("rm -rf %s" % target_dir)
-            os.mkdir(target_dir)
 
-            reads = self.params['mapping_dict'][target]
+        readcounts = {}
+        split_targets = []
+        for target_id in read_map.targets():
+            safe_target = safe_target_name(target_id)
+            target = table.name[target_id]
+            target_iteration = table.rounds[target_id] + 1
+
             # track how many total reads were added for this cycle
-            checker_params['readcounts'][target][iteration] = len(reads)
-            statsf.write('\t'.join([self.params['sample'], target, str(iteration), str(len(reads))]) + '\n')
-
-            SEs = PEs = 0
-            if 'PE1' and 'PE2' in self.params:
-                outf_PE1 = open(os.path.join(target_dir, "PE1." + self.params['format']), 'w')
-                outf_PE2 = open(os.path.join(target_dir, "PE2." + self.params['format']), 'w')
-            if 'SE' in self.params:
-                outf_SE = open(os.path.join(target_dir, "SE." + self.params['format']), 'w')
-
-            for readID in reads:
-                if self.params['subsample'] < 1 and randint(0, 100) > self.params['subsample'] * 100:
-                    continue
-                if 'PE1' in self.params and readID in idx_PE1:
-                    # read1 = idx_PE1[readID]
-                    # read2 = idx_PE2[readID]
-                    read1 = idx_PE1.get(readID, None)
-                    read2 = idx_PE2.get(readID, None)
-                    if read2 is None:
-                        raise exceptions.FatalError("ERROR: ReadID %s was found in PE1 file but not PE2" % readID)
-                    new_readID = readID.replace(":", "_") + ":0:0:0:0#0/"
-                    read1.id = read1.name = new_readID + "1"
-                    read2.id = read2.name = new_readID + "2"
-                    SeqIO.write(read1, outf_PE1, self.params['format'])
-                    SeqIO.write(read2, outf_PE2, self.params['format'])
-                    PEs += 1
-                elif 'SE' in self.params and readID in idx_SE:
-                    read1 = idx_SE[readID]
-                    read1.id = read1.name = readID.replace(":", "_") + ":0:0:0:0#0/"
-                    SeqIO.write(read1, outf_SE, self.params['format'])
-                    SEs += 1
-            if 'PE1' in self.params and 'PE2' in self.params:
-                outf_PE1.close()
-                outf_PE2.close()
-            if 'SE' in self.params:
-                outf_SE.close()
-
-            #Build assembly job:
-            assembly_params = {}
-            assembly_params['target'] = target
-            assembly_params['target_dir'] = target_dir
-            assembly_params['iteration'] = iteration
-            assembly_params['last_assembly'] = False
-            assembler_keys = ['assembler', 'sample', 'verbose', 'format', 'assemblytimeout', 'map_against_reads', 'urt', 'numcycles', 'cdna', 'rip', 'only-assembler']
-            for k in assembler_keys:
-                assembly_params[k] = self.params[k]
-            cur_reads = checker_params['readcounts'][target][iteration]  # note that this is a counter, so no key errors can occur
-            previous_reads = checker_params['readcounts'][target][iteration - 1]
+            cur_reads = readcounts[target] = read_map.count(target_id)
+            previous_reads = table.reads[target_id]
 
             #Turn off URT in situations where this will be the last iteration due to readcounts:
+            last_assembly = False
+            if cur_reads <= previous_reads and target_iteration > 2 or target_iteration >= self.params['numcycles']:
+                logger.info("Sample: %s target: %s iteration: %s Setting last_assembly to True" % (sample, target, target_iteration))
+                last_assembly = True
+
+            # The target folder is emptied here, before its Splitter runs.
+            # With packedstore there are no target folders.
+            if not self.params['packedstore']:
+                self.make_target_dir(safe_target)
+            split_targets.append(Job(target_id, target, iteration, target_iteration, last_assembly, cur_reads, previous_reads))
+        self.state.set_readcounts(sample, iteration, readcounts)
+        self.state.add_jobs(sample, iteration, split_targets)
+
+        #Subsample and cap the reads after the counts above are recorded, so
+        # the stopping rules and mapping_stats.tsv still see every read that
+        # mapped.
+        if self.downsampling() and split_targets:
+            before = dict((t[0], read_map.count(t[0])) for t in split_targets)
+            read_map.downsample(self.params['subsample'], self.params['max_reads_per_target'])
+            for job in split_targets:
+                if 0 < self.params['max_reads_per_target'] == read_map.count(job.ordinal) < before[job.ordinal]:
+                    logger.info("Sample: %s target: %s iteration: %s reads capped at %s of %s" % (
+                        sample, job.target, job.target_iteration, read_map.count(job.ordinal), before[job.ordinal]))
+
+        #Hand the targets to Splitter jobs in chunks with about the same number
+        # of reads, each chunk starts its assemblies as soon as it is written.
+        # A Splitter gets the range of target ordinals in its chunk and finds
+        # the targets in the run state database.
+        if split_targets:
+            read_map_file = os.path.join(self.params['working_dir'], 'read_map.I%03d' % iteration)
+            read_map.save(read_map_file)
+            previous_map = os.path.join(self.params['working_dir'], 'read_map.I%03d' % (iteration - 1))
+            if os.path.exists(previous_map):
+                os.remove(previous_map)
+            chunks = self.chunk_targets(read_map, split_targets)
+            splitter_keys = Splitter.assembler_keys + ['format', 'sra', 'sequentialsplit', 'splithandles', 'iteration', 'working_dir', 'finished_dir', 'normalize_coverage', 'normalize_ksize', 'normalize_memory', 'packedstore', 'scratchdir', 'state_db']
+            for chunk in chunks:
+                splitter_params = {}
+                for k in splitter_keys + ['PE1', 'PE2', 'SE']:
+                    if k in self.params:
+                        splitter_params[k] = self.params[k]
+                splitter_params['read_map_file'] = read_map_file
+                splitter_params['split_targets'] = [chunk[0][0], chunk[-1][0]]
+                self.submit(Splitter.to_job(splitter_params))
+            logger.info("Sample: %s Submitted %s splitter jobs for %s targets" % (sample, len(chunks), len(split_targets)))
 
-            if cur_reads <= previous_reads and iteration > 2 or iteration >= self.params['numcycles']:
-                logger.info("Sample: %s target: %s iteration: %s Setting last_assembly to True" % (self.params['sample'], target, self.params['iteration']))
-                assembly_params['last_assembly'] = True
-
-            #properly handle the case where no reads ended up mapping for the PE or SE inputs:
-            if PEs > 0:
-                assembly_params['assembly_PE1'] = os.path.join(target_dir, "PE1." + self.params['format'])
-                assembly_params['assembly_PE2'] = os.path.join(target_dir, "PE2." + self.params['format'])
-            if SEs > 0:
-                assembly_params['assembly_SE'] = os.path.join(target_dir, "SE." + self.params['format'])
-
-            #All reads have been written at this point, add an assembly to the queue:
-            logger.info("Sample: %s target: %s iteration: %s Split %s reads in %s seconds" % (self.params['sample'], target, self.params['iteration'], len(reads), time.time() - startT))
-
-            #Only add an assembly job and AssemblyChecker target if is there are >0 reads:
-            if PEs + SEs > 0:
-                checker_params['targets'][target_dir] = False
-                self.submit(Assembler.to_job(assembly_params))
-
-        statsf.close()
         logger.info("------------------------------------")
-        logger.info("| Sample: %s Iteration %s of numcycles %s" % (checker_params['sample'], checker_params['iteration'], checker_params['numcycles']))
+        logger.info("| Sample: %s Iteration %s of numcycles %s" % (sample, iteration, self.params['numcycles']))
         logger.info("------------------------------------")
-        if 'PE1' in self.params and 'PE2' in self.params:
-            idx_PE1.close()
-            idx_PE2.close()
-            del idx_PE1
-            del idx_PE2
-        if 'SE' in self.params:
-            idx_SE.close()
-            del idx_SE
 
-        #Kick off a job which checks if all assemblies are done, and if not adds a copy of itself to the job queue
-        if len(checker_params['targets']) > 0:
-            # checker = AssemblyChecker(checker_params)
-            self.submit(AssemblyChecker.to_job(checker_params))
+        #The Finisher waits for this job and all of the Splitters and Assemblers it started
+        finisher_params = {}
+        for k in self.params:
+            finisher_params[k] = self.params[k]
+        if len(split_targets) > 0:
+            self.submit(Finisher.to_job(finisher_params), barrier=True)
+        elif assembling:
+            logger.info("Sample: %s No reads mapped, finishing the %s targets still being assembled." % (sample, len(assembling)))
+            self.submit(Finisher.to_job(finisher_params), barrier='sample')
         else:
-            logger.info("Sample: %s No reads mapped, no more work to do." % checker_params['sample'])
+            logger.info("Sample: %s No reads mapped, no more work to do." % sample)
+
+    def make_target_dir(self, safe_target):
+        """
+        Get a target directory ready for this iteration and return its path.
+        The read files and reads.ord of a target which carries on from the
+        last iteration are kept so the Splitter only has to extract the reads
+        it hasn't seen yet, anything else (the last assembly, finished file,
+        normalized reads) is removed.
+        """
+        target_dir = os.path.join(self.params['working_dir'], safe_target)
+        if os.path.exists(target_dir):
+            keep = set(self.read_files() + ['reads.ord'])
+            for name in os.listdir(target_dir):
+                if name not in keep:
+                    os.system("rm -rf %s" % os.path.join(target_dir, name))
+        else:
+            os.mkdir(target_dir)
+        for name in self.read_files():
+            if not os.path.exists(os.path.join(target_dir, name)):
+                open(os.path.join(target_dir, name), 'w').close()
+        return target_dir
+
+    def read_files(self):
+        """ Names of the read files written to each target directory """
+        names = []
+        if 'PE1' in self.params and 'PE2' in self.params:
+            names += ["PE1." + self.params['format'], "PE2." + self.params['format']]
+        if 'SE' in self.params:
+            names.append("SE." + self.params['format'])
+        return names
+
+    def chunk_targets(self, read_map, split_targets):
+        """ Divide split_targets into splitjobs runs of targets with about the same number of reads """
+        njobs = self.params['splitjobs']
+        if njobs <= 0:
+            njobs = int(self.params['nprocs'])
+        per_job = float(len(read_map)) / max(njobs, 1)
+        chunks = [[]]
+        nreads = 0
+        for t in split_targets:
+            if chunks[-1] and nreads >= per_job * len(chunks) and len(chunks) < njobs:
+                chunks.append([])
+            chunks[-1].append(t)
+            nreads += read_map.count(t[0])
+        return chunks
@@ -0,0 +1,404 @@
+# Copyright 2013, Institute for Bioninformatics and Evolutionary Studies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import time
+from array import array
+from itertools import izip
+from collections import OrderedDict
+from ARC import logger
+from ARC import seqio
+from ARC.runners import Base
+from ARC.runners import Assembler
+from ARC.functions import keyfunction
+from ARC.read_index import SampleIndex
+from ARC.read_map import ReadMap, safe_target_name
+from ARC.normalize import Normalizer
+from ARC.packed_store import PackedStore, container_path, scratch_dir
+from ARC.state import StateStore
+
+
+class Splitter(Base):
+    """
+    Writes the reads of a chunk of targets to their target folders and
+    submits an assembly for each target as soon as its reads are written.
+    The Mapper saves its ReadMap and creates the (empty) target folders, then
+    submits one Splitter per chunk so that several workers extract reads at
+    the same time and assemblies start before the whole split is done.
+    Targets which end up with no reads (because the Mapper subsampled them
+    away) get a 'no_reads' finished file and no assembly.
+    With normalize_coverage set the written reads are digitally normalized
+    into norm_* files which are given to the assembler instead, the full
+    read files are kept for the Finisher. Each target's line in
+    mapping_stats.tsv is written here once the kept and dropped counts are
+    known.
+    With packedstore each target is built in a work folder (starting from
+    its entry in the last iteration's container) and packed into this
+    iteration's container, the assembly runs in a scratch copy of it.
+    required params:
+        assembler keys, PE1, PE2, SE, format, sample, sra,
+        sequentialsplit, splithandles, iteration, working_dir, finished_dir,
+        normalize_coverage, normalize_ksize, normalize_memory,
+        packedstore, scratchdir,
+        state_db, read_map_file, split_targets: the first and last target
+            ordinal of the chunk, its jobs are looked up in the state database
+    """
+    assembler_keys = ['assembler', 'sample', 'verbose', 'format', 'assemblytimeout', 'map_against_reads', 'urt', 'numcycles', 'cdna', 'rip', 'only-assembler']
+
+    def message(self):
+        return 'Sample: %s Starting splitter for targets %s to %s.' % (
+            self.params['sample'], self.params['split_targets'][0], self.params['split_targets'][1])
+
+    def start(self):
+        first, last = self.params['split_targets']
+        state = StateStore(self.params['state_db'])
+        targets = state.jobs(self.params['sample'], self.params['iteration'], first, last)
+        state.close()
+        read_map = ReadMap.load(self.params['read_map_file'], [t[0] for t in targets])
+        pe_files = None
+        if 'PE1' in self.params and 'PE2' in self.params:
+            pe_files = [self.params['PE1'], self.params['PE2']]
+        self.index = SampleIndex(self.params['working_dir'], pe_files, self.params.get('SE'))
+        try:
+            self.split(read_map, targets)
+        finally:
+            self.index.close()
+
+    def split(self, read_map, targets):
+        target_dirs = {}
+        packed = self.params['packedstore']
+        if packed:
+            # Targets are put together one at a time in a single work folder
+            # and then packed, nothing is written per target.
+            work_dir = os.path.join(scratch_dir(self.params), 'split.%d' % os.getpid())
+            if not os.path.exists(work_dir):
+                os.makedirs(work_dir)
+        for job in targets:
+            if packed:
+                target_dirs[job.ordinal] = work_dir
+            else:
+                target_dirs[job.ordinal] = os.path.join(self.params['working_dir'], safe_target_name(job.ordinal))
+        try:
+            self.split_targets(read_map, targets, target_dirs)
+        finally:
+            if packed:
+                os.system("rm -rf %s" % work_dir)
+
+    def split_targets(self, read_map, targets, target_dirs):
+        packed = self.params['packedstore']
+        if packed:
+            store = PackedStore(container_path(self.params['working_dir'], self.params['iteration']))
+            previous = PackedStore(container_path(self.params['working_dir'], self.params['iteration'] - 1))
+            scratch = scratch_dir(self.params)
+        sequential = self.params['sequentialsplit']
+        if sequential:
+            # Every target's reads in this chunk are written in one pass
+            # before any of its assemblies are started.
+            splitT = time.time()
+            prepared = {}
+            for target_id in target_dirs:
+                prepared[target_id] = self.prepare_target(target_dirs[target_id], read_map.get(target_id))
+            fresh_map = read_map.with_reads(dict((t, prepared[t][1]) for t in prepared))
+            self.split_sequential(fresh_map, target_dirs)
+            splitT = time.time() - splitT
+            logger.info("Sample: %s Extracted reads for %s targets in one sequential pass in %s seconds" % (self.params['sample'], len(target_dirs), splitT))
+
+        for job in targets:
+            target_id = job.ordinal
+            target = job.target
+            iteration = job.target_iteration
+            startT = time.time()
+            target_dir = target_dirs[target_id]
+            safe_target = safe_target_name(target_id)
+            reads = read_map.get(target_id)
+            if packed:
+                # Start from this target's reads of the last iteration
+                os.system("rm -rf %s/*" % target_dir)
+                previous.materialize(safe_target, target_dir, self.read_files() + ['reads.ord'])
+            if sequential:
+                known, fresh = prepared[target_id]
+                # Report this target's share of the single pass
+                splitS = splitT * len(fresh) / max(len(fresh_map), 1)
+            else:
+                known, fresh = self.prepare_target(target_dir, reads)
+                self.split_target(target_dir, fresh)
+                splitS = time.time() - startT
+            known.extend(fresh)
+            self.save_ordinals(target_dir, known)
+            PEs = len([r for r in known if r < self.index.npe])
+            SEs = len(known) - PEs
+            logger.info("Sample: %s target: %s iteration: %s Split %s reads in %s seconds, %s newly extracted" % (self.params['sample'], target, iteration, len(reads), splitS, len(fresh)))
+
+            prefix = ''
+            dropped = 0
+            if self.params['normalize_coverage'] > 0 and PEs + SEs > 0:
+                startT = time.time()
+                prefix = 'norm_'
+                PEs, SEs, dropped = self.normalize(target_dir, PEs, SEs, prefix)
+                logger.info("Sample: %s target: %s iteration: %s Normalization kept %s and dropped %s reads in %s seconds" % (self.params['sample'], target, iteration, PEs + SEs, dropped, time.time() - startT))
+            self.write_stats(target, iteration, job.mapped, PEs + SEs, dropped)
+
+            if PEs + SEs == 0:
+                outf = open(os.path.join(target_dir, 'finished'), 'w')
+                outf.write("no_reads")
+                outf.close()
+                if packed:
+                    store.pack(safe_target, target_dir, self.read_files() + ['reads.ord', 'finished'])
+                continue
+
+            if packed:
+                store.pack(safe_target, target_dir, self.read_files() + ['reads.ord'] +
+                           [prefix + name for name in self.read_files() if prefix])
+                # The Assembler unpacks the target here just before it runs
+                target_dir = os.path.join(scratch, safe_target)
+
+            #Build assembly job:
+            assembly_params = {}
+            assembly_params['target'] = target
+            assembly_params['target_dir'] = target_dir
+            if packed:
+                assembly_params['packed_store'] = store.path
+            assembly_params['iteration'] = iteration
+            assembly_params['last_assembly'] = job.last_assembly
+            # What the scheduler predicts the assembly's run time from
+            assembly_params['reads'] = PEs + SEs
+            for k in self.assembler_keys:
+                assembly_params[k] = self.params[k]
+
+            #properly handle the case where no reads ended up mapping for the PE or SE inputs:
+            if PEs > 0:
+                assembly_params['assembly_PE1'] = os.path.join(target_dir, prefix + "PE1." + self.params['format'])
+                assembly_params['assembly_PE2'] = os.path.join(target_dir, prefix + "PE2." + self.params['format'])
+            if SEs > 0:
+                assembly_params['assembly_SE'] = os.path.join(target_dir, prefix + "SE." + self.params['format'])
+
+            #All reads have been written at this point, add an assembly to the queue:
+            self.submit(Assembler.to_job(assembly_params))
+
+    def write_stats(self, target, iteration, mapped, kept, dropped):
+        """
+        Append a target's line to mapping_stats.tsv, in a single write as
+        other Splitters share the file. The kept and dropped counts are only
+        written with normalize_coverage set, like their columns in the header.
+        """
+        fields = [self.params['sample'], target, str(iteration), str(mapped)]
+        if self.params['normalize_coverage'] > 0:
+            fields += [str(kept), str(dropped)]
+        statsf = open(os.path.join(self.params['finished_dir'], 'mapping_stats.tsv'), 'a')
+        statsf.write('\t'.join(fields) + '\n')
+        statsf.close()
+
+    def normalize(self, target_dir, PEs, SEs, prefix):
+        """
+        Write the reads of a target which pass digital normalization to
+        prefixed copies of its read files, pairs first and then single ends
+        through one shared sketch. Returns (PEs, SEs, dropped).
+        """
+        format = self.params['format']
+        names = []
+        if PEs > 0:
+            names += ["PE1." + format, "PE2." + format]
+        if SEs > 0:
+            names += ["SE." + format]
+        nbases = sum([os.path.getsize(os.path.join(target_dir, n)) for n in names])
+        normalizer = Normalizer(self.params['normalize_coverage'], self.params['normalize_ksize'],
+                                self.params['normalize_memory'], nbases)
+        kept_PEs = kept_SEs = 0
+        if PEs > 0:
+            inf_PE1 = open(os.path.join(target_dir, "PE1." + format), 'r')
+            inf_PE2 = open(os.path.join(target_dir, "PE2." + format), 'r')
+            outf_PE1 = seqio.RecordWriter(open(os.path.join(target_dir, prefix + "PE1." + format), 'w'), format)
+            outf_PE2 = seqio.RecordWriter(open(os.path.join(target_dir, prefix + "PE2." + format), 'w'), format)
+            for r1, r2 in izip(seqio.read_records(inf_PE1, format), seqio.read_records(inf_PE2, format)):
+                if normalizer.keep([r1[1], r2[1]]):
+                    outf_PE1.write(*r1)
+                    outf_PE2.write(*r2)
+                    kept_PEs += 1
+            inf_PE1.close()
+            inf_PE2.close()
+            outf_PE1.close()
+            outf_PE2.close()
+        if SEs > 0:
+            inf_SE = open(os.path.join(target_dir, "SE." + format), 'r')
+            outf_SE = seqio.RecordWriter(open(os.path.join(target_dir, prefix + "SE." + format), 'w'), format)
+            for r in seqio.read_records(inf_SE, format):
+                if normalizer.keep([r[1]]):
+                    outf_SE.write(*r)
+                    kept_SEs += 1
+            inf_SE.close()
+            outf_SE.close()
+        return kept_PEs, kept_SEs, normalizer.dropped
+
+    def rename_read(self, paired, records):
+        """
+        Give a read or pair fetched from the index the name used for assembly,
+        returns the text of each record. Records in the layout SeqIO writes
+        are copied with only their first line replaced (see seqio.retitle).
+        """
+        format = self.params['format']
+        titles = [seqio.raw_title(raw) for raw in records]
+        readID = keyfunction(self.params['sra'])(seqio.record_id(titles[0]))
+        if paired:
+            new_readID = readID.replace(":", "_") + ":0:0:0:0#0/"
+            new_ids = [new_readID + "1", new_readID + "2"]
+        else:
+            new_ids = [readID.replace(":", "_") + ":0:0:0:0#0/"]
+        return [seqio.retitle(raw, format, seqio.rename(title, new_id))
+                for raw, title, new_id in zip(records, titles, new_ids)]
+
+    def prepare_target(self, target_dir, reads):
+        """
+        Get a target's read files ready for the reads mapped this iteration.
+        Reads extracted in earlier iterations are listed in reads.ord and stay
+        in the files, reads which no longer map are filtered out of them, and
+        the rest has to be appended. Returns (known, fresh): the ordinals left
+        in the files in file order, and the sorted ordinals to fetch from the
+        index. reads.ord is removed until save_ordinals() is called, so an
+        interrupted split starts over from empty files.
+        """
+        ord_file = os.path.join(target_dir, 'reads.ord')
+        known = array('I')
+        if os.path.exists(ord_file):
+            inf = open(ord_file, 'rb')
+            known.fromstring(inf.read())
+            inf.close()
+            os.remove(ord_file)
+        else:
+            for name in self.read_files():
+                open(os.path.join(target_dir, name), 'w').close()
+        wanted = set(reads)
+        if [r for r in known if r not in wanted]:
+            known = self.drop_reads(target_dir, known, wanted)
+        known_set = set(known)
+        fresh = array('I', [r for r in reads if r not in known_set])
+        return known, fresh
+
+    def drop_reads(self, target_dir, known, wanted):
+        """
+        Rewrite a target's read files without the reads which are not in
+        wanted. The files hold the reads of known in that order, pairs in the
+        PE files and single reads in the SE file. Returns the ordinals kept.
+        """
+        format = self.params['format']
+        npe = self.index.npe
+        inputs = {}
+        outputs = {}
+        for name in self.read_files():
+            path = os.path.join(target_dir, name)
+            inf = open(path, 'r')
+            inputs[name] = (inf, seqio.read_records(inf, format))
+            outputs[name] = seqio.RecordWriter(open(path + '.tmp', 'w'), format)
+        pe_names = ["PE1." + format, "PE2." + format]
+        se_names = ["SE." + format]
+        kept = array('I')
+        for r in known:
+            names = pe_names if r < npe else se_names
+            records = [inputs[name][1].next() for name in names]
+            if r in wanted:
+                for name, record in zip(names, records):
+                    outputs[name].write(*record)
+                kept.append(r)
+        for name in inputs:
+            inputs[name][0].close()
+            outputs[name].close()
+            path = os.path.join(target_dir, name)
+            os.rename(path + '.tmp', path)
+        logger.info("Sample: %s %s reads dropped out of %s, rewrote its read files" % (
+            self.params['sample'], len(known) - len(kept), target_dir))
+        return kept
+
+    def save_ordinals(self, target_dir, known):
+        ord_file = os.path.join(target_dir, 'reads.ord')
+        outf = open(ord_file + '.tmp', 'wb')
+        known.tofile(outf)
+        outf.close()
+        os.rename(ord_file + '.tmp', ord_file)
+
+    def read_files(self):
+        """ Names of the read files kept in each target directory """
+        names = []
+        if 'PE1' in self.params and 'PE2' in self.params:
+            names += ["PE1." + self.params['format'], "PE2." + self.params['format']]
+        if 'SE' in self.params:
+            names.append("SE." + self.params['format'])
+        return names
+
+    def split_target(self, target_dir, reads):
+        """ Append reads to a target's read files, fetching them from the index. Returns (PEs, SEs) """
+        SEs = PEs = 0
+        if 'PE1' in self.params and 'PE2' in self.params:
+            outf_PE1 = open(os.path.join(target_dir, "PE1." + self.params['format']), 'a')
+            outf_PE2 = open(os.path.join(target_dir, "PE2." + self.params['format']), 'a')
+        if 'SE' in self.params:
+            outf_SE = open(os.path.join(target_dir, "SE." + self.params['format']), 'a')
+
+        for read in reads:
+            # Both mates of a pair are stored in a single index record
+            paired, records = self.index.get_raw(read)
+            renamed = self.rename_read(paired, records)
+            if paired:
+                outf_PE1.write(renamed[0])
+                outf_PE2.write(renamed[1])
+                PEs += 1
+            else:
+                outf_SE.write(renamed[0])
+                SEs += 1
+        if 'PE1' in self.params and 'PE2' in self.params:
+            outf_PE1.close()
+            outf_PE2.close()
+        if 'SE' in self.params:
+            outf_SE.close()
+        return PEs, SEs
+
+    def split_sequential(self, read_map, target_dirs):
+        """
+        Write the reads of every target in a single forward pass through the
+        read files. The map is inverted to read -> targets and visited in read
+        ordinal order, which is file order, and each record is written to all
+        of the targets it mapped to. Output files are kept in a bounded pool
+        of open handles, evicted files are reopened for appending.
+        Returns {target_id: [PEs, SEs]}.
+        """
+        format = self.params['format']
+        counts = dict((t, [0, 0]) for t in target_dirs)
+        handles = OrderedDict()
+        max_handles = max(self.params['splithandles'], 3)
+
+        def handle(target_id, name):
+            path = os.path.join(target_dirs[target_id], name)
+            if path in handles:
+                outf = handles.pop(path)
+            else:
+                if len(handles) >= max_handles:
+                    handles.popitem(last=False)[1].close()
+                outf = open(path, 'a', 65536)
+            handles[path] = outf
+            return outf
+
+        try:
+            for read, targets in read_map.by_read():
+                paired, records = self.index.get_raw(read)
+                renamed = self.rename_read(paired, records)
+                for target_id in targets:
+                    if paired:
+                        handle(target_id, "PE1." + format).write(renamed[0])
+                        handle(target_id, "PE2." + format).write(renamed[1])
+                        counts[target_id][0] += 1
+                    else:
+                        handle(target_id, "SE." + format).write(renamed[0])
+                        counts[target_id][1] += 1
+        finally:
+            for outf in handles.values():
+                outf.close()
+        return counts
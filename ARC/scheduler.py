@@ -0,0 +1,311 @@
+# Copyright 2013, Institute for Bioninformatics and Evolutionary Studies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import heapq
+from ARC import logger
+from ARC import exceptions
+
+# Task states
+WAITING, READY, RUNNING, DONE = range(4)
+
+# How many times a job which raised a RerunnableError is run again before
+# the run is stopped
+MAX_RETRIES = 2
+
+# Seconds per read assumed for assemblies until one has finished
+DEFAULT_RATE = 0.001
+
+
+class Task:
+    """
+    A job in the task graph. A task's parent is the task which submitted it,
+    a task submitted as a barrier waits until its parent and every other
+    task descended from the parent (including those submitted after the
+    barrier) are done. For each iteration of a sample this gives
+
+        Mapper -> Splitter x chunks -> Assembler x targets
+               \-> Finisher (barrier) -> Mapper of the next iteration
+
+    A barrier submitted as 'sample' instead waits until no other task of
+    its sample is left.
+    """
+
+    def __init__(self, id, job, parent, barrier):
+        self.id = id
+        self.job = job
+        self.runner = job['runner']
+        self.sample = job['params'].get('sample')
+        self.iteration = job['params'].get('iteration')
+        self.parent = parent
+        self.barrier = barrier
+        self.state = WAITING
+        # Tasks below this one which aren't done (and how many of them aren't
+        # Assemblers), and barriers waiting on them
+        self.open = 0
+        self.open_other = 0
+        self.barriers = []
+        # Assemblers below this one submitted and finished, for rollingrounds
+        self.assemblies = 0
+        self.assembled = 0
+        # The task whose completion made this one ready, the link followed
+        # back along the critical path
+        self.pred = parent
+        self.retries = 0
+        # Predicted run time in seconds, only for Assemblers
+        self.cost = 0.0
+        self.submitted = time.time()
+        self.ready = self.started = self.finished = None
+
+    def key(self):
+        """
+        Heap key of a ready task. Everything that feeds the pipeline (Mapper,
+        Splitter, Finisher) goes before assemblies, and assemblies go most
+        expensive first so a large target doesn't start last and hold up its
+        iteration's Finisher.
+        """
+        return (self.runner == 'Assembler', -self.cost, self.id)
+
+
+class Scheduler:
+    """
+    Keeps the task graph of a run and puts tasks on the job queue as their
+    dependencies are met. Runners submit jobs through the events queue of
+    Spawn instead of the job queue, workers report when they start and
+    finish a task. Ready tasks wait in a priority queue (Task.key) and are
+    only put on the job queue when a worker is free to take them.
+
+    An assembly's cost is predicted from the reads it was given. A target
+    assembled in an earlier iteration is scaled from its own reads and run
+    time then, other targets use the seconds per read of all assemblies so
+    far. The predicted and actual costs are logged for every assembly.
+
+    Queue depth and busy workers are integrated over time and the critical
+    path is traced back from the last task at the end of the run
+    (report()).
+
+    With rolling (rollingrounds) above 0 a task's barriers don't wait for
+    all of its assemblies: once everything else below it is done they are
+    released as soon as that fraction of the assemblies has finished. The
+    rest carry on and are collected by a later Finisher.
+    """
+
+    def __init__(self, job_q, nprocs, rolling=0):
+        self.job_q = job_q
+        self.nprocs = nprocs
+        self.rolling = rolling
+        self.tasks = {}
+        self.next_id = 0
+        self.ready = []
+        self.unfinished = 0
+        # Unfinished tasks and 'sample' barriers of each sample
+        self.sample_unfinished = {}
+        self.sample_barriers = {}
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.first = self.last = time.time()
+        self.queued_area = 0.0
+        self.idle_area = 0.0
+        # (sample, target): (reads, seconds) of its last assembly
+        self.history = {}
+        self.assembled_reads = 0
+        self.assembled_seconds = 0.0
+        self.predicted = []
+
+    def submit(self, job, parent=None, barrier=False):
+        """ Add a job to the graph, it is queued right away unless it is a barrier """
+        self.tick()
+        task = Task(self.next_id, job, parent, barrier)
+        self.tasks[task.id] = task
+        self.next_id += 1
+        self.unfinished += 1
+        self.sample_unfinished[task.sample] = self.sample_unfinished.get(task.sample, 0) + 1
+        if task.runner == 'Assembler':
+            task.cost = self.predict(job['params'])
+        if barrier == 'sample':
+            self.sample_barriers.setdefault(task.sample, []).append(task.id)
+        elif barrier:
+            self.tasks[parent].barriers.append(task.id)
+        else:
+            for ancestor in self.ancestors(task):
+                ancestor.open += 1
+                if task.runner == 'Assembler':
+                    ancestor.assemblies += 1
+                else:
+                    ancestor.open_other += 1
+            self.dispatch(task)
+        return task.id
+
+    def ancestors(self, task):
+        while task.parent is not None:
+            task = self.tasks[task.parent]
+            yield task
+
+    def dispatch(self, task):
+        task.state = READY
+        task.ready = time.time()
+        heapq.heappush(self.ready, (task.key(), task.id))
+        self.max_queued = max(self.max_queued, self.queued + len(self.ready))
+        self.pump()
+
+    def pump(self):
+        """ Queue the most urgent ready tasks for the workers which are free """
+        while self.ready and self.queued + self.running < self.nprocs:
+            task = self.tasks[heapq.heappop(self.ready)[1]]
+            job = dict(task.job)
+            job['task'] = task.id
+            self.queued += 1
+            self.job_q.put(job)
+
+    def predict(self, params):
+        """ Predicted seconds for an assembly """
+        reads = params.get('reads', 0)
+        last = self.history.get((params['sample'], params['target']))
+        if last is not None and last[0] > 0:
+            return last[1] * reads / float(last[0])
+        if self.assembled_reads > 0:
+            return self.assembled_seconds * reads / self.assembled_reads
+        return DEFAULT_RATE * reads
+
+    def started(self, task_id):
+        self.tick()
+        task = self.tasks[task_id]
+        task.state = RUNNING
+        task.started = time.time()
+        self.queued -= 1
+        self.running += 1
+
+    def finished(self, task_id, status):
+        """
+        A worker is done with a task, status is 'ok', 'rerun' or 'failed'.
+        Raises FatalError if a task still asks to be rerun after MAX_RETRIES.
+        """
+        self.tick()
+        task = self.tasks[task_id]
+        self.running -= 1
+        if status == 'rerun':
+            if task.retries >= MAX_RETRIES:
+                # Its targets would stay open for good and the sample's
+                # Finisher would keep waiting on them
+                raise exceptions.FatalError("%s task %s of sample %s failed again after %s retries" % (
+                    task.runner, task.id, task.sample, MAX_RETRIES))
+            task.retries += 1
+            logger.warn("Scheduler: rerunning %s task %s (retry %s of %s)" % (task.runner, task.id, task.retries, MAX_RETRIES))
+            self.dispatch(task)
+            return
+        task.state = DONE
+        task.finished = time.time()
+        if task.runner == 'Assembler' and status == 'ok':
+            self.assembled(task)
+        task.job = None
+        self.unfinished -= 1
+        self.sample_unfinished[task.sample] -= 1
+        self.release(task, task)
+        if not task.barrier:
+            for ancestor in self.ancestors(task):
+                ancestor.open -= 1
+                if task.runner == 'Assembler':
+                    ancestor.assembled += 1
+                else:
+                    ancestor.open_other -= 1
+                self.release(ancestor, task)
+        self.release_sample(task)
+        self.pump()
+
+    def assembled(self, task):
+        """ Log an assembly's predicted and actual cost and learn from it """
+        params = task.job['params']
+        seconds = task.finished - task.started
+        reads = params.get('reads', 0)
+        logger.info("Sample: %s target: %s iteration: %s Assembly cost predicted %.2f seconds, actual %.2f seconds for %s reads"
+                    % (task.sample, params['target'], task.iteration, task.cost, seconds, reads))
+        self.history[(task.sample, params['target'])] = (reads, seconds)
+        self.assembled_reads += reads
+        self.assembled_seconds += seconds
+        self.predicted.append((task.cost, seconds))
+
+    def release(self, task, cause):
+        """ Queue the barriers of task if it and everything below it are done """
+        if task.state != DONE or not task.barriers:
+            return
+        if task.open == 0:
+            message = "All work of iteration %s finished"
+        elif (self.rolling and task.open_other == 0 and task.assemblies
+              and task.assembled >= self.rolling * task.assemblies):
+            message = "%s of %s assemblies of iteration %%s finished" % (task.assembled, task.assemblies)
+        else:
+            return
+        for barrier_id in task.barriers:
+            barrier = self.tasks[barrier_id]
+            barrier.pred = cause.id
+            logger.info(("Sample: %s " + message + ", queueing %s (queue depth %s, %s of %s workers busy)")
+                        % (barrier.sample, barrier.iteration, barrier.runner, self.queued, self.running, self.nprocs))
+            self.dispatch(barrier)
+        task.barriers = []
+
+    def release_sample(self, cause):
+        """ Queue the 'sample' barriers of cause's sample if they are all that is left of it """
+        barriers = self.sample_barriers.get(cause.sample)
+        if barriers and self.sample_unfinished[cause.sample] == len(barriers):
+            for barrier_id in barriers:
+                barrier = self.tasks[barrier_id]
+                barrier.pred = cause.id
+                logger.info("Sample: %s All remaining work finished, queueing %s (queue depth %s, %s of %s workers busy)"
+                            % (barrier.sample, barrier.runner, self.queued, self.running, self.nprocs))
+                self.dispatch(barrier)
+            self.sample_barriers[cause.sample] = []
+
+    def tick(self):
+        """ Integrate queue depth and idle workers up to now """
+        now = time.time()
+        elapsed = now - self.last
+        self.queued_area += (self.queued + len(self.ready)) * elapsed
+        self.idle_area += (self.nprocs - self.running) * elapsed
+        self.last = now
+
+    def critical_path(self):
+        """ The chain of tasks leading to the one which finished last, first task first """
+        done = [t for t in self.tasks.itervalues() if t.state == DONE]
+        if not done:
+            return []
+        task = max(done, key=lambda t: t.finished)
+        path = [task]
+        while task.pred is not None:
+            task = self.tasks[task.pred]
+            path.append(task)
+        path.reverse()
+        return path
+
+    def report(self):
+        self.tick()
+        makespan = self.last - self.first
+        logger.info("Scheduler: %d tasks in %.1f seconds" % (len(self.tasks), makespan))
+        path = self.critical_path()
+        if path:
+            kinds = {}
+            for task in path:
+                n, seconds = kinds.get(task.runner, (0, 0.0))
+                kinds[task.runner] = (n + 1, seconds + task.finished - task.started)
+            logger.info("Scheduler: critical path of %d tasks over %.1f seconds, %.1f of them running: %s" % (
+                len(path), path[-1].finished - path[0].submitted, sum(k[1] for k in kinds.itervalues()),
+                ", ".join("%s x%d %.1fs" % (k, kinds[k][0], kinds[k][1]) for k in sorted(kinds, key=lambda k: -kinds[k][1]))))
+        if makespan > 0:
+            logger.info("Scheduler: queue depth max %d, mean %.1f" % (self.max_queued, self.queued_area / makespan))
+            logger.info("Scheduler: workers idle %.1f of %.1f worker seconds (%.0f%%)" % (
+                self.idle_area, makespan * self.nprocs, 100 * self.idle_area / (makespan * self.nprocs)))
+        if self.predicted:
+            error = sum(abs(p - a) for p, a in self.predicted) / len(self.predicted)
+            logger.info("Scheduler: %d assemblies predicted to take %.1f seconds, took %.1f, mean error %.2f seconds" % (
+                len(self.predicted), sum(p for p, a in self.predicted), sum(a for p, a in self.predicted), error))
@@ -0,0 +1,246 @@
+# Copyright 2013, Institute for Bioninformatics and Evolutionary Studies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+# Light-weight FASTA/FASTQ handling for the read paths, which only ever need
+# to rename or annotate records. Records are (title, seq, qual) string tuples
+# (qual is None for FASTA) instead of SeqRecords, and the output is
+# byte-identical to parsing with Bio.SeqIO and writing with SeqIO.write:
+# titles follow SeqIO's id/description rules, FASTQ is written on four lines
+# with a bare '+' and FASTA is wrapped at 60 columns.
+#
+# Records which only need a new title can also be handled as their raw text
+# (read_raw, retitle): one already laid out the way SeqIO writes it is copied
+# as is apart from its first line, only other layouts are parsed and rewritten.
+
+FASTA_WRAP = 60
+
+
+def parse_raw(raw, format):
+    """ Split the raw text of one record into a (title, seq, qual) tuple """
+    lines = raw.split('\n')
+    title = lines[0][1:].rstrip()
+    if format == 'fastq':
+        i = 1
+        while lines[i][:1] != '+':
+            i += 1
+        return (title, ''.join([l.rstrip() for l in lines[1:i]]),
+                ''.join([l.rstrip() for l in lines[i + 1:]]))
+    return (title, ''.join([l.rstrip() for l in lines[1:]]).replace(" ", "").replace("\r", ""), None)
+
+
+def raw_title(raw):
+    """ The title of the record in raw, as parse_raw would give it """
+    end = raw.find('\n')
+    return (raw[1:end] if end >= 0 else raw[1:]).rstrip()
+
+
+def canonical(first, body, format):
+    """
+    Whether a record's first line and the rest of its text (ending in a
+    newline) are exactly what format_record writes for it
+    """
+    if first != first.rstrip() or '\r' in first:
+        return False
+    lines = body.split('\n')[:-1]
+    for l in lines:
+        if l != l.rstrip():
+            return False
+    if format == 'fastq':
+        return len(lines) == 3 and lines[1] == '+' and len(lines[0]) == len(lines[2])
+    if ' ' in body or '\r' in body:
+        return False
+    for l in lines[:-1]:
+        if len(l) != FASTA_WRAP:
+            return False
+    return not lines or 0 < len(lines[-1]) <= FASTA_WRAP
+
+
+def retitle(raw, format, title):
+    """
+    The text SeqIO.write would produce for the record in raw with title as
+    its title. A record in the layout format_record writes keeps its bytes
+    and only gets a new first line, others are parsed and reformatted.
+    """
+    end = raw.find('\n')
+    if end >= 0:
+        first, body = raw[:end], raw[end + 1:]
+        if not body.endswith('\n'):
+            # The last record of a file without a final newline
+            body += '\n'
+        if canonical(first, body, format):
+            return "%s%s\n%s" % (raw[0], title, body)
+    record = parse_raw(raw, format)
+    return format_record(title, record[1], record[2], format)
+
+
+def record_id(title):
+    """ The id SeqIO gives a record with this title (its first word) """
+    words = title.split(None, 1)
+    return words[0] if words else ''
+
+
+def _title(id, description):
+    # How SeqIO.write builds a title line from a record's id and description
+    id = id.replace("\n", " ").replace("\r", " ")
+    description = description.replace("\n", " ").replace("\r", " ")
+    if description and description.split(None, 1)[0] == id:
+        return description
+    elif description:
+        return "%s %s" % (id, description)
+    return id
+
+
+def rename(title, new_id):
+    """ Title written by SeqIO after setting record.id = new_id """
+    return _title(new_id, title)
+
+
+def describe(title, description):
+    """ Title written by SeqIO after setting record.description = description """
+    return _title(record_id(title), description)
+
+
+def format_record(title, seq, qual, format):
+    """ Return the text SeqIO.write would produce for a record in format """
+    if format == 'fastq':
+        return "@%s\n%s\n+\n%s\n" % (title, seq, qual)
+    lines = [">%s\n" % title]
+    for i in xrange(0, len(seq), FASTA_WRAP):
+        lines.append(seq[i:i + FASTA_WRAP] + "\n")
+    return ''.join(lines)
+
+
+def read_records(handle, format):
+    """
+    Iterate over the (title, seq, qual) tuples in a FASTA or FASTQ file,
+    following the rules of Bio.SeqIO's parsers for multi-line records.
+    """
+    if format == 'fasta':
+        title = None
+        lines = []
+        for line in handle:
+            if line[0] == '>':
+                if title is not None:
+                    yield title, ''.join(lines).replace(" ", "").replace("\r", ""), None
+                title = line[1:].rstrip()
+                lines = []
+            elif title is not None:
+                lines.append(line.rstrip())
+        if title is not None:
+            yield title, ''.join(lines).replace(" ", "").replace("\r", ""), None
+        return
+    line = handle.readline()
+    while line:
+        if line[0] != '@':
+            raise ValueError("Records in Fastq files should start with '@' character")
+        title = line[1:].rstrip()
+        seq = []
+        line = handle.readline()
+        while line and line[0] != '+':
+            seq.append(line.rstrip())
+            line = handle.readline()
+        if not line:
+            raise ValueError("End of file without quality information.")
+        seq = ''.join(seq)
+        qual = handle.readline().rstrip()
+        line = handle.readline()
+        while line and (line[0] != '@' or len(qual) < len(seq)):
+            qual += line.rstrip()
+            line = handle.readline()
+        if len(seq) != len(qual):
+            raise ValueError("Lengths of sequence and quality values differs for %s (%i and %i)."
+                             % (title, len(seq), len(qual)))
+        yield title, seq, qual
+
+
+def read_raw(handle, format):
+    """
+    Iterate over the raw text of the records in a FASTA or FASTQ file, split
+    the way read_records splits them.
+    """
+    if format == 'fasta':
+        lines = None
+        for line in handle:
+            if line[0] == '>':
+                if lines is not None:
+                    yield ''.join(lines)
+                lines = [line]
+            elif lines is not None:
+                lines.append(line)
+        if lines is not None:
+            yield ''.join(lines)
+        return
+    line = handle.readline()
+    while line:
+        if line[0] != '@':
+            raise ValueError("Records in Fastq files should start with '@' character")
+        lines = [line]
+        seq_length = 0
+        line = handle.readline()
+        while line and line[0] != '+':
+            lines.append(line)
+            seq_length += len(line.rstrip())
+            line = handle.readline()
+        if not line:
+            raise ValueError("End of file without quality information.")
+        lines.append(line)
+        line = handle.readline()
+        lines.append(line)
+        qual_length = len(line.rstrip())
+        line = handle.readline()
+        while line and (line[0] != '@' or qual_length < seq_length):
+            lines.append(line)
+            qual_length += len(line.rstrip())
+            line = handle.readline()
+        if seq_length != qual_length:
+            raise ValueError("Lengths of sequence and quality values differs for %s (%i and %i)."
+                             % (lines[0][1:].rstrip(), seq_length, qual_length))
+        yield ''.join(lines)
+
+
+class RecordWriter:
+    """
+    Buffered writer for (title, seq, qual) records. Formatted records are
+    collected in memory and written to the handle in blocks of about
+    buffer_size bytes. flush() must be called before the handle is used by
+    anything else, close() flushes and closes the handle.
+    """
+
+    def __init__(self, handle, format, buffer_size=1048576):
+        self.handle = handle
+        self.format = format
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.size = 0
+
+    def write(self, title, seq, qual=None):
+        self.write_text(format_record(title, seq, qual, self.format))
+
+    def write_text(self, text):
+        """ Write the text of formatted records (from format_record or retitle) """
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.handle.write(''.join(self.buffer))
+            self.buffer = []
+            self.size = 0
+
+    def close(self):
+        self.flush()
+        self.handle.close()
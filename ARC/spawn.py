@@ -14,15 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import time
 import multiprocessing
 import os
 import sys
 import traceback
+from Queue import Empty
 from ARC import ProcessRunner
 from ARC import logger
 from ARC import exceptions
 from ARC.runners import Mapper
+from ARC.scheduler import Scheduler
 
 
 class Spawn:
@@ -32,6 +33,12 @@ class Spawn:
         self.pid = os.getpid()
         self.nprocs = int(config['nprocs'])
         self.q = multiprocessing.JoinableQueue()
+        # Events sent to the scheduler by jobs and workers:
+        # ('submit', parent task, job, barrier): a job submitted a new one
+        # ('started', task): a worker picked a task off the queue
+        # ('job_done', task, status): a worker finished a task
+        self.events = multiprocessing.Queue()
+        self.scheduler = Scheduler(self.q, self.nprocs, float(config['rollingrounds']))
         # Contains the state of the job
         # 0: Not set
         # 1: Waiting for jobs
@@ -42,8 +49,8 @@ class Spawn:
         # [1]: Number of jobs returned rerun
         # [2]: Number of Mapper jobs run
         # [3]: Number of Assembly jobs run
-        # [4]: Number of Checker jobs run
-        # [5]: Number of Finisher jobs run
+        # [4]: Number of Finisher jobs run
+        # [5]: Number of Splitter jobs run
         self.stats = multiprocessing.Array('i', [0] * 6)
 
     def submit(self):
@@ -52,14 +59,25 @@ class Spawn:
 
         for sample in self.config['Samples']:
             s = self.config['Samples'][sample]
+            # Only settings and this sample's files go in params, shared
+            # state is in the run state database at params['state_db'].
             params = {}
             for k in self.config:
-                params[k] = self.config[k]
+                if k != 'Samples':
+                    params[k] = self.config[k]
+            params['nsamples'] = len(self.config['Samples'])
             params['working_dir'] = s['working_dir']
             params['finished_dir'] = s['finished_dir']
-            #params['reference'] = s['reference']
-            params['reference'] = os.path.join(s['working_dir'], 'I000_contigs.fasta')
+            # Every sample starts from the same shared, masked reference
+            # unless it is resumed from a checkpoint
+            params['reference'] = self.config['initial_reference']
             params['sample'] = sample
+            checkpoint = s.get('checkpoint')
+            if checkpoint is not None:
+                if checkpoint.finished:
+                    continue
+                params['iteration'] = checkpoint.iteration
+                params['reference'] = checkpoint.reference
 
             if 'PE1' in s and 'PE2' in s:
                 params['PE1'] = s['PE1']
@@ -68,7 +86,7 @@ class Spawn:
                 params['SE'] = s['SE']
 
             # mapper = Mapper(params)
-            self.q.put(Mapper.to_job(params))
+            self.scheduler.submit(Mapper.to_job(params))
 
     def run(self):
         logger.info("Starting...")
@@ -78,6 +96,7 @@ class Spawn:
             worker = ProcessRunner(
                 i,
                 self.q,
+                self.events,
                 self.status,
                 self.stats,
                 self.pid)
@@ -85,44 +104,43 @@ class Spawn:
             worker.daemon = False
             worker.start()
 
-        while True:
-            try:
-                self.q.join()
-
-                # This shouldn't be needed but we will check just in case
-                if self.all_workers_waiting():
-                    logger.debug("Workers are all waiting and the queue is empty.  Exiting")
-                    break
-                else:
-                    logger.debug("Workers are not in a waiting state.  Waiting for more.")
-                    time.sleep(5)
-
-            except exceptions.FatalError:
-                logger.error("A fatal error was encountered.")
-                self.killall()
-                raise
-            except (KeyboardInterrupt, SystemExit):
-                logger.error("Terminating processes")
-                self.killall()
-                raise
-            except Exception as e:
-                ex_type, ex, tb = sys.exc_info()
-                logger.error("\n".join(traceback.format_exception(ex_type, ex, tb)))
-                logger.error("An unhandled exception occurred")
-                self.killall()
-                raise
-            finally:
-                # Kill 'em all!
-                self.killall()
+        try:
+            # A task's 'job_done' event comes after the jobs it submitted, so
+            # nothing is left to run once every task in the graph is done.
+            while self.scheduler.unfinished > 0:
+                try:
+                    # The timeout keeps the loop responsive to SIGINT
+                    event = self.events.get(timeout=5)
+                except Empty:
+                    continue
+                self.handle(event)
+            logger.debug("All jobs are done and the queue is empty.  Exiting")
+
+        except exceptions.FatalError:
+            logger.error("A fatal error was encountered.")
+            raise
+        except (KeyboardInterrupt, SystemExit):
+            logger.error("Terminating processes")
+            raise
+        except Exception as e:
+            ex_type, ex, tb = sys.exc_info()
+            logger.error("\n".join(traceback.format_exception(ex_type, ex, tb)))
+            logger.error("An unhandled exception occurred")
+            raise
+        finally:
+            # Kill 'em all!
+            self.killall()
 
         logger.info("-----")
         logger.info("%d processes returned ok." % (self.stats[0]))
         logger.info("%d processes had to be rerun." % (self.stats[1]))
         logger.info("-----")
         logger.info("%d Mapper jobs run." % (self.stats[2]))
+        logger.info("%d Splitter jobs run." % (self.stats[5]))
         logger.info("%d Assembly jobs run." % (self.stats[3]))
-        logger.info("%d Checker jobs run." % (self.stats[4]))
-        logger.info("%d Finisher jobs run." % (self.stats[5]))
+        logger.info("%d Finisher jobs run." % (self.stats[4]))
+        logger.info("-----")
+        self.scheduler.report()
         logger.info("-----")
 
     def killall(self):
@@ -131,12 +149,11 @@ class Spawn:
             self.workers[i].terminate()
             self.workers[i].join()
 
-    def all_workers_waiting(self):
-        waiting = 0
-        for i in range(self.nprocs):
-            logger.debug("ProcessRunner %d reports %d" % (i, self.status[i]))
-            if self.status[i] == 1:
-                waiting += 1
-
-        logger.debug("%d of %d workers are in the waiting state" % (waiting, self.nprocs))
-        return waiting == self.nprocs
+    def handle(self, event):
+        """ Pass an event from a job or worker on to the scheduler """
+        if event[0] == 'submit':
+            self.scheduler.submit(event[2], parent=event[1], barrier=event[3])
+        elif event[0] == 'started':
+            self.scheduler.started(event[1])
+        elif event[0] == 'job_done':
+            self.scheduler.finished(event[1], event[2])
@@ -0,0 +1,210 @@
+# Copyright 2013, Institute for Bioninformatics and Evolutionary Studies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sqlite3
+from collections import namedtuple
+from ARC import exceptions
+
+# The run state which used to travel through the job queue in params
+# (safe_targets, summary_stats, readcounts and the targets of each
+# iteration) lives in one SQLite database in shared_working. Jobs only
+# carry its path as params['state_db'] and open it when they start, so queue
+# messages stay the same size however many targets there are.
+#
+#   names:      reference record ordinal -> target (safe names are t__<ordinal>)
+#   targets:    target -> ordinal used for it and its length
+#   active:     the targets of each sample which are still being worked on
+#   retired:    the sample iteration each other target was retired in
+#   readcounts: reads mapped per sample, target and iteration
+#   jobs:       the targets of each sample and iteration, see Job, and
+#               whether a Finisher has collected them yet
+#   checkpoints, checkpoint_files: where each sample can be resumed from
+#               and the sizes of its finished files at that point
+#
+# A target's own iteration counts the iterations it was mapped in. It is the
+# sample's iteration unless rollingrounds lets targets skip some.
+
+SCHEMA = """
+CREATE TABLE names (ordinal INTEGER PRIMARY KEY, target TEXT NOT NULL);
+CREATE TABLE targets (target TEXT PRIMARY KEY, ordinal INTEGER NOT NULL, length INTEGER NOT NULL);
+CREATE TABLE active (sample TEXT NOT NULL, target TEXT NOT NULL, PRIMARY KEY (sample, target));
+CREATE TABLE retired (sample TEXT NOT NULL, target TEXT NOT NULL, iteration INTEGER NOT NULL,
+                      PRIMARY KEY (sample, target));
+CREATE TABLE readcounts (sample TEXT NOT NULL, target TEXT NOT NULL, iteration INTEGER NOT NULL,
+                         reads INTEGER NOT NULL, PRIMARY KEY (sample, target, iteration));
+CREATE TABLE jobs (sample TEXT NOT NULL, iteration INTEGER NOT NULL, ordinal INTEGER NOT NULL,
+                   target TEXT NOT NULL, target_iteration INTEGER NOT NULL, last_assembly INTEGER NOT NULL,
+                   mapped INTEGER NOT NULL, previous INTEGER NOT NULL, done INTEGER NOT NULL DEFAULT 0,
+                   PRIMARY KEY (sample, iteration, ordinal));
+CREATE TABLE checkpoints (sample TEXT PRIMARY KEY, iteration INTEGER NOT NULL, reference TEXT NOT NULL,
+                          finished INTEGER NOT NULL);
+CREATE TABLE checkpoint_files (sample TEXT NOT NULL, name TEXT NOT NULL, size INTEGER NOT NULL,
+                               PRIMARY KEY (sample, name));
+"""
+
+JOB_COLUMNS = "ordinal, target, iteration, target_iteration, last_assembly, mapped, previous"
+
+# A target's job in one iteration: the sample iteration whose Mapper made it,
+# the target's own iteration, its last_assembly flag and the reads mapped to
+# it then and in its previous iteration
+Job = namedtuple('Job', JOB_COLUMNS.replace(',', ''))
+
+# The last checkpoint of a sample: the iteration and reference its next Mapper
+# starts from (unless it is finished) and {name: size} of its finished files
+Checkpoint = namedtuple('Checkpoint', 'iteration reference finished files')
+
+
+class StateStore:
+    """
+    A connection to the run state database. Every process opens its own
+    connection (they can't be shared across fork) and should close it when
+    it is done. Writes are committed straight away, SQLite's locking keeps
+    concurrent jobs consistent and the timeout covers waiting on each other.
+    """
+
+    def __init__(self, path, timeout=600):
+        if not os.path.exists(path):
+            raise exceptions.FatalError("Run state database %s does not exist" % path)
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=timeout)
+        self.db.text_factory = str
+
+    @classmethod
+    def create(cls, path, names, summary_stats, samples):
+        """
+        Start a new database from what was learned reading the reference:
+        names lists the target of each record in order (record i is safe
+        target t__i), summary_stats maps the unmasked targets to
+        {'targetLength'}. Every sample starts with all of those targets
+        active.
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        ordinals = {}
+        for i, target in enumerate(names):
+            # Like safe_targets, a target's last record names it
+            ordinals[target] = i
+        db = sqlite3.connect(path)
+        db.text_factory = str
+        db.executescript(SCHEMA)
+        db.executemany("INSERT INTO names VALUES (?, ?)", enumerate(names))
+        db.executemany("INSERT INTO targets VALUES (?, ?, ?)",
+                       ((t, o, summary_stats[t]['targetLength'] if t in summary_stats else 0)
+                        for t, o in ordinals.iteritems()))
+        for sample in samples:
+            db.executemany("INSERT INTO active VALUES (?, ?)", ((sample, t) for t in summary_stats))
+        db.commit()
+        db.close()
+        return cls(path)
+
+    def close(self):
+        self.db.close()
+
+    #
+    # Targets
+    #
+    def target_names(self):
+        """ {ordinal: target} for every reference record """
+        return dict(self.db.execute("SELECT ordinal, target FROM names"))
+
+    def targets(self):
+        """ (target, ordinal, length) of every target """
+        return self.db.execute("SELECT target, ordinal, length FROM targets").fetchall()
+
+    #
+    # Per sample state
+    #
+    def active_targets(self, sample):
+        return [r[0] for r in self.db.execute("SELECT target FROM active WHERE sample = ?", (sample,))]
+
+    def retire(self, sample, targets, iteration):
+        """ Take targets out of further work for sample (they were written out or got no reads) """
+        self.db.executemany("DELETE FROM active WHERE sample = ? AND target = ?", ((sample, t) for t in targets))
+        self.db.executemany("INSERT OR REPLACE INTO retired VALUES (?, ?, ?)", ((sample, t, iteration) for t in targets))
+        self.db.commit()
+
+    def set_readcounts(self, sample, iteration, counts):
+        """ Record {target: reads} mapped in an iteration """
+        self.db.executemany("INSERT OR REPLACE INTO readcounts VALUES (?, ?, ?, ?)",
+                            ((sample, t, iteration, n) for t, n in counts.iteritems()))
+        self.db.commit()
+
+    def mapped_history(self, sample):
+        """ {target: (iterations it got reads in, reads in the last of them)} """
+        # SQLite takes reads from the row with MAX(iteration)
+        return dict((r[0], (r[1], r[2])) for r in self.db.execute(
+            "SELECT target, COUNT(*), reads, MAX(iteration) FROM readcounts WHERE sample = ? GROUP BY target",
+            (sample,)))
+
+    #
+    # Targets of an iteration
+    #
+    def add_jobs(self, sample, iteration, jobs):
+        """ jobs is a list of Job """
+        self.db.execute("DELETE FROM jobs WHERE sample = ? AND iteration = ?", (sample, iteration))
+        self.db.executemany("INSERT INTO jobs (sample, %s) VALUES (?, ?, ?, ?, ?, ?, ?, ?)" % JOB_COLUMNS,
+                            ((sample,) + tuple(j) for j in jobs))
+        self.db.commit()
+
+    def select_jobs(self, where, args):
+        return [Job(r[0], r[1], r[2], r[3], bool(r[4]), r[5], r[6]) for r in self.db.execute(
+            "SELECT %s FROM jobs WHERE %s ORDER BY iteration, ordinal" % (JOB_COLUMNS, where), args)]
+
+    def jobs(self, sample, iteration, first, last):
+        """ The jobs of an iteration for the target ordinals first to last """
+        return self.select_jobs("sample = ? AND iteration = ? AND ordinal BETWEEN ? AND ?",
+                                (sample, iteration, first, last))
+
+    def open_jobs(self, sample):
+        """ The jobs of every iteration no Finisher has collected yet """
+        return self.select_jobs("sample = ? AND done = 0", (sample,))
+
+    def finish_jobs(self, sample, jobs):
+        self.db.executemany("UPDATE jobs SET done = 1 WHERE sample = ? AND iteration = ? AND ordinal = ?",
+                            ((sample, j.iteration, j.ordinal) for j in jobs))
+        self.db.commit()
+
+    #
+    # Checkpoints
+    #
+    def checkpoint(self, sample, iteration, reference, finished, files):
+        """
+        Record that sample can be resumed with a Mapper of iteration against
+        reference (or that it is finished), files is {name: size} of its
+        finished files. Replaces the sample's previous checkpoint.
+        """
+        self.db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)",
+                        (sample, iteration, reference, int(finished)))
+        self.db.execute("DELETE FROM checkpoint_files WHERE sample = ?", (sample,))
+        self.db.executemany("INSERT INTO checkpoint_files VALUES (?, ?, ?)",
+                            ((sample, name, size) for name, size in files.iteritems()))
+        self.db.commit()
+
+    def last_checkpoint(self, sample):
+        """ The Checkpoint of sample, None if it has none """
+        row = self.db.execute("SELECT iteration, reference, finished FROM checkpoints WHERE sample = ?",
+                              (sample,)).fetchone()
+        if row is None:
+            return None
+        files = dict(self.db.execute("SELECT name, size FROM checkpoint_files WHERE sample = ?", (sample,)))
+        return Checkpoint(row[0], row[1], bool(row[2]), files)
+
+    def rollback(self, sample, iteration):
+        """ Undo everything recorded for sample after iteration, so it can run again from there """
+        self.db.execute("INSERT INTO active SELECT sample, target FROM retired WHERE sample = ? AND iteration > ?",
+                        (sample, iteration))
+        for table in ('retired', 'readcounts', 'jobs'):
+            self.db.execute("DELETE FROM %s WHERE sample = ? AND iteration > ?" % table, (sample, iteration))
+        self.db.commit()
@@ -0,0 +1,122 @@
+# Copyright 2013, Institute for Bioninformatics and Evolutionary Studies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from array import array
+
+# Values of the status column. A target's id is the ordinal of the reference
+# record it is counted under (its safe name is t__<id>), rows of the other
+# records are NONE. RETIRED targets were taken out of the run before the table
+# was loaded, the statuses after it are the ones written to
+# target_summary_table.tsv when a target is retired.
+STATUSES = ['None', 'Active', 'Retired', 'NoReads', 'Finished', 'Repeat', 'Killed']
+NONE, ACTIVE, RETIRED = 0, 1, 2
+
+
+class TargetTable:
+    """
+    The per-target state of one sample held in columns indexed by target id
+    rather than in dicts per target:
+
+    name:    interned target name of every record
+    length:  array of target lengths
+    status:  array of STATUSES codes
+    rounds:  array of how many iterations each target got reads in
+    reads:   array of the reads mapped to each target the last time
+    iteration, readcount, contigs, contig_length: arrays set when a
+             target is retired
+
+    Load it from the run state database with load() and hand the targets
+    retired while it was loaded back with save().
+    """
+
+    def __init__(self, names):
+        n = len(names)
+        self.name = [intern(t) for t in names]
+        self.length = array('l', [0]) * n
+        self.status = array('B', [NONE]) * n
+        self.rounds = array('l', [0]) * n
+        self.reads = array('l', [0]) * n
+        self.iteration = array('l', [0]) * n
+        self.readcount = array('l', [0]) * n
+        self.contigs = array('l', [0]) * n
+        self.contig_length = array('l', [0]) * n
+        self.ids = {}
+        # Ids in the order they were retired, the order their stats are written
+        self.retired = []
+
+    @classmethod
+    def load(cls, state, sample):
+        """ The table of sample """
+        names = state.target_names()
+        table = cls([names[i] for i in xrange(len(names))])
+        for target, target_id, length in state.targets():
+            table.ids[table.name[target_id]] = target_id
+            table.length[target_id] = length
+            table.status[target_id] = RETIRED
+        for target in state.active_targets(sample):
+            table.status[table.ids[target]] = ACTIVE
+        for target, (rounds, reads) in state.mapped_history(sample).iteritems():
+            table.rounds[table.ids[target]] = rounds
+            table.reads[table.ids[target]] = reads
+        return table
+
+    def __len__(self):
+        return len(self.name)
+
+    def id(self, target):
+        return self.ids[target]
+
+    def active(self):
+        """ Ids of the targets still being worked on """
+        return [i for i, s in enumerate(self.status) if s == ACTIVE]
+
+    def retire(self, ids, status, iteration, readcount=None, contigs=None, contig_length=None):
+        """
+        Set the status of the targets in ids retired in iteration (a single
+        iteration, or a list of each target's with rollingrounds), with the
+        readcount, contigs and contig_length columns from lists in the same
+        order (0 if not given).
+        """
+        code = STATUSES.index(status)
+        for n, i in enumerate(ids):
+            self.status[i] = code
+            self.iteration[i] = iteration[n] if isinstance(iteration, list) else iteration
+            self.readcount[i] = readcount[n] if readcount is not None else 0
+            self.contigs[i] = contigs[n] if contigs is not None else 0
+            self.contig_length[i] = contig_length[n] if contig_length is not None else 0
+        self.retired.extend(ids)
+
+    def write_stats(self, finished_dir, sample, ids=None):
+        """
+        Append the rows of ids (by default every target retired while the
+        table was loaded) to target_summary_table.tsv in one write.
+        """
+        if ids is None:
+            ids = self.retired
+        if not ids:
+            return
+        lines = []
+        for i in ids:
+            lines.append('\t'.join([sample, self.name[i], str(self.length[i]), STATUSES[self.status[i]],
+                                    str(self.iteration[i]), str(self.readcount[i]),
+                                    str(self.contigs[i]), str(self.contig_length[i])]) + '\n')
+        tstf = open(os.path.join(finished_dir, "target_summary_table.tsv"), 'a')
+        tstf.write(''.join(lines))
+        tstf.close()
+
+    def save(self, state, sample, iteration):
+        """ Take the targets retired while the table was loaded out of the run in iteration of sample """
+        state.retire(sample, [self.name[i] for i in self.retired], iteration)
+        self.retired = []
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks comparing ARC's hot paths against the implementations they
+replaced. Run from the top level of the ARC repository, e.g.:
+
+    python contrib/ARC_benchmarks.py index test_data/reads/Sample1_R1.fastq test_data/reads/Sample1_R2.fastq
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import shutil
+import argparse
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Bio import SeqIO
+from ARC import seqio
+from ARC.functions import keyfunction, mask_seq
+from ARC.read_index import build_index, ReadIndex
+
+
+def timed(label, func, *args):
+    start = time.time()
+    result = func(*args)
+    print "%-40s %10.3f seconds" % (label, time.time() - start)
+    return result
+
+
+def bench_index(args):
+    """ SeqIO.index_db against ARC's read index: build time and random fetches """
+    tmp = tempfile.mkdtemp()
+    try:
+        format = args.format
+        keyf = keyfunction(False)
+        files = args.files
+
+        def build_index_db():
+            return [SeqIO.index_db(os.path.join(tmp, "%d.sqlite" % i), f, format, key_function=keyf)
+                    for i, f in enumerate(files)]
+
+        dbs = timed("SeqIO.index_db build", build_index_db)
+        timed("ReadIndex build", build_index, os.path.join(tmp, "reads.idx"), files, format, False)
+        idx = ReadIndex(os.path.join(tmp, "reads.idx"), files)
+
+        keys = list(dbs[0].keys())
+        random.seed(0)
+        keys = [random.choice(keys) for i in xrange(args.lookups)]
+
+        def fetch_index_db():
+            for k in keys:
+                for db in dbs:
+                    db.get(k, None)
+
+        def fetch_read_index():
+            for k in keys:
+                idx.get(k)
+
+        timed("SeqIO.index_db %d fetches" % len(keys), fetch_index_db)
+        timed("ReadIndex %d fetches" % len(keys), fetch_read_index)
+        print "%-40s %10.1f MB" % ("SeqIO.index_db size", sum(
+            [os.path.getsize(os.path.join(tmp, "%d.sqlite" % i)) for i in range(len(files))]) / 1048576.0)
+        print "%-40s %10.1f MB" % ("ReadIndex size", os.path.getsize(os.path.join(tmp, "reads.idx")) / 1048576.0)
+        idx.close()
+        for db in dbs:
+            db.close()
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_split(args):
+    """ Renaming split reads with SeqIO against the raw record path """
+    tmp = tempfile.mkdtemp()
+    try:
+        format = args.format
+        keyf = keyfunction(False)
+        build_index(os.path.join(tmp, "reads.idx"), args.files, format, False)
+        idx = ReadIndex(os.path.join(tmp, "reads.idx"), args.files)
+        random.seed(0)
+        ordinals = sorted(random.randint(0, len(idx) - 1) for i in xrange(args.lookups))
+        raws = [idx.get_raw(o) for o in ordinals]
+        idx.close()
+
+        def split_seqio():
+            outf = StringIO()
+            for records in raws:
+                for n, raw in enumerate(records):
+                    r = SeqIO.read(StringIO(raw), format)
+                    r.id = r.name = keyf(r.id).replace(":", "_") + ":0:0:0:0#0/%d" % (n + 1)
+                    SeqIO.write(r, outf, format)
+            return outf.getvalue()
+
+        def split_raw():
+            outf = StringIO()
+            for records in raws:
+                for n, raw in enumerate(records):
+                    title = seqio.raw_title(raw)
+                    new_id = keyf(seqio.record_id(title)).replace(":", "_") + ":0:0:0:0#0/%d" % (n + 1)
+                    outf.write(seqio.retitle(raw, format, seqio.rename(title, new_id)))
+            return outf.getvalue()
+
+        old = timed("SeqIO split %d records" % len(raws), split_seqio)
+        new = timed("raw split %d records" % len(raws), split_raw)
+        print "%-40s %10s" % ("identical output", old == new)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_finish(args):
+    """ Annotating finished reads with SeqIO against the raw record path """
+    format = args.format
+    description = "Sample_:_target"
+
+    def finish_seqio():
+        outf = StringIO()
+        for f in args.files:
+            for r in SeqIO.parse(f, format):
+                r.description = description
+                SeqIO.write(r, outf, format)
+        return outf.getvalue()
+
+    def finish_raw():
+        outf = StringIO()
+        for f in args.files:
+            inf = open(f)
+            for raw in seqio.read_raw(inf, format):
+                outf.write(seqio.retitle(raw, format, seqio.describe(seqio.raw_title(raw), description)))
+            inf.close()
+        return outf.getvalue()
+
+    old = timed("SeqIO finish", finish_seqio)
+    new = timed("raw finish", finish_raw)
+    print "%-40s %10s" % ("identical output", old == new)
+
+
+def bench_seqio(args):
+    """ Bio.SeqIO against ARC.seqio: parsing, and parsing plus writing each file """
+    for f in args.files:
+        format = args.format or ('fasta' if f.endswith(('.fa', '.fasta', '.fna')) else 'fastq')
+        print "%s (%s, %.1f MB)" % (f, format, os.path.getsize(f) / 1048576.0)
+
+        def parse_seqio():
+            return sum(len(r) for r in SeqIO.parse(f, format))
+
+        def parse_arc():
+            inf = open(f)
+            n = sum(len(seq) for title, seq, qual in seqio.read_records(inf, format))
+            inf.close()
+            return n
+
+        def write_seqio():
+            outf = StringIO()
+            SeqIO.write(SeqIO.parse(f, format), outf, format)
+            return outf.getvalue()
+
+        def write_arc():
+            outf = StringIO()
+            inf = open(f)
+            writer = seqio.RecordWriter(outf, format)
+            for title, seq, qual in seqio.read_records(inf, format):
+                writer.write(title, seq, qual)
+            writer.flush()
+            inf.close()
+            return outf.getvalue()
+
+        timed("  SeqIO.parse", parse_seqio)
+        timed("  seqio.read_records", parse_arc)
+        old = timed("  SeqIO.parse + SeqIO.write", write_seqio)
+        new = timed("  read_records + RecordWriter", write_arc)
+        print "%-40s %10s" % ("  identical output", old == new)
+
+
+def num_unmers(seq, N):
+    #Calculate the number of unique nmers in seq
+    nmers = {}
+    for i in range(len(seq) - (N - 1)):
+        nmers[str(seq[i:i+N]).upper()] = True
+    return(len(nmers))
+
+
+def mask_seq_windowed(seq, mapper, W=15, N=3):
+    """ The original O(L*W) masker, kept as a reference for mask_seq """
+    seq_copy = bytearray(seq)
+    for i in range(len(seq) - (W - 1)):
+        if num_unmers(seq[i:i + W], N) < 7:
+            if mapper == 'blat':
+                seq_copy[i:i + W] = seq[i:i + W].lower()
+            if mapper == 'bowtie2':
+                seq_copy[i:i + W] = 'n' * W
+    return(seq_copy)
+
+
+def random_contigs(total, length):
+    """ Random contigs with simple repeats mixed in """
+    random.seed(0)
+    contigs = []
+    for i in xrange(max(1, total / length)):
+        seq = []
+        while sum(map(len, seq)) < length:
+            if random.random() < 0.05:
+                seq.append(''.join(random.choice('ACGT') for j in range(random.randint(1, 4))) * random.randint(3, 20))
+            else:
+                seq.append(''.join(random.choice('ACGTacgt') for j in range(random.randint(10, 200))))
+        contigs.append(''.join(seq)[:length])
+    return contigs
+
+
+def bench_mask(args):
+    """ mask_seq against the original windowed masker on random contigs """
+    contigs = random_contigs(args.length, args.contig_length)
+    print "Masking %d contigs, %d bases" % (len(contigs), sum(map(len, contigs)))
+    for mapper in ('bowtie2', 'blat'):
+        new = timed("mask_seq (%s)" % mapper, lambda: [mask_seq(c, mapper) for c in contigs])
+        if not args.skip_reference:
+            old = timed("windowed mask_seq (%s)" % mapper, lambda: [mask_seq_windowed(c, mapper) for c in contigs])
+            print "%-40s %10s" % ("identical masks", new == old)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ARC micro-benchmarks")
+    sub = parser.add_subparsers()
+
+    p = sub.add_parser('index', help=bench_index.__doc__)
+    p.add_argument('files', nargs='+', help="A SE file, or a PE1 and PE2 file")
+    p.add_argument('--format', default='fastq')
+    p.add_argument('--lookups', type=int, default=100000)
+    p.set_defaults(func=bench_index)
+
+    p = sub.add_parser('split', help=bench_split.__doc__)
+    p.add_argument('files', nargs='+', help="A SE file, or a PE1 and PE2 file")
+    p.add_argument('--format', default='fastq')
+    p.add_argument('--lookups', type=int, default=100000)
+    p.set_defaults(func=bench_split)
+
+    p = sub.add_parser('finish', help=bench_finish.__doc__)
+    p.add_argument('files', nargs='+', help="Read files written by splitreads")
+    p.add_argument('--format', default='fastq')
+    p.set_defaults(func=bench_finish)
+
+    p = sub.add_parser('seqio', help=bench_seqio.__doc__)
+    p.add_argument('files', nargs='+', help="FASTA or FASTQ files, e.g. a reference and read files")
+    p.add_argument('--format', default=None, help="Default: from the file extension")
+    p.set_defaults(func=bench_seqio)
+
+    p = sub.add_parser('mask', help=bench_mask.__doc__)
+    p.add_argument('--length', type=int, default=2000000, help="Total bases to mask")
+    p.add_argument('--contig-length', type=int, default=5000)
+    p.add_argument('--skip-reference', action='store_true', help="Don't time the original masker")
+    p.set_defaults(func=bench_mask)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Tests of ARC.packed_store: packing files into a container and reading
+entries back.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+lib_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from ARC import packed_store
+from ARC.packed_store import PackedStore
+
+FILES = {'PE1.fastq': "@r1\nACGT\n+\nIIII\n@r2\nAC\n+\nII\n",
+         'SE.fastq': "@r3\nGGGG\n+\nIIII",
+         'finished': "assembled_ok\n",
+         'empty': ""}
+
+
+class PackedStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        os.makedirs(self.src)
+        for name, data in FILES.items():
+            open(os.path.join(self.src, name), 'wb').write(data)
+        self.store = PackedStore(os.path.join(self.tmp, 'I001.pack'))
+        # Small chunks so entries are copied in several of them
+        self.chunk_size = packed_store.CHUNK_SIZE
+        packed_store.CHUNK_SIZE = 3
+
+    def tearDown(self):
+        packed_store.CHUNK_SIZE = self.chunk_size
+        shutil.rmtree(self.tmp)
+
+    def test_pack(self):
+        self.store.pack('t__000001', self.src, sorted(FILES) + ['missing'])
+        self.store.pack('t__000002', self.src, ['SE.fastq'])
+        self.assertEqual(sorted(self.store.names('t__000001')), sorted(FILES))
+        for name, data in FILES.items():
+            self.assertEqual(self.store.get('t__000001', name), data)
+        self.assertEqual(self.store.get('t__000002', 'SE.fastq'), FILES['SE.fastq'])
+        self.assertEqual(self.store.get('t__000002', 'PE1.fastq'), None)
+
+    def test_open(self):
+        """ Entries read line by line stop at the end of the entry """
+        self.store.pack('t__000001', self.src, ['PE1.fastq', 'SE.fastq'])
+        inf = self.store.open('t__000001', 'PE1.fastq')
+        self.assertEqual(inf.readline(), "@r1\n")
+        self.assertEqual(inf.read(2), "AC")
+        self.assertEqual(list(inf), ["GT\n", "+\n", "IIII\n", "@r2\n", "AC\n", "+\n", "II\n"])
+        self.assertEqual(inf.readline(), "")
+        self.assertEqual(inf.read(), "")
+        inf.close()
+        inf = self.store.open('t__000001', 'SE.fastq')
+        self.assertEqual(list(inf), ["@r3\n", "GGGG\n", "+\n", "IIII"])
+        inf.close()
+        self.assertEqual(self.store.open('t__000001', 'missing'), None)
+
+    def test_replace(self):
+        """ A later entry replaces one with the same name """
+        self.store.pack('t__000001', self.src, ['finished'])
+        open(os.path.join(self.src, 'finished'), 'wb').write("assembly_failed\n")
+        self.store.pack('t__000001', self.src, ['finished'])
+        self.assertEqual(self.store.get('t__000001', 'finished'), "assembly_failed\n")
+
+    def test_materialize(self):
+        self.store.pack('t__000001', self.src, sorted(FILES))
+        dest = os.path.join(self.tmp, 'dest')
+        self.store.materialize('t__000001', dest, ['PE1.fastq', 'empty'])
+        self.assertEqual(sorted(os.listdir(dest)), ['PE1.fastq', 'empty'])
+        for name in os.listdir(dest):
+            self.assertEqual(open(os.path.join(dest, name), 'rb').read(), FILES[name])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Tests of the read index (ARC.read_index) against Bio.SeqIO.index on the reads
+in test_data/reads. Run from anywhere with
+
+    python -m unittest discover -s test_data -p 'test_*.py'
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from Bio import SeqIO
+from Bio import bgzf
+
+lib_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from ARC import read_index
+from ARC.read_index import build_index, hash_key, ReadIndex, SampleIndex
+from ARC.functions import keyfunction
+
+READS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reads")
+PE = [os.path.join(READS, "Sample1_R1.fastq"), os.path.join(READS, "Sample1_R2.fastq")]
+SE = os.path.join(READS, "Sample1_SE.fastq")
+FASTA = os.path.join(READS, "Sample1_SE.fasta")
+
+
+def seqio_index(filename, format):
+    return SeqIO.index(filename, format, key_function=keyfunction(False))
+
+
+def file_keys(filename, format):
+    return [keyfunction(False)(r.id) for r in SeqIO.parse(filename, format)]
+
+
+class ReadIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def index(self, files, format, name="reads.idx"):
+        index_file = os.path.join(self.tmp, name)
+        nreads = build_index(index_file, files, format, False)
+        return nreads, ReadIndex(index_file, files)
+
+    def check_records(self, idx, files, format):
+        """ Every record of idx matches SeqIO.index, ordinals follow file order """
+        keys = file_keys(files[0], format)
+        expected = [seqio_index(f, format) for f in files]
+        self.assertEqual(len(idx), len(keys))
+        for i, key in enumerate(keys):
+            self.assertTrue(key in idx)
+            self.assertEqual(idx.ordinal(key), i)
+            self.assertEqual(idx.get_raw(i), [e.get_raw(key) for e in expected])
+
+    def test_single_fastq(self):
+        nreads, idx = self.index([SE], 'fastq')
+        self.assertEqual(nreads, len(file_keys(SE, 'fastq')))
+        self.check_records(idx, [SE], 'fastq')
+        self.assertEqual(idx.ordinal('not_a_read'), None)
+        idx.close()
+
+    def test_fasta(self):
+        nreads, idx = self.index([FASTA], 'fasta')
+        self.check_records(idx, [FASTA], 'fasta')
+        idx.close()
+
+    def test_pairs(self):
+        nreads, idx = self.index(PE, 'fastq')
+        self.check_records(idx, PE, 'fastq')
+        idx.close()
+
+    def test_keys(self):
+        """ Keys are stored as sorted truncated MD5 digests of the read keys """
+        nreads, idx = self.index([SE], 'fastq')
+        stored = [idx.keys[i] for i in xrange(len(idx))]
+        self.assertEqual(stored, sorted(hash_key(k) for k in file_keys(SE, 'fastq')))
+        idx.close()
+
+    def test_gaps(self):
+        """ Sparse and backwards fetches give the same records as SeqIO """
+        nreads, idx = self.index(PE, 'fastq')
+        keys = file_keys(PE[0], 'fastq')
+        expected = seqio_index(PE[0], 'fastq')
+        for i in range(0, nreads, 7) + range(nreads - 1, 0, -50) + [0, nreads - 1, 1]:
+            self.assertEqual(idx.get_raw(i)[0], expected.get_raw(keys[i]))
+        idx.close()
+
+    def test_buckets(self):
+        """ The bucket table used for large indexes finds the same ordinals """
+        bucket_min = read_index.BUCKET_MIN
+        read_index.BUCKET_MIN = 1
+        try:
+            nreads, idx = self.index([SE], 'fastq')
+        finally:
+            read_index.BUCKET_MIN = bucket_min
+        self.assertNotEqual(idx.buckets, None)
+        for i, key in enumerate(file_keys(SE, 'fastq')):
+            self.assertEqual(idx.ordinal(key), i)
+        idx.close()
+
+    def test_bgzf(self):
+        compressed = os.path.join(self.tmp, "SE.fastq.gz")
+        outf = bgzf.BgzfWriter(compressed, 'wb')
+        outf.write(open(SE).read())
+        outf.close()
+        nreads, idx = self.index([compressed], 'fastq')
+        keys = file_keys(SE, 'fastq')
+        expected = seqio_index(SE, 'fastq')
+        for i in range(0, nreads, 3) + [nreads - 1, 0]:
+            self.assertEqual(idx.get_raw(i)[0], expected.get_raw(keys[i]))
+        idx.close()
+
+    def test_sample_index(self):
+        """ Pairs come first in the ordinals of a sample, then single reads """
+        build_index(os.path.join(self.tmp, "PE.idx"), PE, 'fastq', False)
+        build_index(os.path.join(self.tmp, "SE.idx"), [SE], 'fastq', False)
+        sample = SampleIndex(self.tmp, PE, SE)
+        npe = len(file_keys(PE[0], 'fastq'))
+        se_keys = file_keys(SE, 'fastq')
+        self.assertEqual(len(sample), npe + len(se_keys))
+        paired, records = sample.get_raw(npe - 1)
+        self.assertTrue(paired)
+        self.assertEqual(len(records), 2)
+        paired, records = sample.get_raw(npe)
+        self.assertFalse(paired)
+        self.assertEqual(records[0], seqio_index(SE, 'fastq').get_raw(se_keys[0]))
+        self.assertEqual(sample.ordinal(se_keys[0]), npe)
+        sample.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
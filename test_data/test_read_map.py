@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+Tests of ARC.read_map: building, saving and loading a ReadMap and inverting
+it with by_read().
+"""
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+lib_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from ARC import exceptions
+from ARC import read_map
+from ARC.read_map import ReadMap, read_hash, safe_target_name, target_ordinal
+
+
+def random_hits(n=5000, ntargets=40, nreads=100000, seed=1):
+    random.seed(seed)
+    return [(random.randrange(ntargets), random.randrange(nreads)) for i in xrange(n)]
+
+
+def build(hits, hashes=False):
+    m = ReadMap(hashes=hashes)
+    for t, r in hits:
+        m.add(t, r, read_hash(str(r)) if hashes else 0)
+    m.finalize()
+    return m
+
+
+class ReadMapTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.hits = random_hits()
+        self.expected = {}
+        for t, r in self.hits:
+            self.expected.setdefault(t, set()).add(r)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_safe_names(self):
+        self.assertEqual(safe_target_name(42), "t__000042")
+        self.assertEqual(target_ordinal(safe_target_name(42)), 42)
+
+    def test_finalize(self):
+        """ Reads are grouped by target, sorted and without duplicates """
+        m = build(self.hits)
+        self.assertEqual(sorted(m.targets()), sorted(self.expected))
+        for t in self.expected:
+            self.assertEqual(list(m.get(t)), sorted(self.expected[t]))
+            self.assertEqual(m.count(t), len(self.expected[t]))
+        self.assertFalse(1000 in m)
+        self.assertEqual(list(m.get(1000)), [])
+
+    def test_round_trip(self):
+        m = build(self.hits)
+        filename = os.path.join(self.tmp, "read_map")
+        m.save(filename)
+        loaded = ReadMap.load(filename)
+        self.assertEqual(list(loaded.offsets), list(m.offsets))
+        self.assertEqual(list(loaded.reads), list(m.reads))
+
+    def test_load_targets(self):
+        """ Loading only some targets keeps their reads at the same target ordinals """
+        m = build(self.hits)
+        filename = os.path.join(self.tmp, "read_map")
+        m.save(filename)
+        wanted = [3, 17, 39]
+        loaded = ReadMap.load(filename, wanted)
+        self.assertEqual(sorted(loaded.targets()), sorted(t for t in wanted if t in self.expected))
+        for t in wanted:
+            self.assertEqual(list(loaded.get(t)), list(m.get(t)))
+
+    def test_offset_size(self):
+        """ A map saved with another offset size is refused """
+        m = build(self.hits)
+        filename = os.path.join(self.tmp, "read_map")
+        m.save(filename)
+        data = open(filename, 'rb').read()
+        noffsets, nreads, itemsize = read_map.HEADER.unpack_from(data)
+        self.assertEqual(itemsize, m.offsets.itemsize)
+        outf = open(filename, 'wb')
+        outf.write(read_map.HEADER.pack(noffsets, nreads, itemsize + 1) + data[read_map.HEADER.size:])
+        outf.close()
+        self.assertRaises(exceptions.FatalError, ReadMap.load, filename)
+
+    def test_by_read(self):
+        m = build(self.hits)
+        inverted = list(m.by_read())
+        self.assertEqual([r for r, targets in inverted], sorted(set(r for t, r in self.hits)))
+        by_read = {}
+        for t, r in self.hits:
+            by_read.setdefault(r, set()).add(t)
+        for r, targets in inverted:
+            self.assertEqual(sorted(targets), sorted(by_read[r]))
+
+    def test_by_read_without_wide_arrays(self):
+        """ Builds without a 64 bit array type invert the map the same way """
+        m = build(self.hits + [(5, 2 ** 32 - 1)])
+        expected = list(m.by_read())
+        wide = read_map.WIDE
+        read_map.WIDE = None
+        try:
+            self.assertEqual(list(m.by_read()), expected)
+        finally:
+            read_map.WIDE = wide
+
+    def test_downsample(self):
+        """ Downsampling keeps a subset of each target's reads, the same for the same keys """
+        full = build(self.hits)
+        half = build(self.hits, hashes=True)
+        half.downsample(0.5)
+        self.assertTrue(0 < len(half.reads) < len(full.reads))
+        for t in half.targets():
+            self.assertTrue(set(half.get(t)) <= set(full.get(t)))
+        again = build(self.hits, hashes=True)
+        again.downsample(0.5)
+        self.assertEqual(list(again.reads), list(half.reads))
+        capped = build(self.hits, hashes=True)
+        capped.downsample(1, cap=3)
+        for t in full.targets():
+            self.assertEqual(capped.count(t), min(3, full.count(t)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Tests of ARC.scheduler: scripted sequences of submit / started / finished
+calls, checking which tasks reach the job queue and when.
+"""
+
+import os
+import sys
+import logging
+import unittest
+import multiprocessing
+
+lib_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from ARC import exceptions
+from ARC import scheduler
+from ARC.scheduler import Scheduler
+
+multiprocessing.get_logger().addHandler(logging.NullHandler())
+
+
+class JobQueue:
+    """ Stands in for the multiprocessing job queue """
+    def __init__(self):
+        self.jobs = []
+
+    def put(self, job):
+        self.jobs.append(job)
+
+    def tasks(self):
+        return [job['task'] for job in self.jobs]
+
+
+def job(runner, sample='Sample1', iteration=1, target=None, reads=0):
+    return {'runner': runner, 'params': {'sample': sample, 'iteration': iteration,
+                                         'target': target, 'reads': reads}}
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.q = JobQueue()
+        self.s = Scheduler(self.q, nprocs=100)
+
+    def run_task(self, task_id, status='ok'):
+        self.s.started(task_id)
+        self.s.finished(task_id, status)
+
+    def queued(self, task_id):
+        return task_id in self.q.tasks()
+
+    def iteration(self, nassemblies=2, sample='Sample1'):
+        """ Mapper -> Splitter -> Assemblers with a Finisher barrier on the Mapper """
+        mapper = self.s.submit(job('Mapper', sample))
+        self.s.started(mapper)
+        splitter = self.s.submit(job('Splitter', sample), mapper)
+        finisher = self.s.submit(job('Finisher', sample), mapper, barrier=True)
+        self.s.finished(mapper, 'ok')
+        self.s.started(splitter)
+        assemblies = [self.s.submit(job('Assembler', sample, target='t%d' % i, reads=10), splitter)
+                      for i in range(nassemblies)]
+        self.s.finished(splitter, 'ok')
+        return mapper, splitter, assemblies, finisher
+
+    def test_barrier(self):
+        """ The Finisher is queued only after every task below the Mapper is done """
+        mapper, splitter, assemblies, finisher = self.iteration()
+        self.assertFalse(self.queued(finisher))
+        self.assertTrue(all(self.queued(a) for a in assemblies))
+        self.run_task(assemblies[0])
+        # An assembly submitted after the barrier is waited for as well
+        self.s.started(assemblies[1])
+        late = self.s.submit(job('Assembler', target='late'), assemblies[1])
+        self.s.finished(assemblies[1], 'ok')
+        self.assertFalse(self.queued(finisher))
+        self.run_task(late)
+        self.assertTrue(self.queued(finisher))
+        self.assertEqual(self.q.tasks().count(finisher), 1)
+
+    def test_sample_barrier(self):
+        """ A 'sample' barrier waits for all tasks of its sample and no others """
+        mapper, splitter, assemblies, finisher = self.iteration()
+        other = self.s.submit(job('Mapper', 'Sample2'))
+        last = self.s.submit(job('Finisher'), barrier='sample')
+        for a in assemblies:
+            self.run_task(a)
+        self.assertFalse(self.queued(last))
+        self.s.started(finisher)
+        next_mapper = self.s.submit(job('Mapper', iteration=2), finisher)
+        self.s.finished(finisher, 'ok')
+        self.assertFalse(self.queued(last))
+        self.run_task(next_mapper)
+        self.assertTrue(self.queued(last))
+        self.assertTrue(self.queued(other))
+        self.assertEqual(self.s.tasks[other].state, scheduler.READY)
+
+    def test_rolling(self):
+        """ With rollingrounds the Finisher is queued once that fraction of assemblies is done """
+        self.s.rolling = 0.5
+        mapper = self.s.submit(job('Mapper'))
+        self.s.started(mapper)
+        splitter = self.s.submit(job('Splitter'), mapper)
+        finisher = self.s.submit(job('Finisher'), mapper, barrier=True)
+        self.s.finished(mapper, 'ok')
+        self.s.started(splitter)
+        assemblies = [self.s.submit(job('Assembler', target='t%d' % i, reads=10), splitter)
+                      for i in range(4)]
+        # Not before everything but the assemblies is done
+        self.run_task(assemblies[0])
+        self.run_task(assemblies[1])
+        self.assertFalse(self.queued(finisher))
+        self.s.finished(splitter, 'ok')
+        self.assertTrue(self.queued(finisher))
+        self.assertEqual(self.s.tasks[assemblies[2]].state, scheduler.READY)
+
+    def test_rolling_fraction(self):
+        self.s.rolling = 0.75
+        mapper, splitter, assemblies, finisher = self.iteration(4)
+        self.run_task(assemblies[0])
+        self.run_task(assemblies[1])
+        self.assertFalse(self.queued(finisher))
+        self.run_task(assemblies[2])
+        self.assertTrue(self.queued(finisher))
+
+    def test_retries(self):
+        """ A rerun task is queued again up to MAX_RETRIES times, then the run stops """
+        mapper = self.s.submit(job('Mapper'))
+        for i in range(scheduler.MAX_RETRIES):
+            self.run_task(mapper, 'rerun')
+            self.assertEqual(self.q.tasks().count(mapper), i + 2)
+        self.s.started(mapper)
+        self.assertRaises(exceptions.FatalError, self.s.finished, mapper, 'rerun')
+
+    def test_workers(self):
+        """ Tasks wait in the scheduler until a worker is free, pipeline work first """
+        self.s.nprocs = 1
+        mapper = self.s.submit(job('Mapper'))
+        self.s.started(mapper)
+        splitter = self.s.submit(job('Splitter'), mapper)
+        self.s.finished(mapper, 'ok')
+        self.s.started(splitter)
+        small = self.s.submit(job('Assembler', target='small', reads=10), splitter)
+        large = self.s.submit(job('Assembler', target='large', reads=1000), splitter)
+        other = self.s.submit(job('Splitter'), mapper)
+        self.assertEqual(self.q.tasks(), [mapper, splitter])
+        self.s.finished(splitter, 'ok')
+        self.assertEqual(self.q.tasks(), [mapper, splitter, other])
+        self.run_task(other)
+        self.assertEqual(self.q.tasks()[-1], large)
+        self.run_task(large)
+        self.assertEqual(self.q.tasks()[-1], small)
+
+
+if __name__ == '__main__':
+    unittest.main()
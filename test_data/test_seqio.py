@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Tests that ARC.seqio reads and writes records exactly the way Bio.SeqIO
+does, on the reads in test_data/reads and on records laid out differently
+from what SeqIO writes.
+"""
+
+import os
+import sys
+import glob
+import unittest
+from cStringIO import StringIO
+from Bio import SeqIO
+
+lib_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+if lib_path not in sys.path:
+    sys.path.insert(0, lib_path)
+
+from ARC import seqio
+
+READS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reads")
+
+# Layouts SeqIO reads but doesn't write: multi-line and repeated-title FASTQ,
+# unwrapped, short-wrapped and CRLF FASTA, a missing final newline
+ODD = [
+    ('fastq', "@r1 first read \nACGTAC\nGT\n+r1 first read\nIIIIII\nII\n@r2\nAC\n+\nII"),
+    ('fasta', ">a some description\nACGT ACGT\r\nAC\n>b\n\n>c\n" + "A" * 130 + "\n"),
+    ('fasta', ">x\n" + "A" * 60 + "\n" + "C" * 7),
+    ('fasta', ">y\n" + "ACGTACGTAC\n" * 7),
+]
+
+
+def inputs():
+    """ (name, format, text) of every test file and odd layout """
+    for f in sorted(glob.glob(os.path.join(READS, '*'))):
+        yield os.path.basename(f), 'fastq' if f.endswith('q') else 'fasta', open(f).read()
+    for i, (format, text) in enumerate(ODD):
+        yield 'odd %d' % i, format, text
+
+
+def seqio_write(records, format):
+    outf = StringIO()
+    SeqIO.write(records, outf, format)
+    return outf.getvalue()
+
+
+def new_title(title):
+    """ The title the splitter gives a read """
+    return seqio.rename(title, seqio.record_id(title).replace(":", "_") + ":0:0:0:0#0/1")
+
+
+class SeqioTest(unittest.TestCase):
+    def test_read_records(self):
+        for name, format, text in inputs():
+            expected = [(r.description, str(r.seq), r.letter_annotations.get('phred_quality'))
+                        for r in SeqIO.parse(StringIO(text), format)]
+            records = list(seqio.read_records(StringIO(text), format))
+            self.assertEqual([r[:2] for r in records], [e[:2] for e in expected], name)
+            self.assertEqual([seqio.record_id(r[0]) for r in records],
+                             [r.id for r in SeqIO.parse(StringIO(text), format)], name)
+
+    def test_format_record(self):
+        """ Writing the parsed records unchanged gives SeqIO.write's output """
+        for name, format, text in inputs():
+            expected = seqio_write(SeqIO.parse(StringIO(text), format), format)
+            writer_out = StringIO()
+            writer = seqio.RecordWriter(writer_out, format, buffer_size=100)
+            for title, seq, qual in seqio.read_records(StringIO(text), format):
+                writer.write(title, seq, qual)
+            writer.flush()
+            self.assertEqual(writer_out.getvalue(), expected, name)
+
+    def test_rename(self):
+        """ rename and retitle of the raw records against setting record.id """
+        for name, format, text in inputs():
+            records = list(SeqIO.parse(StringIO(text), format))
+            for r in records:
+                r.id = r.id.replace(":", "_") + ":0:0:0:0#0/1"
+            expected = seqio_write(records, format)
+            parsed = ''.join(seqio.format_record(new_title(title), seq, qual, format)
+                             for title, seq, qual in seqio.read_records(StringIO(text), format))
+            self.assertEqual(parsed, expected, name)
+            raw = ''.join(seqio.retitle(r, format, new_title(seqio.raw_title(r)))
+                          for r in seqio.read_raw(StringIO(text), format))
+            self.assertEqual(raw, expected, name)
+
+    def test_describe(self):
+        """ describe and retitle of the raw records against setting record.description """
+        description = "Sample1_:_target"
+        for name, format, text in inputs():
+            records = list(SeqIO.parse(StringIO(text), format))
+            for r in records:
+                r.description = description
+            expected = seqio_write(records, format)
+            raw = ''.join(seqio.retitle(r, format, seqio.describe(seqio.raw_title(r), description))
+                          for r in seqio.read_raw(StringIO(text), format))
+            self.assertEqual(raw, expected, name)
+
+    def test_canonical(self):
+        """ Records SeqIO wrote are copied as they are, others are not """
+        for name, format, text in inputs():
+            written = seqio_write(SeqIO.parse(StringIO(text), format), format)
+            for raw in seqio.read_raw(StringIO(written), format):
+                end = raw.find('\n')
+                self.assertTrue(seqio.canonical(raw[:end], raw[end + 1:], format), name)
+        format, text = ODD[0]
+        raw = seqio.read_raw(StringIO(text), format).next()
+        end = raw.find('\n')
+        self.assertFalse(seqio.canonical(raw[:end], raw[end + 1:], format))
+
+
+if __name__ == '__main__':
+    unittest.main()